@@ -1,4 +1,5 @@
 import dateparser
+import hashlib
 import json
 import malcolm_utils
 import os
@@ -8,16 +9,22 @@ import random
 import re
 import requests
 import string
+import time
 import traceback
 import urllib3
 import warnings
+import zlib
 
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, deque, OrderedDict
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 from flask import Flask, jsonify, request
+from threading import Condition, Event, Lock, Thread
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from urllib.parse import urlparse, urljoin
+from urllib3.util.retry import Retry
 
 # map categories of field names to OpenSearch dashboards
 fields_to_urls = []
@@ -231,6 +238,7 @@ else:
 if databaseMode == malcolm_utils.DatabaseMode.ElasticsearchRemote:
     import elasticsearch as DatabaseImport
     from elasticsearch_dsl import Search as SearchClass, A as AggregationClass, Q as QueryClass
+    from elasticsearch.helpers import scan as DatabaseScan
 
     DatabaseClass = DatabaseImport.Elasticsearch
     if opensearchHttpAuth:
@@ -238,6 +246,7 @@ if databaseMode == malcolm_utils.DatabaseMode.ElasticsearchRemote:
 else:
     import opensearchpy as DatabaseImport
     from opensearchpy import Search as SearchClass, A as AggregationClass, Q as QueryClass
+    from opensearchpy.helpers import scan as DatabaseScan
 
     DatabaseClass = DatabaseImport.OpenSearch
     if opensearchHttpAuth:
@@ -249,6 +258,196 @@ databaseClient = DatabaseClass(
 )
 
 
+class UpstreamSession(requests.Session):
+    """A requests.Session for the API's calls to other Malcolm components (OpenSearch, Dashboards,
+    NetBox, Logstash, etc.), sharing a bounded pool of keep-alive connections per host, applying a
+    default timeout and retrying connection failures and 502/503/504 responses with backoff
+    """
+
+    def __init__(self, timeout=None, retries=0, backoff=0.0, poolSize=10):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(
+            pool_connections=poolSize,
+            pool_maxsize=poolSize,
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=retries,
+                backoff_factor=backoff,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                raise_on_status=False,
+            ),
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+# for endpoints returning upstream data
+upstreamSession = UpstreamSession(
+    timeout=app.config["MALCOLM_API_UPSTREAM_TIMEOUT_SEC"],
+    retries=app.config["MALCOLM_API_UPSTREAM_RETRIES"],
+    backoff=app.config["MALCOLM_API_UPSTREAM_BACKOFF_SEC"],
+    poolSize=app.config["MALCOLM_API_UPSTREAM_POOL_SIZE"],
+)
+
+# for status probes (see run_probes), which have their own deadline and shouldn't retry
+probeSession = UpstreamSession(
+    timeout=app.config["MALCOLM_API_READY_TIMEOUT_SEC"],
+    poolSize=app.config["MALCOLM_API_UPSTREAM_POOL_SIZE"],
+)
+
+
+class FieldTypeCache(object):
+    """A process-wide cache of field name -> mapping type for each index pattern, used to choose
+    the "missing" bucket value for aggregations without a get_field_mapping round trip per field.
+
+    Types are read from the newest index matching the pattern. Once an index pattern's entry is
+    older than ttl seconds it is reloaded if the newest index or the template's _meta.hash (set
+    by shared-object-creation.sh whenever the templates are imported) has changed, otherwise it
+    is kept and only its negative (field not found) entries are dropped.
+
+    The lock only guards the entries themselves; OpenSearch is queried without holding it, so a
+    slow mapping lookup for one index pattern doesn't hold up requests for the others.
+    """
+
+    def __init__(self, client, templateName, ttl=300):
+        self.client = client
+        self.templateName = templateName
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = {}
+
+    def _template_hash(self):
+        try:
+            return malcolm_utils.deep_get(
+                next(
+                    iter(
+                        dict(
+                            self.client.indices.get_index_template(
+                                name=self.templateName,
+                                filter_path='index_templates.index_template._meta.hash',
+                            )
+                        ).get('index_templates', [])
+                    ),
+                    {},
+                ),
+                ['index_template', '_meta', 'hash'],
+            )
+        except Exception:
+            return None
+
+    def _newest_index(self, idx):
+        return max(dict(self.client.indices.get_alias(index=idx)).keys(), default=None)
+
+    def _field_types(self, index, fields='*'):
+        mapping = dict(self.client.indices.get_field_mapping(fields=fields, index=index))
+        return {
+            fname: next(iter(malcolm_utils.dictsearch(finfo, 'type')), None)
+            for fname, finfo in malcolm_utils.deep_get(mapping, [index, 'mappings'], {}).items()
+        }
+
+    def _load(self, idx):
+        newestIndex = self._newest_index(idx)
+        entry = {
+            'index': newestIndex,
+            'hash': self._template_hash(),
+            'types': self._field_types(newestIndex) if newestIndex else {},
+            'loaded': time.time(),
+        }
+        with self.lock:
+            self.entries[idx] = entry
+        if debugApi:
+            print(f"field type cache loaded {len(entry['types'])} fields for {idx} from {newestIndex}")
+        return entry
+
+    def _current(self, idx):
+        with self.lock:
+            entry = self.entries.get(idx)
+            if stale := (entry is not None) and (time.time() - entry['loaded'] > self.ttl):
+                # other requests carry on with this entry while this one checks whether it's still good
+                entry['loaded'] = time.time()
+        if entry is None:
+            entry = self._load(idx)
+        elif stale:
+            if (entry['index'] != self._newest_index(idx)) or (entry['hash'] != self._template_hash()):
+                entry = self._load(idx)
+            else:
+                with self.lock:
+                    entry['types'] = {k: v for k, v in entry['types'].items() if v is not None}
+        return entry
+
+    def missing_values(self, idx, fieldnames):
+        """Returns a dict of field name -> missing_field_map value for the fields of an index pattern
+
+        Parameters
+        ----------
+        idx : string
+            the index pattern being queried
+        fieldnames : string or Array of string
+            the name of the field(s)
+
+        Returns
+        -------
+        missing
+            a dict where key is the field name and value is the "missing" bucket value for its type
+        """
+        fieldnames = malcolm_utils.get_iterable(fieldnames)
+        types = {}
+        try:
+            entry = self._current(idx)
+            with self.lock:
+                unknown = [f for f in fieldnames if f not in entry['types']]
+            if entry['index'] and unknown:
+                # fields mapped since the entry was loaded are looked up together, and ones
+                #   that still aren't found are remembered until the next refresh
+                found = self._field_types(entry['index'], fields=unknown)
+                with self.lock:
+                    entry['types'].update({f: found.get(f) for f in unknown})
+            with self.lock:
+                types = {f: entry['types'].get(f) for f in fieldnames}
+        except Exception as e:
+            if debugApi:
+                print(f"{type(e).__name__}: {str(e)} getting field types for {idx}")
+        return {f: missing_field_map[types.get(f)] for f in fieldnames}
+
+    def warm(self, idxs):
+        for idx in malcolm_utils.get_iterable(idxs):
+            try:
+                self._load(idx)
+            except Exception as e:
+                if debugApi:
+                    print(f"{type(e).__name__}: {str(e)} warming field type cache for {idx}")
+
+
+fieldTypeCache = FieldTypeCache(
+    databaseClient,
+    app.config["MALCOLM_TEMPLATE"],
+    ttl=app.config["MALCOLM_API_FIELD_CACHE_TTL_SEC"],
+)
+Thread(
+    target=fieldTypeCache.warm,
+    args=(
+        list(
+            set(
+                [
+                    app.config["MALCOLM_NETWORK_INDEX_PATTERN"],
+                    app.config["MALCOLM_OTHER_INDEX_PATTERN"],
+                    app.config["ARKIME_NETWORK_INDEX_PATTERN"],
+                ]
+            )
+        ),
+    ),
+    daemon=True,
+).start()
+
+
 def doctype_is_host_logs(d):
     return any([str(d).lower().startswith(x) for x in ['host', 'beat', 'miscbeat']])
 
@@ -454,7 +653,7 @@ def timefield_from_args(args):
     return timefield
 
 
-def filtertime(search, args, default_from="1 day ago", default_to="now"):
+def filtertime(search, args, default_from="1 day ago", default_to="now", granularity_ms=0):
     """Applies a time filter (inclusive; extracted from request arguments) to an OpenSearch query and
     returns the range as a tuple of integers representing the milliseconds since EPOCH. If
     either end of the range is unspecified, the start and end times default to "1 day ago" and "now",
@@ -466,6 +665,8 @@ def filtertime(search, args, default_from="1 day ago", default_to="now"):
         The object representing the OpenSearch Search query
     args : dict
         The dictionary which should contain 'from' and 'to' times (see gettimes) and 'doctype'
+    granularity_ms : int
+        If nonzero, the start and end times are widened to multiples of this many milliseconds
 
     Returns
     -------
@@ -482,6 +683,9 @@ def filtertime(search, args, default_from="1 day ago", default_to="now"):
     end_time_ms = int(
         end_time.timestamp() * 1000 if end_time is not None else dateparser.parse(default_to).timestamp() * 1000
     )
+    if granularity_ms > 0:
+        start_time_ms = (start_time_ms // granularity_ms) * granularity_ms
+        end_time_ms = -(-end_time_ms // granularity_ms) * granularity_ms
     return (
         start_time_ms,
         end_time_ms,
@@ -551,6 +755,112 @@ def filtervalues(search, args):
     return (filters, s)
 
 
+class AggregationCache(object):
+    """An LRU cache of aggregation query results, keyed on the normalized query (see aggfields).
+
+    Concurrent requests for a key that isn't cached yet are coalesced: the first one runs the query
+    and the others wait for and share its result. Entries expire after ttl seconds.
+    """
+
+    def __init__(self, ttl=60, maxEntries=256, waitSec=60):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.waitSec = waitSec
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.counts = defaultdict(int)
+
+    @staticmethod
+    def key(*args):
+        return hashlib.sha256(json.dumps(args, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _cached(self, key):
+        if (entry := self.entries.get(key)) and (time.monotonic() - entry[0] <= self.ttl):
+            self.entries.move_to_end(key)
+            return entry
+        self.entries.pop(key, None)
+        return None
+
+    def get(self, key, compute):
+        """Returns the cached result for key, calling compute() (once, no matter how many
+        concurrent requests for the same key there are) to get it if it isn't cached
+        """
+        if self.ttl <= 0:
+            return compute()
+
+        with self.lock:
+            if entry := self._cached(key):
+                self.counts['hits'] += 1
+                return entry[1]
+            if leader := ((pending := self.inflight.get(key)) is None):
+                pending = self.inflight[key] = Event()
+                self.counts['misses'] += 1
+            else:
+                self.counts['coalesced'] += 1
+
+        if not leader:
+            pending.wait(self.waitSec)
+            with self.lock:
+                if entry := self._cached(key):
+                    return entry[1]
+            # the leading request failed (or is taking too long), so do it ourselves
+            return compute()
+
+        try:
+            result = compute()
+            with self.lock:
+                self.entries[key] = (time.monotonic(), result)
+                while len(self.entries) > self.maxEntries:
+                    self.entries.popitem(last=False)
+                    self.counts['evictions'] += 1
+            return result
+        except Exception:
+            with self.lock:
+                self.counts['errors'] += 1
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            pending.set()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses'] + self.counts['coalesced']
+            return {
+                'entries': len(self.entries),
+                'hits': self.counts['hits'],
+                'misses': self.counts['misses'],
+                'coalesced': self.counts['coalesced'],
+                'evictions': self.counts['evictions'],
+                'errors': self.counts['errors'],
+                'hit_ratio': round((self.counts['hits'] + self.counts['coalesced']) / lookups, 4) if lookups else 0.0,
+            }
+
+
+aggCache = AggregationCache(
+    ttl=app.config["MALCOLM_API_AGG_CACHE_SEC"],
+    maxEntries=app.config["MALCOLM_API_AGG_CACHE_MAX"],
+)
+
+
+def use_agg_cache_from_args(args):
+    """returns whether an aggregation's result should be shared through aggCache (with its time
+    range widened to multiples of MALCOLM_API_AGG_CACHE_GRANULARITY_SEC)
+
+    Parameters
+    ----------
+    args : dict
+        The dictionary which may contain a 'cache' value (true or false, default true)
+
+    Returns
+    -------
+    use_cache
+        False if aggCache is disabled (MALCOLM_API_AGG_CACHE_SEC is 0) or the request bypasses it
+    """
+    return (aggCache.ttl > 0) and malcolm_utils.str2bool(args.get('cache', True))
+
+
 def aggfields(fieldnames, current_request, urls=None):
     """Returns a bucket aggregation for a particular field over a given time range
 
@@ -572,54 +882,162 @@ def aggfields(fieldnames, current_request, urls=None):
         dict containing the filters, e.g., { "fieldname1": "value", "fieldname2": 1234, "fieldname3": ["abc", "123"] }
     fields
         the name of the field(s) on which the aggregation was performed
+
+    Results are cached in aggCache, with the query's time range widened to multiples of
+    MALCOLM_API_AGG_CACHE_GRANULARITY_SEC so that requests for the same relative time frame
+    (e.g., "1 day ago" to "now") made close together share a result. 'cache' (true or false,
+    default true) in current_request arguments can be used to bypass the cache. If the cache is
+    disabled (MALCOLM_API_AGG_CACHE_SEC is 0) the time range is left as requested.
     """
     args = get_request_arguments(current_request)
     idx = index_from_args(args)
+    use_cache = use_agg_cache_from_args(args)
     s = SearchClass(
         using=databaseClient,
         index=idx,
     ).extra(size=0)
-    start_time_ms, end_time_ms, s = filtertime(s, args)
+    start_time_ms, end_time_ms, s = filtertime(
+        s,
+        args,
+        granularity_ms=(app.config["MALCOLM_API_AGG_CACHE_GRANULARITY_SEC"] * 1000) if use_cache else 0,
+    )
     filters, s = filtervalues(s, args)
     bucket_limit = int(malcolm_utils.deep_get(args, ["limit"], app.config["RESULT_SET_LIMIT"]))
     last_bucket = s.aggs
 
-    for fname in malcolm_utils.get_iterable(fieldnames):
-        # Get the field mapping type for this field, and map it to a good default "missing"
-        #   (empty bucket) label for the bucket missing= parameter below
-        mapping = databaseClient.indices.get_field_mapping(
-            fields=fname,
-            index=idx,
-        )
-        missing_val = (
-            missing_field_map[
-                next(
-                    iter(
-                        malcolm_utils.dictsearch(
-                            mapping[next(iter(OrderedDict(sorted(mapping.items(), reverse=True))))], 'type'
-                        )
-                    ),
-                    None,
-                )
-            ]
-            if (mapping and isinstance(mapping, dict))
-            else missing_field_map[None]
-        )
+    # map each field's mapping type to a good default "missing" (empty bucket) label for the
+    #   bucket missing= parameter below (see FieldTypeCache)
+    missing_vals = fieldTypeCache.missing_values(idx, fieldnames)
 
+    for fname in malcolm_utils.get_iterable(fieldnames):
         # chain on the aggregation for the next field
         last_bucket = last_bucket.bucket(
             fname,
             "terms",
             field=fname,
             size=bucket_limit,
-            missing=missing_val,
+            missing=missing_vals[fname],
         )
 
-    response = s.execute()
-
     top_bucket_name = next(iter(malcolm_utils.get_iterable(fieldnames)))
+    if use_cache:
+        aggregations = aggCache.get(aggCache.key(idx, s.to_dict()), lambda: s.execute().aggregations.to_dict())
+    else:
+        aggregations = s.execute().aggregations.to_dict()
+
+    result_dict = {
+        top_bucket_name: aggregations.get(top_bucket_name, {}),
+        'range': (start_time_ms // 1000, end_time_ms // 1000),
+        'filter': filters,
+        'fields': malcolm_utils.get_iterable(fieldnames),
+    }
+    if (urls is not None) and (len(urls) > 0):
+        result_dict['urls'] = urls
+
+    return jsonify(result_dict)
+
+
+def composite_pages(search, fieldnames, page_size, after=None):
+    """A generator paging through every bucket of a composite aggregation over one or more fields
+
+    Parameters
+    ----------
+    search : opensearchpy.Search
+        The object representing the (filtered) OpenSearch Search query
+    fieldnames : string or Array of string
+        The name of the field(s) making up each bucket's key
+    page_size : int
+        The number of buckets to request per page
+    after : dict
+        The after_key from a previous page at which to start (None to start at the beginning)
+
+    Returns
+    -------
+    buckets, after_key
+        for each page, a list of dicts containing key (a dict of field name -> value, where a
+        missing value is null) and doc_count for each bucket, and the after_key cursor for the
+        next page (None after the last page)
+    """
+    while True:
+        page = search.extra(size=0)
+        page.aggs.bucket(
+            'composite',
+            'composite',
+            sources=[
+                {fname: {'terms': {'field': fname, 'missing_bucket': True}}}
+                for fname in malcolm_utils.get_iterable(fieldnames)
+            ],
+            size=page_size,
+            **({'after': after} if after else {}),
+        )
+        result = page.execute().aggregations.to_dict().get('composite', {})
+        buckets = result.get('buckets', [])
+        after = result.get('after_key') if buckets else None
+        yield buckets, after
+        if not after:
+            break
+
+
+def aggcomposite(fieldnames, current_request, urls=None):
+    """Returns a page of a composite aggregation (every combination of values of the field(s) with
+    its document count, in key order) over a given time range, or streams all of its pages as NDJSON
+
+    Parameters
+    ----------
+    fieldname : string or Array of string
+        The name of the field(s) on which to perform the aggregation
+    current_request : Request
+        The flask Request object being processed (see gettimes/filtertime and getfilters/filtervalues)
+        Uses 'from', 'to', 'limit' (the number of buckets per page), 'filter', 'doctype', 'after'
+        (the after_key returned with the previous page, as a dict or JSON string) and 'stream'
+        (true to stream every bucket from 'after' on, one per line) from current_request arguments
+
+    Returns
+    -------
+    values
+        list of dicts containing key (a dict of field name -> value) and doc_count for each bucket
+    after_key
+        the cursor to pass as 'after' to get the next page, or null if this is the last page
+    range
+        start_time (seconds since EPOCH) and end_time (seconds since EPOCH) of query
+    filter
+        dict containing the filters, e.g., { "fieldname1": "value", "fieldname2": 1234, "fieldname3": ["abc", "123"] }
+    fields
+        the name of the field(s) on which the aggregation was performed
+    """
+    args = get_request_arguments(current_request)
+    if isinstance(after := (args.get('after') or None), str):
+        try:
+            after = json.loads(after)
+        except ValueError:
+            pass
+    if (after is not None) and not isinstance(after, dict):
+        return (
+            jsonify(error="'after' must be a JSON dictionary (the after_key returned with the previous page)"),
+            400,
+        )
+
+    s = SearchClass(
+        using=databaseClient,
+        index=index_from_args(args),
+    )
+    start_time_ms, end_time_ms, s = filtertime(s, args)
+    filters, s = filtervalues(s, args)
+    page_size = int(malcolm_utils.deep_get(args, ["limit"], app.config["RESULT_SET_LIMIT"]))
+
+    if malcolm_utils.str2bool(args.get('stream', False)):
+
+        def generate():
+            for buckets, _ in composite_pages(s, fieldnames, page_size, after=after):
+                if buckets:
+                    yield ''.join(json.dumps(bucket) + '\n' for bucket in buckets).encode()
+
+        return app.response_class(generate(), mimetype='application/x-ndjson')
+
+    buckets, after_key = next(composite_pages(s, fieldnames, page_size, after=after))
     result_dict = {
-        top_bucket_name: response.aggregations.to_dict().get(top_bucket_name, {}),
+        'values': buckets,
+        'after_key': after_key,
         'range': (start_time_ms // 1000, end_time_ms // 1000),
         'filter': filters,
         'fields': malcolm_utils.get_iterable(fieldnames),
@@ -647,7 +1065,7 @@ def aggregate(fieldname):
     fieldname : string
         the name of the field(s) to be bucketed (comma-separated if multiple fields)
     request : Request
-        see aggfields
+        see aggfields, or aggcomposite if 'composite' is true
 
     Returns
     -------
@@ -656,15 +1074,255 @@ def aggregate(fieldname):
     range
         start_time (seconds since EPOCH) and end_time (seconds since EPOCH) of query
     """
-    start_time, end_time = gettimes(get_request_arguments(request))
+    args = get_request_arguments(request)
+    start_time, end_time = gettimes(args)
     fields = fieldname.split(",")
-    return aggfields(
+    return (aggcomposite if malcolm_utils.str2bool(args.get('composite', False)) else aggfields)(
         fields,
         request,
         urls=urls_for_field(fields, start_time=start_time, end_time=end_time),
     )
 
 
+# "nice" date_histogram intervals to choose from when one isn't specified
+histogram_intervals = [
+    ('1s', 1000),
+    ('5s', 5 * 1000),
+    ('10s', 10 * 1000),
+    ('30s', 30 * 1000),
+    ('1m', 60 * 1000),
+    ('5m', 5 * 60 * 1000),
+    ('10m', 10 * 60 * 1000),
+    ('30m', 30 * 60 * 1000),
+    ('1h', 60 * 60 * 1000),
+    ('3h', 3 * 60 * 60 * 1000),
+    ('12h', 12 * 60 * 60 * 1000),
+    ('1d', 24 * 60 * 60 * 1000),
+    ('7d', 7 * 24 * 60 * 60 * 1000),
+    ('30d', 30 * 24 * 60 * 60 * 1000),
+    ('365d', 365 * 24 * 60 * 60 * 1000),
+]
+
+
+@app.route(
+    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/histogram",
+    defaults={'fieldname': None},
+    methods=['GET', 'POST'],
+)
+@app.route(
+    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/histogram/<fieldname>",
+    methods=['GET', 'POST'],
+)
+def histogram(fieldname):
+    """Returns document counts over time (a date_histogram aggregation) for a given time range,
+    optionally split into a series for each of the top values of a field
+
+    Parameters
+    ----------
+    fieldname : string
+        the name of the field by which to split the counts (may also be specified with 'split')
+    request : Request
+        Uses 'from', 'to', 'filter', 'doctype' and 'cache' (see aggfields) from request arguments, as
+        well as 'interval' (a fixed_interval such as "5m"; by default, the smallest of histogram_intervals
+        yielding no more than 'buckets' buckets, default 100), and 'limit' (the maximum number of values
+        of the split field for which to return a series, default 10)
+
+    Returns
+    -------
+    interval
+        the width of each time bucket
+    times
+        array of the start time (seconds since EPOCH) of each time bucket
+    counts
+        array of the total number of documents in each time bucket
+    series
+        if split, a dict where key is a value of the split field and value is an array of the number
+        of documents with that value in each time bucket
+    other
+        if split, an array of the number of documents in each time bucket not in any of the series
+    range
+        start_time (seconds since EPOCH) and end_time (seconds since EPOCH) of query
+    filter
+        dict containing the filters, e.g., { "fieldname1": "value", "fieldname2": 1234, "fieldname3": ["abc", "123"] }
+    split
+        the name of the field by which the counts were split
+    """
+    args = get_request_arguments(request)
+    idx = index_from_args(args)
+    use_cache = use_agg_cache_from_args(args)
+    split = fieldname or args.get('split')
+    s = SearchClass(
+        using=databaseClient,
+        index=idx,
+    ).extra(size=0)
+    start_time_ms, end_time_ms, s = filtertime(
+        s,
+        args,
+        granularity_ms=(app.config["MALCOLM_API_AGG_CACHE_GRANULARITY_SEC"] * 1000) if use_cache else 0,
+    )
+    filters, s = filtervalues(s, args)
+
+    if not (interval := args.get('interval')):
+        target_buckets = max(int(malcolm_utils.deep_get(args, ["buckets"], 100)), 1)
+        interval = next(
+            (name for name, ms in histogram_intervals if (end_time_ms - start_time_ms) / ms <= target_buckets),
+            histogram_intervals[-1][0],
+        )
+    date_histogram = AggregationClass(
+        'date_histogram',
+        field=timefield_from_args(args),
+        fixed_interval=interval,
+        min_doc_count=0,
+        extended_bounds={'min': start_time_ms, 'max': end_time_ms},
+    )
+    s.aggs.bucket('histogram', date_histogram)
+    if split:
+        s.aggs.bucket(
+            'split',
+            'terms',
+            field=split,
+            size=int(malcolm_utils.deep_get(args, ["limit"], 10)),
+            missing=fieldTypeCache.missing_values(idx, split)[split],
+        ).bucket('histogram', date_histogram)
+
+    if use_cache:
+        aggregations = aggCache.get(aggCache.key(idx, s.to_dict()), lambda: s.execute().aggregations.to_dict())
+    else:
+        aggregations = s.execute().aggregations.to_dict()
+
+    # reshape the buckets into columns: one array of times, and arrays of counts aligned with it
+    times = [bucket['key'] for bucket in malcolm_utils.deep_get(aggregations, ['histogram', 'buckets'], [])]
+    result_dict = {
+        'interval': interval,
+        'times': [t // 1000 for t in times],
+        'counts': [
+            bucket['doc_count'] for bucket in malcolm_utils.deep_get(aggregations, ['histogram', 'buckets'], [])
+        ],
+        'range': (start_time_ms // 1000, end_time_ms // 1000),
+        'filter': filters,
+    }
+    if split:
+        series = {}
+        for term in malcolm_utils.deep_get(aggregations, ['split', 'buckets'], []):
+            counts = {
+                bucket['key']: bucket['doc_count']
+                for bucket in malcolm_utils.deep_get(term, ['histogram', 'buckets'], [])
+            }
+            series[str(term.get('key_as_string', term['key']))] = [counts.get(t, 0) for t in times]
+        result_dict['series'] = series
+        result_dict['other'] = [
+            total - sum(values[i] for values in series.values()) for i, total in enumerate(result_dict['counts'])
+        ]
+        result_dict['split'] = split
+
+    return jsonify(result_dict)
+
+
+@app.route(
+    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/cache-stats",
+    methods=['GET'],
+)
+def cache_stats():
+    """Provide hit and miss counters for the API's query result cache
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    agg
+        a dict containing the number of cached aggregation results ('entries'), requests answered from
+        the cache ('hits'), requests that ran a query ('misses'), requests that waited on an identical
+        in-flight query ('coalesced'), results evicted to make room ('evictions'), queries that
+        failed ('errors') and the fraction of requests that didn't need their own query ('hit_ratio')
+    """
+    return jsonify(agg=aggCache.stats())
+
+
+def sourcefields(search, args):
+    """Applies _source field projection (extracted from the 'include' and 'exclude' request arguments,
+    either lists or comma-separated strings of field names or wildcard patterns) to an OpenSearch query
+
+    Parameters
+    ----------
+    search : opensearchpy.Search
+        The object representing the OpenSearch Search query
+    args : dict
+        The dictionary which may contain 'include' and/or 'exclude'
+
+    Returns
+    -------
+    search.source(...)
+        search object returning only the requested fields
+    """
+    projection = {}
+    for arg, key in (('include', 'includes'), ('exclude', 'excludes')):
+        if value := args.get(arg):
+            if fieldnames := [
+                x.strip() for x in (value.split(',') if isinstance(value, str) else value) if str(x).strip()
+            ]:
+                projection[key] = fieldnames
+    return search.source(**projection) if (search and projection) else search
+
+
+def export_documents(search, index, limit=0, compress=False):
+    """A generator yielding the documents matching a query as NDJSON (one hit per line), paging through
+    them with the scroll API so that memory use doesn't depend on the size of the result set
+
+    Parameters
+    ----------
+    search : opensearchpy.Search
+        The object representing the OpenSearch Search query
+    index : string
+        the index pattern to search
+    limit : int
+        the maximum number of documents to return (0 for no limit)
+    compress : bool
+        if True, the output is gzip-compressed
+
+    Returns
+    -------
+    chunks
+        bytes of NDJSON, flushed after about MALCOLM_API_EXPORT_CHUNK_BYTES bytes of documents
+    """
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+    hits = DatabaseScan(
+        databaseClient,
+        query=search.to_dict(),
+        index=index,
+        size=(
+            min(app.config["MALCOLM_API_EXPORT_BATCH_SIZE"], limit)
+            if limit
+            else app.config["MALCOLM_API_EXPORT_BATCH_SIZE"]
+        ),
+        scroll=app.config["MALCOLM_API_EXPORT_SCROLL"],
+    )
+    try:
+        chunk = []
+        chunkLen = 0
+        for count, hit in enumerate(hits, start=1):
+            line = (json.dumps(hit) + '\n').encode()
+            chunk.append(line)
+            chunkLen += len(line)
+            if chunkLen >= app.config["MALCOLM_API_EXPORT_CHUNK_BYTES"]:
+                data = b''.join(chunk)
+                chunk, chunkLen = [], 0
+                if compressor:
+                    data = compressor.compress(data)
+                if data:
+                    yield data
+            if limit and (count >= limit):
+                break
+        data = b''.join(chunk)
+        if compressor:
+            data = compressor.compress(data) + compressor.flush()
+        if data:
+            yield data
+    finally:
+        # closing the scan generator clears the scroll context, including when the client disconnects
+        hits.close()
+
+
 @app.route(
     f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/document",
     methods=['GET', 'POST'],
@@ -675,7 +1333,10 @@ def document():
     Parameters
     ----------
     request : Request
-        Uses 'from', 'to', 'limit', 'filter', and 'doctype' from request arguments
+        Uses 'from', 'to', 'limit', 'filter', 'include', 'exclude', 'doctype', 'export' and 'gzip' from
+        request arguments. If 'export' is true, all matching documents (or up to 'limit', if specified)
+        are streamed as NDJSON rather than returned in a JSON response, and 'gzip' (true or false)
+        indicates whether the stream is gzip-compressed.
 
     Returns
     -------
@@ -685,12 +1346,31 @@ def document():
         array of the documents retrieved (up to 'limit')
     """
     args = get_request_arguments(request)
+    idx = index_from_args(args)
     s = SearchClass(
         using=databaseClient,
-        index=index_from_args(args),
-    ).extra(size=int(malcolm_utils.deep_get(args, ["limit"], app.config["RESULT_SET_LIMIT"])))
+        index=idx,
+    )
     start_time_ms, end_time_ms, s = filtertime(s, args, default_from="1970-1-1", default_to="now")
     filters, s = filtervalues(s, args)
+    s = sourcefields(s, args)
+
+    if malcolm_utils.str2bool(args.get('export', False)):
+        compress = malcolm_utils.str2bool(args.get('gzip', False))
+        response = app.response_class(
+            export_documents(
+                s,
+                idx,
+                limit=int(malcolm_utils.deep_get(args, ["limit"], 0)),
+                compress=compress,
+            ),
+            mimetype='application/x-ndjson',
+        )
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    s = s.extra(size=int(malcolm_utils.deep_get(args, ["limit"], app.config["RESULT_SET_LIMIT"])))
     return jsonify(
         results=s.execute().to_dict().get('hits', {}).get('hits', []),
         range=(start_time_ms // 1000, end_time_ms // 1000),
@@ -721,7 +1401,7 @@ def indices():
         their respective index pattern names
     """
     result = {}
-    result["indices"] = requests.get(
+    result["indices"] = upstreamSession.get(
         f'{opensearchUrl}/_cat/indices?format=json',
         auth=opensearchReqHttpAuth,
         verify=opensearchSslVerify,
@@ -733,134 +1413,375 @@ def indices():
     return jsonify(result)
 
 
-@app.route(
-    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/fields",
-    methods=['GET', 'POST'],
-)
-def fields():
-    """Provide a list of fields Malcolm "knows about" merged from Arkime's field table, Malcolm's
-    OpenSearch template for the sessions indices, and Kibana's field list
-
-    Parameters
-    ----------
-    request : Request
-        template - template name (default is app.config["MALCOLM_TEMPLATE"])
-        doctype - network|host
-    Returns
-    -------
-    fields
-        A dict of dicts where key is the field name and value may contain 'description' and 'type'
-    """
-    args = get_request_arguments(request)
-
-    templateName = malcolm_utils.deep_get(args, ["template"], app.config["MALCOLM_TEMPLATE"])
-    arkimeFields = (templateName == app.config["MALCOLM_TEMPLATE"]) and (doctype_from_args(args) == 'network')
+def arkime_fields_source(index):
+    """Returns the field definitions from Arkime's fields table"""
+    s = SearchClass(
+        using=databaseClient,
+        index=index,
+    ).extra(size=6000)
+    return [x['_source'] for x in s.execute().to_dict().get('hits', {}).get('hits', [])]
 
-    fields = defaultdict(dict)
 
-    if arkimeFields:
-        try:
-            # get fields from Arkime's fields table
-            s = SearchClass(
-                using=databaseClient,
-                index=index_from_args(args),
-            ).extra(size=6000)
-            for hit in [x['_source'] for x in s.execute().to_dict().get('hits', {}).get('hits', [])]:
-                if (fieldname := malcolm_utils.deep_get(hit, ['dbField2'])) and (fieldname not in fields):
+def template_fields_source(templateName):
+    """Returns an OpenSearch index template and its component templates, the latter fetched concurrently"""
+    templates = (
+        malcolm_utils.deep_get(
+            upstreamSession.get(
+                f'{opensearchUrl}/_index_template/{templateName}',
+                auth=opensearchReqHttpAuth,
+                verify=opensearchSslVerify,
+            ).json(),
+            ["index_templates"],
+        )
+        or []
+    )
+    componentNames = list(
+        OrderedDict.fromkeys(
+            componentName
+            for template in templates
+            for componentName in malcolm_utils.get_iterable(
+                malcolm_utils.deep_get(template, ["index_template", "composed_of"], [])
+            )
+        )
+    )
+    components = {}
+    if componentNames:
+        with ThreadPoolExecutor(max_workers=min(len(componentNames), 8)) as executor:
+            for componentName, componentResponseJson in zip(
+                componentNames,
+                executor.map(
+                    lambda x: upstreamSession.get(
+                        f'{opensearchUrl}/_component_template/{x}',
+                        auth=opensearchReqHttpAuth,
+                        verify=opensearchSslVerify,
+                    ).json(),
+                    componentNames,
+                ),
+            ):
+                components[componentName] = list(
+                    malcolm_utils.get_iterable(
+                        malcolm_utils.deep_get(componentResponseJson, ["component_templates"], [])
+                    )
+                )
+    return {'templates': templates, 'components': components}
+
+
+def dashboards_fields_source(index):
+    """Returns the fields of an OpenSearch Dashboards index pattern"""
+    return (
+        upstreamSession.get(
+            f"{dashboardsUrl}/api/index_patterns/_fields_for_wildcard",
+            params={
+                'pattern': index,
+                'meta_fields': ["_source", "_id", "_type", "_index", "_score"],
+            },
+            auth=opensearchReqHttpAuth,
+            verify=opensearchSslVerify,
+        )
+        .json()
+        .get('fields', [])
+    )
+
+
+def merge_fields(templateName, arkime, templates, dashboards):
+    """Merges the field sources (see arkime_fields_source, template_fields_source and
+    dashboards_fields_source) into the field list returned by /fields, where later sources
+    override the types of earlier ones
+    """
+    fields = defaultdict(dict)
+
+    # fields from Arkime's fields table
+    for hit in arkime:
+        if (fieldname := malcolm_utils.deep_get(hit, ['dbField2'])) and (fieldname not in fields):
+            if debugApi:
+                hit['source'] = 'arkime'
+            fields[fieldname] = {
+                'description': malcolm_utils.deep_get(hit, ['help']),
+                'type': field_type_map[malcolm_utils.deep_get(hit, ['type'])],
+            }
+            if debugApi:
+                fields[fieldname]['original'] = [hit]
+
+    # fields from OpenSearch template (and descendant components)
+    for template in templates['templates']:
+        # top-level fields
+        for fieldname, fieldinfo in malcolm_utils.deep_get(
+            template,
+            ["index_template", "template", "mappings", "properties"],
+            {},
+        ).items():
+            if debugApi:
+                fieldinfo['source'] = f'opensearch.{templateName}'
+            if 'type' in fieldinfo:
+                fields[fieldname]['type'] = field_type_map[malcolm_utils.deep_get(fieldinfo, ['type'])]
+            if debugApi:
+                fields[fieldname]['original'] = fields[fieldname].get('original', []) + [fieldinfo]
+
+        # descendant component fields
+        for componentName in malcolm_utils.get_iterable(
+            malcolm_utils.deep_get(template, ["index_template", "composed_of"], [])
+        ):
+            for component in templates['components'].get(componentName, []):
+                for fieldname, fieldinfo in malcolm_utils.deep_get(
+                    component,
+                    ["component_template", "template", "mappings", "properties"],
+                    {},
+                ).items():
                     if debugApi:
-                        hit['source'] = 'arkime'
-                    fields[fieldname] = {
-                        'description': malcolm_utils.deep_get(hit, ['help']),
-                        'type': field_type_map[malcolm_utils.deep_get(hit, ['type'])],
-                    }
+                        fieldinfo['source'] = f'opensearch.{templateName}.{componentName}'
+                    if 'type' in fieldinfo:
+                        fields[fieldname]['type'] = field_type_map[malcolm_utils.deep_get(fieldinfo, ['type'])]
                     if debugApi:
-                        fields[fieldname]['original'] = [hit]
-        except Exception as e:
+                        fields[fieldname]['original'] = fields[fieldname].get('original', []) + [fieldinfo]
+
+    # fields from OpenSearch dashboards
+    for field in dashboards:
+        if fieldname := malcolm_utils.deep_get(field, ['name']):
+            if debugApi:
+                field['source'] = 'dashboards'
+            field_types = malcolm_utils.deep_get(field, ['esTypes'], [])
+            fields[fieldname]['type'] = field_type_map[
+                field_types[0] if len(field_types) > 0 else malcolm_utils.deep_get(fields[fieldname], ['type'])
+            ]
             if debugApi:
-                print(f"{type(e).__name__}: {str(e)} getting Arkime fields")
+                fields[fieldname]['original'] = fields[fieldname].get('original', []) + [field]
 
-    # get fields from OpenSearch template (and descendant components)
-    try:
-        getTemplateResponseJson = requests.get(
-            f'{opensearchUrl}/_index_template/{templateName}',
-            auth=opensearchReqHttpAuth,
-            verify=opensearchSslVerify,
-        ).json()
-
-        for template in malcolm_utils.deep_get(getTemplateResponseJson, ["index_templates"]):
-            # top-level fields
-            for fieldname, fieldinfo in malcolm_utils.deep_get(
-                template,
-                ["index_template", "template", "mappings", "properties"],
-                {},
-            ).items():
+    for fieldname in ("@version", "_source", "_id", "_type", "_index", "_score", "type"):
+        fields.pop(fieldname, None)
+
+    return fields
+
+
+class FieldCatalog(object):
+    """A background-refreshed cache of the merged /fields result, keyed by template name and doctype.
+
+    The field sources are fetched concurrently. An entry is only re-merged (and its ETag changed) when
+    the digest of its sources changes; a source that fails to fetch keeps its previously fetched value.
+    Entries not requested for idleRefreshes refresh intervals are dropped.
+    """
+
+    def __init__(self, refreshSec=300, idleRefreshes=12):
+        self.refreshSec = refreshSec
+        self.idleRefreshes = idleRefreshes
+        self.lock = Lock()
+        self.entries = {}
+
+    def _build(self, templateName, doctype, previous=None):
+        args = {'doctype': doctype, 'template': templateName}
+        index = index_from_args(args)
+        arkimeFields = (templateName == app.config["MALCOLM_TEMPLATE"]) and (doctype == 'network')
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = {
+                'arkime': executor.submit(arkime_fields_source, index) if arkimeFields else None,
+                'templates': executor.submit(template_fields_source, templateName),
+                'dashboards': executor.submit(dashboards_fields_source, index),
+            }
+            sources = {}
+            fetched = 0
+            for sourceName, future in futures.items():
+                try:
+                    sources[sourceName] = future.result() if future else []
+                    fetched += 1 if future else 0
+                except Exception as e:
+                    sources[sourceName] = (
+                        previous['sources'][sourceName]
+                        if previous
+                        else ({'templates': [], 'components': {}} if (sourceName == 'templates') else [])
+                    )
+                    if debugApi:
+                        print(f"{type(e).__name__}: {str(e)} getting {sourceName} fields for {templateName}/{doctype}")
+
+        nowTime = time.time()
+        digest = hashlib.sha256(json.dumps(sources, sort_keys=True, default=str).encode()).hexdigest()
+        if previous and (previous['etag'] == digest):
+            previous['refreshed'] = nowTime
+            previous['fetched'] = fetched
+            return previous
+
+        if debugApi:
+            print(f"field catalog for {templateName}/{doctype} recomputed ({digest})")
+        return {
+            'sources': sources,
+            'fields': merge_fields(templateName, **sources),
+            'etag': digest,
+            'fetched': fetched,
+            'refreshed': nowTime,
+            'requested': previous['requested'] if previous else nowTime,
+        }
+
+    def get(self, templateName, doctype):
+        """Returns the catalog entry (containing 'fields' and 'etag') for a template name and doctype,
+        building it first if it isn't cached or if its last fetch failed entirely
+        """
+        key = (templateName, doctype)
+        with self.lock:
+            entry = self.entries.get(key)
+        if (entry is None) or (entry['fetched'] == 0):
+            entry = self._build(templateName, doctype, previous=entry)
+            with self.lock:
+                self.entries[key] = entry
+        entry['requested'] = time.time()
+        return entry
+
+    def refresh(self):
+        with self.lock:
+            idleTime = time.time() - (self.refreshSec * self.idleRefreshes)
+            for key in [k for k, v in self.entries.items() if v['requested'] < idleTime]:
+                self.entries.pop(key, None)
+            entries = list(self.entries.items())
+        for key, entry in entries:
+            try:
+                updated = self._build(*key, previous=entry)
+                with self.lock:
+                    if key in self.entries:
+                        self.entries[key] = updated
+            except Exception as e:
                 if debugApi:
-                    fieldinfo['source'] = f'opensearch.{templateName}'
-                if 'type' in fieldinfo:
-                    fields[fieldname]['type'] = field_type_map[malcolm_utils.deep_get(fieldinfo, ['type'])]
+                    print(f"{type(e).__name__}: {str(e)} refreshing field catalog for {key}")
+
+    def run(self, warmKeys=()):
+        for key in warmKeys:
+            try:
+                self.get(*key)
+            except Exception as e:
                 if debugApi:
-                    fields[fieldname]['original'] = fields[fieldname].get('original', []) + [fieldinfo]
+                    print(f"{type(e).__name__}: {str(e)} warming field catalog for {key}")
+        while True:
+            time.sleep(self.refreshSec)
+            self.refresh()
 
-            # descendant component fields
-            for componentName in malcolm_utils.get_iterable(
-                malcolm_utils.deep_get(template, ["index_template", "composed_of"])
-            ):
-                getComponentResponseJson = requests.get(
-                    f'{opensearchUrl}/_component_template/{componentName}',
-                    auth=opensearchReqHttpAuth,
-                    verify=opensearchSslVerify,
-                ).json()
-                for component in malcolm_utils.get_iterable(
-                    malcolm_utils.deep_get(getComponentResponseJson, ["component_templates"])
-                ):
-                    for fieldname, fieldinfo in malcolm_utils.deep_get(
-                        component,
-                        ["component_template", "template", "mappings", "properties"],
-                        {},
-                    ).items():
-                        if debugApi:
-                            fieldinfo['source'] = f'opensearch.{templateName}.{componentName}'
-                        if 'type' in fieldinfo:
-                            fields[fieldname]['type'] = field_type_map[malcolm_utils.deep_get(fieldinfo, ['type'])]
-                        if debugApi:
-                            fields[fieldname]['original'] = fields[fieldname].get('original', []) + [fieldinfo]
 
+fieldCatalog = FieldCatalog(refreshSec=app.config["MALCOLM_API_FIELDS_REFRESH_SEC"])
+Thread(
+    target=fieldCatalog.run,
+    args=([(app.config["MALCOLM_TEMPLATE"], doctype_from_args({}))],),
+    daemon=True,
+).start()
+
+
+@app.route(
+    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/fields",
+    methods=['GET', 'POST'],
+)
+def fields():
+    """Provide a list of fields Malcolm "knows about" merged from Arkime's field table, Malcolm's
+    OpenSearch template for the sessions indices, and Kibana's field list
+
+    Parameters
+    ----------
+    request : Request
+        template - template name (default is app.config["MALCOLM_TEMPLATE"])
+        doctype - network|host
+    Returns
+    -------
+    fields
+        A dict of dicts where key is the field name and value may contain 'description' and 'type'
+
+    The response carries an ETag that only changes when the underlying field sources do, so
+    requests with a matching If-None-Match header get an empty 304 Not Modified response.
+    """
+    args = get_request_arguments(request)
+
+    entry = fieldCatalog.get(
+        malcolm_utils.deep_get(args, ["template"], app.config["MALCOLM_TEMPLATE"]),
+        doctype_from_args(args),
+    )
+    if request.if_none_match.contains_weak(entry['etag']):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(fields=entry['fields'], total=len(entry['fields']))
+    response.set_etag(entry['etag'])
+    return response
+
+
+class ShortLivedResult(object):
+    """Memoizes the result of a function for ttl seconds. Concurrent callers of get() while the
+    result is being (re)computed wait for and share that single call.
+    """
+
+    def __init__(self, func, ttl):
+        self.func = func
+        self.ttl = ttl
+        self.lock = Lock()
+        self.result = None
+        self.time = 0.0
+
+    def get(self):
+        with self.lock:
+            if (self.result is None) or (time.monotonic() - self.time > self.ttl):
+                self.result = self.func()
+                self.time = time.monotonic()
+            return self.result
+
+
+probeTimeout = app.config["MALCOLM_API_READY_TIMEOUT_SEC"]
+probeExecutor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='probe')
+
+
+def timed_probe(name, probe):
+    startTime = time.monotonic()
+    try:
+        result = probe()
     except Exception as e:
+        result = None
         if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting OpenSearch index template fields")
+            print(f"{type(e).__name__}: {str(e)} getting {name} status")
+    return result, time.monotonic() - startTime
 
-    # get fields from OpenSearch dashboards
-    try:
-        for field in (
-            requests.get(
-                f"{dashboardsUrl}/api/index_patterns/_fields_for_wildcard",
-                params={
-                    'pattern': index_from_args(args),
-                    'meta_fields': ["_source", "_id", "_type", "_index", "_score"],
-                },
+
+def run_probes(probes, timeout=probeTimeout):
+    """Runs status probes concurrently
+
+    Parameters
+    ----------
+    probes : dict
+        a dict where key is the component name and value is a function returning its status
+    timeout : float
+        the number of seconds to wait for the probes to finish (the probes' own network
+        operations use the same timeout, this is the deadline for the whole set)
+
+    Returns
+    -------
+    results
+        a dict where key is the component name and value is the probe's result (None if it
+        raised an exception or didn't finish before the deadline)
+    latencies
+        a dict where key is the component name and value is the probe's duration in
+        milliseconds (None if it didn't finish before the deadline)
+    """
+    futures = {name: probeExecutor.submit(timed_probe, name, probe) for name, probe in probes.items()}
+    wait(futures.values(), timeout=timeout)
+    results = {}
+    latencies = {}
+    for name, future in futures.items():
+        if future.done():
+            results[name], duration = future.result()
+            latencies[name] = round(duration * 1000)
+        else:
+            results[name], latencies[name] = None, None
+            if debugApi:
+                print(f"Timed out after {timeout} seconds getting {name} status")
+    return results, latencies
+
+
+def opensearch_stats():
+    results, _ = run_probes(
+        {
+            'opensearch': lambda: probeSession.get(
+                opensearchUrl,
                 auth=opensearchReqHttpAuth,
                 verify=opensearchSslVerify,
-            )
-            .json()
-            .get('fields', [])
-        ):
-            if fieldname := malcolm_utils.deep_get(field, ['name']):
-                if debugApi:
-                    field['source'] = 'dashboards'
-                field_types = malcolm_utils.deep_get(field, ['esTypes'], [])
-                fields[fieldname]['type'] = field_type_map[
-                    field_types[0] if len(field_types) > 0 else malcolm_utils.deep_get(fields[fieldname], ['type'])
-                ]
-                if debugApi:
-                    fields[fieldname]['original'] = fields[fieldname].get('original', []) + [field]
-    except Exception as e:
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting OpenSearch Dashboards index pattern fields")
+            ).json(),
+            'health': lambda: dict(databaseClient.cluster.health(request_timeout=probeTimeout)),
+        }
+    )
+    opensearchStats = results['opensearch']
+    if isinstance(opensearchStats, dict):
+        opensearchStats['health'] = results['health']
+    return opensearchStats
 
-    for fieldname in ("@version", "_source", "_id", "_type", "_index", "_score", "type"):
-        fields.pop(fieldname, None)
 
-    return jsonify(fields=fields, total=len(fields))
+opensearchStatsCache = ShortLivedResult(opensearch_stats, app.config["MALCOLM_API_READY_CACHE_SEC"])
 
 
 @app.route(f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/", methods=['GET'])
@@ -890,14 +1811,6 @@ def version():
     opensearch_health
         a JSON structure containing OpenSearch cluster health
     """
-    opensearchStats = requests.get(
-        opensearchUrl,
-        auth=opensearchReqHttpAuth,
-        verify=opensearchSslVerify,
-    ).json()
-    if isinstance(opensearchStats, dict):
-        opensearchStats['health'] = dict(databaseClient.cluster.health())
-
     return jsonify(
         version=app.config["MALCOLM_VERSION"],
         built=app.config["BUILD_DATE"],
@@ -905,16 +1818,107 @@ def version():
         mode=malcolm_utils.DatabaseModeEnumToStr(databaseMode),
         machine=platform.machine(),
         boot_time=datetime.fromtimestamp(psutil.boot_time(), tz=timezone.utc).isoformat().replace('+00:00', 'Z'),
-        opensearch=opensearchStats,
+        opensearch=opensearchStatsCache.get(),
+    )
+
+
+def probe_arkime():
+    probeSession.get(
+        arkimeStatusUrl,
+        verify=False,
+    ).raise_for_status()
+    return True
+
+
+def probe_dashboards():
+    return (
+        malcolm_utils.deep_get(
+            probeSession.get(
+                f'{dashboardsUrl}/api/status',
+                auth=opensearchReqHttpAuth,
+                verify=opensearchSslVerify,
+            ).json(),
+            [
+                "status",
+                "overall",
+                "level" if databaseMode == malcolm_utils.DatabaseMode.ElasticsearchRemote else "state",
+            ],
+            "red",
+        )
+        != "red"
+    )
+
+
+def probe_freq():
+    probeSession.get(freqUrl).raise_for_status()
+    return True
+
+
+def probe_logstash_pipelines():
+    logstashHealth = probeSession.get(f'{logstashUrl}/_health_report').json()
+    return (malcolm_utils.deep_get(logstashHealth, ["status"], "red") != "red") and (
+        malcolm_utils.deep_get(logstashHealth, ["indicators", "pipelines", "status"], "red") != "red"
+    )
+
+
+def probe_netbox():
+    netboxStatus = probeSession.get(
+        f'{netboxUrl}/api/status/?format=json',
+        headers={"Authorization": f"Token {netboxToken}"} if netboxToken else None,
+        verify=False,
+    ).json()
+    return bool(isinstance(netboxStatus, dict) and netboxStatus.get('netbox-version'))
+
+
+def probe_opensearch():
+    return (
+        malcolm_utils.deep_get(dict(databaseClient.cluster.health(request_timeout=probeTimeout)), ["status"], 'red')
+        != "red"
     )
 
 
+readyProbes = {
+    'arkime': probe_arkime,
+    'dashboards': probe_dashboards,
+    'dashboards_maps': lambda: malcolm_utils.check_socket(
+        dashboardsHelperHost, dashboardsMapsPort, timeout=probeTimeout
+    ),
+    'filebeat_tcp': lambda: malcolm_utils.check_socket(filebeatHost, filebeatTcpJsonPort, timeout=probeTimeout),
+    'freq': probe_freq,
+    'logstash_lumberjack': lambda: malcolm_utils.check_socket(logstashHost, logstashLJPort, timeout=probeTimeout),
+    'logstash_pipelines': probe_logstash_pipelines,
+    'netbox': probe_netbox,
+    'opensearch': probe_opensearch,
+    'pcap_monitor': lambda: malcolm_utils.check_socket(pcapMonitorHost, pcapTopicPort, timeout=probeTimeout),
+    'zeek_extracted_file_logger': lambda: malcolm_utils.check_socket(
+        zeekExtractedFileLoggerHost, zeekExtractedFileLoggerTopicPort, timeout=probeTimeout
+    ),
+    'zeek_extracted_file_monitor': lambda: malcolm_utils.check_socket(
+        zeekExtractedFileMonitorHost, zeekExtractedFileTopicPort, timeout=probeTimeout
+    ),
+}
+
+
+def ready_status():
+    results, latencies = run_probes(readyProbes)
+    status = {name: bool(result) for name, result in results.items()}
+    status['latency_ms'] = latencies
+    return status
+
+
+readyStatusCache = ShortLivedResult(ready_status, app.config["MALCOLM_API_READY_CACHE_SEC"])
+
+
 @app.route(
     f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/ready", methods=['GET']
 )
 def ready():
     """Return ready status (true or false) for various Malcolm components
 
+    The components are probed concurrently, each with a deadline of MALCOLM_API_READY_TIMEOUT_SEC
+    seconds (a component that misses it is not ready), and the result is reused for
+    MALCOLM_API_READY_CACHE_SEC seconds.
+
     Parameters
     ----------
 
@@ -944,136 +1948,11 @@ def ready():
         true or false, the ready status of the Zeek extracted file results logging process
     zeek_extracted_file_monitor
         true or false, the ready status of the Zeek extracted file monitoring process
+    latency_ms
+        a dict where key is the component name and value is how long its probe took in
+        milliseconds (null if it timed out)
     """
-    try:
-        arkimeResponse = requests.get(
-            arkimeStatusUrl,
-            verify=False,
-        )
-        arkimeResponse.raise_for_status()
-        arkimeStatus = True
-    except Exception as e:
-        arkimeStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Arkime status")
-
-    try:
-        dashboardsStatus = requests.get(
-            f'{dashboardsUrl}/api/status',
-            auth=opensearchReqHttpAuth,
-            verify=opensearchSslVerify,
-        ).json()
-    except Exception as e:
-        dashboardsStatus = {}
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Dashboards status")
-
-    try:
-        dashboardsMapsStatus = malcolm_utils.check_socket(dashboardsHelperHost, dashboardsMapsPort)
-    except Exception as e:
-        dashboardsMapsStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Logstash offline map server")
-
-    try:
-        filebeatTcpJsonStatus = malcolm_utils.check_socket(filebeatHost, filebeatTcpJsonPort)
-    except Exception as e:
-        filebeatTcpJsonStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting filebeat TCP JSON listener status")
-
-    try:
-        freqResponse = requests.get(freqUrl)
-        freqResponse.raise_for_status()
-        freqStatus = True
-    except Exception as e:
-        freqStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting freq status")
-
-    try:
-        logstashHealth = requests.get(f'{logstashUrl}/_health_report').json()
-    except Exception as e:
-        logstashHealth = {}
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Logstash node status")
-
-    try:
-        logstashLJStatus = malcolm_utils.check_socket(logstashHost, logstashLJPort)
-    except Exception as e:
-        logstashLJStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Logstash lumberjack listener status")
-
-    try:
-        netboxStatus = requests.get(
-            f'{netboxUrl}/api/status/?format=json',
-            headers={"Authorization": f"Token {netboxToken}"} if netboxToken else None,
-            verify=False,
-        ).json()
-    except Exception as e:
-        netboxStatus = {}
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting NetBox status")
-
-    try:
-        openSearchHealth = dict(databaseClient.cluster.health())
-    except Exception as e:
-        openSearchHealth = {}
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting OpenSearch health")
-
-    try:
-        pcapMonitorStatus = malcolm_utils.check_socket(pcapMonitorHost, pcapTopicPort)
-    except Exception as e:
-        pcapMonitorStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting PCAP monitor topic status")
-
-    try:
-        zeekExtractedFileMonitorStatus = malcolm_utils.check_socket(
-            zeekExtractedFileMonitorHost, zeekExtractedFileTopicPort
-        )
-    except Exception as e:
-        zeekExtractedFileMonitorStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Zeek extracted file monitor topic status")
-
-    try:
-        zeekExtractedFileLoggerStatus = malcolm_utils.check_socket(
-            zeekExtractedFileLoggerHost, zeekExtractedFileLoggerTopicPort
-        )
-    except Exception as e:
-        zeekExtractedFileLoggerStatus = False
-        if debugApi:
-            print(f"{type(e).__name__}: {str(e)} getting Zeek extracted file logger topic status")
-
-    return jsonify(
-        arkime=arkimeStatus,
-        dashboards=(
-            malcolm_utils.deep_get(
-                dashboardsStatus,
-                [
-                    "status",
-                    "overall",
-                    "level" if databaseMode == malcolm_utils.DatabaseMode.ElasticsearchRemote else "state",
-                ],
-                "red",
-            )
-            != "red"
-        ),
-        dashboards_maps=dashboardsMapsStatus,
-        filebeat_tcp=filebeatTcpJsonStatus,
-        freq=freqStatus,
-        logstash_lumberjack=logstashLJStatus,
-        logstash_pipelines=(malcolm_utils.deep_get(logstashHealth, ["status"], "red") != "red")
-        and (malcolm_utils.deep_get(logstashHealth, ["indicators", "pipelines", "status"], "red") != "red"),
-        netbox=bool(isinstance(netboxStatus, dict) and netboxStatus.get('netbox-version')),
-        opensearch=(malcolm_utils.deep_get(openSearchHealth, ["status"], 'red') != "red"),
-        pcap_monitor=pcapMonitorStatus,
-        zeek_extracted_file_logger=zeekExtractedFileLoggerStatus,
-        zeek_extracted_file_monitor=zeekExtractedFileMonitorStatus,
-    )
+    return jsonify(readyStatusCache.get())
 
 
 @app.route(
@@ -1103,7 +1982,7 @@ def dashboard_export(dashid):
     args = get_request_arguments(request)
     try:
         # call the API to get the dashboard JSON
-        response = requests.get(
+        response = upstreamSession.get(
             f"{dashboardsUrl}/api/{'kibana' if (databaseMode == malcolm_utils.DatabaseMode.ElasticsearchRemote) else 'opensearch-dashboards'}/dashboards/export",
             params={
                 'dashboard': dashid,
@@ -1166,6 +2045,199 @@ def dashboard_export(dashid):
         return jsonify(error=errStr)
 
 
+def ingest_search(doctype, ingested_after_ms=None, counted_through_ms=None):
+    """Returns a search for the maximum event.ingested value (and document count) of each data
+    source (host.name) for a document type, optionally limited to documents ingested after a time
+
+    Parameters
+    ----------
+    doctype : string
+        network|host
+    ingested_after_ms : int
+        if specified, only documents with an event.ingested value after this time (in milliseconds
+        since the epoch) are considered
+    counted_through_ms : int
+        if specified, each data source's documents with an event.ingested value up to (and including)
+        this time (in milliseconds since the epoch) are also counted separately
+
+    Returns
+    -------
+    search
+        a search object which, when executed, returns the 'host_names' terms aggregation with its
+        'max_event_ingested' metric (and, if counted_through_ms was specified, its 'counted' filter)
+    """
+    s = (
+        SearchClass(
+            using=databaseClient,
+            index=index_from_args({'doctype': doctype}),
+        ).extra(size=0)
+        # Exclusions:
+        #   NGINX access and error logs: we want to exclude nginx error and
+        #       access logs, otherwise the very act of accessing Malcolm will
+        #       update the latest ingest time returned from this function.
+        #   event() webhook: we want to exclude alerts written by the event()
+        #       webhook API (see below) and limit our results to actual
+        #       network logs ingested via PCAP, etc.
+        .query(
+            QueryClass(
+                'bool',
+                must_not=[
+                    QueryClass(
+                        'term',
+                        **{'event.module': ('nginx' if doctype_is_host_logs(doctype) else 'alerting')},
+                    )
+                ],
+            )
+        )
+    )
+    if ingested_after_ms is not None:
+        s = s.filter('range', **{'event.ingested': {'gt': ingested_after_ms, 'format': 'epoch_millis'}})
+
+    hostAgg = AggregationClass('terms', field='host.name', size=app.config["MALCOLM_API_INGEST_MAX_SOURCES"])
+    maxIngestAgg = AggregationClass('max', field='event.ingested')
+    hostBucket = s.aggs.bucket('host_names', hostAgg).metric('max_event_ingested', maxIngestAgg)
+    if counted_through_ms is not None:
+        hostBucket.bucket(
+            'counted',
+            AggregationClass(
+                'filter',
+                QueryClass('range', **{'event.ingested': {'lte': counted_through_ms, 'format': 'epoch_millis'}}),
+            ),
+        )
+    return s
+
+
+class IngestMonitor(object):
+    """Samples the latest event.ingested time of each data source (host.name) for a document type
+    in the background, keeping a rolling history per source from which ingest rates, lag (the age
+    of a source's most recent document at each sample) percentiles and stalled flags are derived.
+
+    The first sample aggregates over the whole index. After that, samples only consider documents
+    ingested within lookbackSec of the watermark (the latest event.ingested time seen so far), as
+    documents don't become searchable in event.ingested order, and sources with no new documents
+    keep their last known time. So that documents in that overlap aren't counted toward rates more
+    than once, each sample only counts those ingested between the previous sample's cutoff and its
+    own (lookbackSec behind the watermark), by which time they should all be searchable.
+    """
+
+    def __init__(self, doctype, intervalSec=30, historyLen=120, stalledSec=600, lookbackSec=120):
+        self.doctype = doctype
+        self.intervalSec = intervalSec
+        self.stalledSec = stalledSec
+        self.historyLen = historyLen
+        self.lookbackSec = lookbackSec
+        self.lock = Lock()
+        self.watermark = None
+        self.countedThrough = None
+        self.latest = {}
+        self.history = defaultdict(lambda: deque(maxlen=self.historyLen))
+        self.sampled = None
+        self.samples = 0
+        self.errors = 0
+
+    def sample(self):
+        countedThrough = (self.watermark - self.lookbackSec * 1000) if (self.watermark is not None) else None
+        try:
+            response = ingest_search(
+                self.doctype,
+                ingested_after_ms=self.countedThrough,
+                counted_through_ms=countedThrough if (self.countedThrough is not None) else None,
+            ).execute()
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            if debugApi:
+                print(f"{type(e).__name__}: \"{str(e)}\" sampling {self.doctype} ingest stats")
+            return
+
+        nowTime = time.time()
+        with self.lock:
+            counts = {}
+            for bucket in response.aggregations.host_names.buckets:
+                if bucket.max_event_ingested.value is not None:
+                    self.latest[bucket.key] = max(int(bucket.max_event_ingested.value), self.latest.get(bucket.key, 0))
+                if 'counted' in bucket:
+                    counts[bucket.key] = bucket.counted.doc_count
+            for source, latest in self.latest.items():
+                # the first sample's counts are of everything ever ingested, so they don't count toward rates
+                self.history[source].append((nowTime, nowTime - latest / 1000, counts.get(source, 0)))
+            if self.latest:
+                self.watermark = max(self.latest.values())
+                # the next sample looks back from (and counts documents ingested after) this sample's cutoff
+                if countedThrough is None:
+                    countedThrough = self.watermark - self.lookbackSec * 1000
+                self.countedThrough = countedThrough
+            self.sampled = nowTime
+            self.samples += 1
+
+    def run(self):
+        while True:
+            self.sample()
+            time.sleep(self.intervalSec)
+
+    def fresh(self):
+        with self.lock:
+            return (self.sampled is not None) and (time.time() - self.sampled <= self.intervalSec * 2)
+
+    def stats(self):
+        """Returns a dict containing, for each data source, its latest ingest time, its age, its ingest
+        rate (documents per second) over the history, its lag percentiles and whether it is stalled
+        """
+        nowTime = time.time()
+        with self.lock:
+            sources = {}
+            for source, latestMs in self.latest.items():
+                latest = latestMs / 1000
+                history = self.history[source]
+                lags = sorted(lag for _, lag, _ in history)
+                span = (history[-1][0] - history[0][0]) if (len(history) > 1) else 0
+                sources[source] = {
+                    'latest_ingest': datetime.fromtimestamp(latest, timezone.utc).replace(microsecond=0).isoformat(),
+                    'age_seconds': max(round(nowTime - latest), 0),
+                    # the first entry's count is for the interval before the history begins
+                    'rate_per_second': (
+                        round(sum(count for _, _, count in list(history)[1:]) / span, 3) if (span > 0) else 0.0
+                    ),
+                    'lag_seconds': {
+                        f'p{q}': max(round(lags[min(int(len(lags) * q / 100), len(lags) - 1)]), 0) if lags else None
+                        for q in (50, 90, 99)
+                    },
+                    'stalled': (nowTime - latest) > self.stalledSec,
+                }
+            return {
+                'doctype': self.doctype,
+                'sources': sources,
+                'stalled': sorted(source for source, info in sources.items() if info['stalled']),
+                'sampled': (
+                    datetime.fromtimestamp(self.sampled, timezone.utc).replace(microsecond=0).isoformat()
+                    if self.sampled
+                    else None
+                ),
+                'samples': self.samples,
+                'errors': self.errors,
+            }
+
+
+ingestMonitors = {
+    doctype: IngestMonitor(
+        doctype,
+        intervalSec=app.config["MALCOLM_API_INGEST_SAMPLE_SEC"],
+        historyLen=app.config["MALCOLM_API_INGEST_HISTORY_SAMPLES"],
+        stalledSec=app.config["MALCOLM_API_INGEST_STALLED_SEC"],
+        lookbackSec=app.config["MALCOLM_API_INGEST_LOOKBACK_SEC"],
+    )
+    for doctype in ('network', 'host')
+}
+if app.config["MALCOLM_API_INGEST_SAMPLE_SEC"] > 0:
+    for monitor in ingestMonitors.values():
+        Thread(target=monitor.run, daemon=True).start()
+
+
+def ingest_monitor_from_args(args):
+    dtype = doctype_from_args(args)
+    return ingestMonitors.get('host' if doctype_is_host_logs(dtype) else dtype)
+
+
 @app.route(
     f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/ingest-stats",
     methods=['GET'],
@@ -1173,7 +2245,8 @@ def dashboard_export(dashid):
 def ingest_stats():
     """Provide an aggregation of each log source (host.name) with it's latest event.ingested
     time. This can be used to know the most recent time a document was written from each
-    network sensor.
+    network sensor. The ingest monitor's (see IngestMonitor) results are used if it has sampled
+    recently, otherwise the aggregation is queried directly.
 
     Parameters
     ----------
@@ -1189,56 +2262,31 @@ def ingest_stats():
     result = {}
     result['latest_ingest_age_seconds'] = 0
     try:
-        # do the aggregation bucket query for the max event.ingested value for each data source
         request_args = get_request_arguments(request)
-        s = (
-            SearchClass(
-                using=databaseClient,
-                index=index_from_args(request_args),
-            ).extra(size=0)
-            # Exclusions:
-            #   NGINX access and error logs: we want to exclude nginx error and
-            #       access logs, otherwise the very act of accessing Malcolm will
-            #       update the latest ingest time returned from this function.
-            #   event() webhook: we want to exclude alerts written by the event()
-            #       webhook API (see below) and limit our results to actual
-            #       network logs ingested via PCAP, etc.
-            .query(
-                QueryClass(
-                    'bool',
-                    must_not=[
-                        QueryClass(
-                            'term',
-                            **{
-                                'event.module': (
-                                    'nginx' if doctype_is_host_logs(doctype_from_args(request_args)) else 'alerting'
-                                )
-                            },
-                        )
-                    ],
-                )
-            )
-        )
+        if (monitor := ingest_monitor_from_args(request_args)) and monitor.fresh():
+            sources = monitor.stats()['sources']
+            result['sources'] = {source: info['latest_ingest'] for source, info in sources.items()}
+            if sources:
+                result['latest_ingest_age_seconds'] = min(info['age_seconds'] for info in sources.values())
 
-        hostAgg = AggregationClass('terms', field='host.name')
-        maxIngestAgg = AggregationClass('max', field='event.ingested')
-        s.aggs.bucket('host_names', hostAgg).metric('max_event_ingested', maxIngestAgg)
-        response = s.execute()
-
-        # put the result array together while tracking the most recent ingest time
-        nowTime = datetime.now().astimezone(timezone.utc)
-        maxTime = None
-        result['sources'] = {}
-        for bucket in response.aggregations.host_names.buckets:
-            sourceTime = datetime.fromtimestamp(bucket.max_event_ingested.value / 1000, timezone.utc)
-            result['sources'][bucket.key] = sourceTime.replace(microsecond=0).isoformat()
-            if (maxTime is None) or (sourceTime > maxTime):
-                maxTime = sourceTime
-
-        # calculate the age of the most recent ingest time
-        if maxTime:
-            diffTime = nowTime - maxTime
-            result['latest_ingest_age_seconds'] = max(round(diffTime.total_seconds()), 0)
+        else:
+            # do the aggregation bucket query for the max event.ingested value for each data source
+            response = ingest_search(doctype_from_args(request_args)).execute()
+
+            # put the result array together while tracking the most recent ingest time
+            nowTime = datetime.now().astimezone(timezone.utc)
+            maxTime = None
+            result['sources'] = {}
+            for bucket in response.aggregations.host_names.buckets:
+                sourceTime = datetime.fromtimestamp(bucket.max_event_ingested.value / 1000, timezone.utc)
+                result['sources'][bucket.key] = sourceTime.replace(microsecond=0).isoformat()
+                if (maxTime is None) or (sourceTime > maxTime):
+                    maxTime = sourceTime
+
+            # calculate the age of the most recent ingest time
+            if maxTime:
+                diffTime = nowTime - maxTime
+                result['latest_ingest_age_seconds'] = max(round(diffTime.total_seconds()), 0)
 
     except Exception as e:
         if debugApi:
@@ -1247,6 +2295,89 @@ def ingest_stats():
     return jsonify(result)
 
 
+@app.route(
+    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/ingest-lag",
+    methods=['GET'],
+)
+def ingest_lag():
+    """Provide the ingest monitor's (see IngestMonitor) per-source freshness statistics, without
+    querying OpenSearch
+
+    Parameters
+    ----------
+    request : Request
+        Uses 'doctype' from request arguments
+    Returns
+    -------
+    sources
+        A dict where key is host.name and value is a dict containing 'latest_ingest' (its max(event.ingested)),
+        'age_seconds', 'rate_per_second' (documents ingested per second over the monitor's history),
+        'lag_seconds' (the 50th, 90th and 99th percentile of its age over the monitor's history) and
+        'stalled' (true if it hasn't ingested a document in MALCOLM_API_INGEST_STALLED_SEC seconds)
+    stalled
+        A list of the stalled sources
+    sampled
+        The time of the monitor's most recent sample
+    """
+    return jsonify((ingest_monitor_from_args(get_request_arguments(request)) or ingestMonitors['network']).stats())
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@app.route(
+    f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/ingest-lag/metrics",
+    methods=['GET'],
+)
+def ingest_lag_metrics():
+    """Provide the ingest monitors' (see IngestMonitor) statistics for all document types in the
+    Prometheus text exposition format
+
+    Parameters
+    ----------
+
+    Returns
+    -------
+    metrics
+        text/plain Prometheus metrics
+    """
+    metrics = {
+        'malcolm_ingest_latest_timestamp_seconds': ('gauge', 'Latest event.ingested time of the data source'),
+        'malcolm_ingest_age_seconds': ('gauge', 'Age of the data source\'s most recently ingested document'),
+        'malcolm_ingest_rate_per_second': ('gauge', 'Documents ingested per second over the sampled history'),
+        'malcolm_ingest_lag_seconds': ('gauge', 'Percentiles of the data source\'s age over the sampled history'),
+        'malcolm_ingest_stalled': ('gauge', 'Whether the data source has stopped ingesting documents'),
+        'malcolm_ingest_samples_total': ('counter', 'Number of ingest samples taken'),
+        'malcolm_ingest_sample_errors_total': ('counter', 'Number of ingest samples which failed'),
+    }
+    values = defaultdict(list)
+    for doctype, monitor in ingestMonitors.items():
+        stats = monitor.stats()
+        values['malcolm_ingest_samples_total'].append((f'doctype="{doctype}"', stats['samples']))
+        values['malcolm_ingest_sample_errors_total'].append((f'doctype="{doctype}"', stats['errors']))
+        for source, info in stats['sources'].items():
+            labels = f'doctype="{doctype}",host="{prometheus_label(source)}"'
+            values['malcolm_ingest_latest_timestamp_seconds'].append(
+                (labels, int(datetime.fromisoformat(info['latest_ingest']).timestamp()))
+            )
+            values['malcolm_ingest_age_seconds'].append((labels, info['age_seconds']))
+            values['malcolm_ingest_rate_per_second'].append((labels, info['rate_per_second']))
+            for quantile, lag in info['lag_seconds'].items():
+                if lag is not None:
+                    values['malcolm_ingest_lag_seconds'].append(
+                        (f'{labels},quantile="{int(quantile[1:]) / 100}"', lag),
+                    )
+            values['malcolm_ingest_stalled'].append((labels, int(info['stalled'])))
+
+    lines = []
+    for name, (metricType, description) in metrics.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {metricType}')
+        lines.extend(f'{name}{{{labels}}} {value}' for labels, value in values[name])
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
 @app.route(
     f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/netbox-sites",
     methods=['GET'],
@@ -1275,7 +2406,7 @@ def netbox_sites():
         url = f'{netboxUrl}/api/dcim/sites/?format=json'
         while url:
             try:
-                response = requests.get(url, headers=headers, verify=False)
+                response = upstreamSession.get(url, headers=headers, verify=False)
                 response.raise_for_status()
             except Exception as e:
                 if debugApi:
@@ -1316,6 +2447,210 @@ def ping():
     return jsonify(ping="pong")
 
 
+def alert_document(data):
+    """Translates alert data (see event) into a session record
+
+    Parameters
+    ----------
+    data : dict
+        the alert data
+
+    Returns
+    -------
+    index, id, alert
+        the name of the index and the document ID to which the record is to be written and
+        the record itself, or None if data does not contain an alert
+    """
+    if not (isinstance(data, dict) and ('alert' in data)):
+        return None
+
+    alert = {}
+    nowTimeStr = datetime.now().astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
+    alert[app.config["MALCOLM_NETWORK_INDEX_TIME_FIELD"]] = malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'period',
+            'start',
+        ],
+        nowTimeStr,
+    )
+    alert['firstPacket'] = alert[app.config["MALCOLM_NETWORK_INDEX_TIME_FIELD"]]
+    alert['lastPacket'] = malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'period',
+            'end',
+        ],
+        nowTimeStr,
+    )
+    alert['ecs'] = {}
+    alert['ecs']['version'] = '1.6.0'
+    alert['event'] = {}
+    alert['event']['kind'] = 'alert'
+    alert['event']['start'] = alert['firstPacket']
+    alert['event']['end'] = alert['lastPacket']
+    alert['event']['ingested'] = nowTimeStr
+    alert['event']['provider'] = 'malcolm'
+    alert['event']['dataset'] = 'alerting'
+    alert['event']['module'] = 'alerting'
+    alert['event']['url'] = '/dashboards/app/alerting#/dashboard'
+    alertId = malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'alert',
+        ],
+    )
+    alert['event']['id'] = alertId if alertId else random_id()
+    if alertBody := malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'body',
+        ],
+    ):
+        alert['event']['original'] = alertBody
+    if triggerName := malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'trigger',
+            'name',
+        ],
+    ):
+        alert['event']['reason'] = triggerName
+    if monitorName := malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'monitor',
+            'name',
+        ],
+    ):
+        alert['rule'] = {}
+        alert['rule']['name'] = monitorName
+    if alertSeverity := str(
+        malcolm_utils.deep_get(
+            data,
+            [
+                'alert',
+                'trigger',
+                'severity',
+            ],
+        )
+    ):
+        sevnum = 100 - ((int(alertSeverity) - 1) * 20) if alertSeverity.isdigit() else 40
+        alert['event']['risk_score'] = sevnum
+        alert['event']['risk_score_norm'] = sevnum
+        alert['event']['severity'] = sevnum
+        alert['event']['severity_tags'] = 'Alert'
+    if alertResults := malcolm_utils.deep_get(
+        data,
+        [
+            'alert',
+            'results',
+        ],
+    ):
+        if len(alertResults) > 0:
+            if hitCount := malcolm_utils.deep_get(alertResults[0], ['hits', 'total', 'value'], 0):
+                alert['event']['hits'] = hitCount
+
+    docDateStr = dateparser.parse(alert[app.config["MALCOLM_NETWORK_INDEX_TIME_FIELD"]]).strftime('%y%m%d')
+    return (
+        f"{app.config['MALCOLM_NETWORK_INDEX_PATTERN'].rstrip('*')}{docDateStr}",
+        f"{docDateStr}-{alert['event']['id']}",
+        alert,
+    )
+
+
+class BulkIndexer(object):
+    """Writes documents with the _bulk API, grouping the documents of concurrent callers.
+
+    While one caller's bulk request is in flight, documents submitted by other callers (i.e., other
+    request threads) accumulate and are sent together by the next caller to take a turn (after
+    waiting up to lingerSec for more to arrive), so a burst of concurrent single-alert webhook posts
+    costs a few bulk requests rather than one index request apiece. Each bulk request contains at
+    most maxBatch documents.
+    """
+
+    def __init__(self, client, maxBatch=500, lingerSec=0.0):
+        self.client = client
+        self.maxBatch = maxBatch
+        self.lingerSec = lingerSec
+        self.cond = Condition()
+        self.pending = []
+        self.flushing = False
+
+    def _flush(self, batch):
+        actions = [action for entry in batch for action in entry['actions']]
+        items = []
+        for i in range(0, len(actions), self.maxBatch):
+            chunk = actions[i : i + self.maxBatch]
+            try:
+                body = []
+                for index, docId, doc in chunk:
+                    body.append({'index': {'_index': index, '_id': docId}})
+                    body.append(doc)
+                items.extend([next(iter(item.values()), {}) for item in self.client.bulk(body=body).get('items', [])])
+            except Exception as e:
+                errStr = f"{type(e).__name__}: {str(e)}"
+                if debugApi:
+                    print(f"{errStr} bulk indexing {len(chunk)} documents")
+                items.extend(
+                    [{'_index': index, '_id': docId, 'status': 500, 'error': errStr} for index, docId, _ in chunk]
+                )
+        for entry in batch:
+            entry['results'], items = items[: len(entry['actions'])], items[len(entry['actions']) :]
+
+    def index(self, actions):
+        """Indexes documents
+
+        Parameters
+        ----------
+        actions : list
+            a list of (index, id, document) tuples
+
+        Returns
+        -------
+        results
+            a list of the _bulk API's per-item results (containing '_index', '_id', 'status',
+            'result' or 'error', etc.), one for each action
+        """
+        entry = {'actions': list(actions), 'results': None}
+        if not entry['actions']:
+            return []
+        with self.cond:
+            self.pending.append(entry)
+            while entry['results'] is None:
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                if self.lingerSec > 0:
+                    self.cond.wait(self.lingerSec)
+                batch, count = [], 0
+                while self.pending and ((not batch) or (count + len(self.pending[0]['actions']) <= self.maxBatch)):
+                    count += len(self.pending[0]['actions'])
+                    batch.append(self.pending.pop(0))
+                self.cond.release()
+                try:
+                    self._flush(batch)
+                finally:
+                    self.cond.acquire()
+                    self.flushing = False
+                    self.cond.notify_all()
+        return entry['results']
+
+
+bulkIndexer = BulkIndexer(
+    databaseClient,
+    maxBatch=app.config["MALCOLM_API_EVENT_BATCH_SIZE"],
+    lingerSec=app.config["MALCOLM_API_EVENT_BATCH_WAIT_MS"] / 1000.0,
+)
+
+
 @app.route(
     f"{('/' + app.config['MALCOLM_API_PREFIX']) if app.config['MALCOLM_API_PREFIX'] else ''}/alert", methods=['POST']
 )
@@ -1331,7 +2666,8 @@ def event():
 
     Parameters
     ----------
-    HTTP POST data in JSON format
+    HTTP POST data in JSON format: a single alert, an array of alerts, or (with a Content-Type of
+    application/x-ndjson) newline-delimited alerts, written with the _bulk API (see BulkIndexer)
     e.g.:
         {
           "alert": {
@@ -1374,117 +2710,38 @@ def event():
 
     Returns
     -------
-    status
-        the JSON-formatted OpenSearch response from indexing/updating the alert record
+    result
+        the JSON-formatted OpenSearch response from indexing/updating the alert record, or for
+        multiple alerts, an array of responses (an empty object for any item not containing an alert,
+        or an object containing 'error' for one that couldn't be translated or indexed)
+    errors
+        for multiple alerts, the number of alerts which could not be indexed
     """
-    alert = {}
-    idxResponse = {}
-    data = get_request_arguments(request)
-    nowTimeStr = datetime.now().astimezone(timezone.utc).isoformat().replace('+00:00', 'Z')
-    if 'alert' in data:
-        alert[app.config["MALCOLM_NETWORK_INDEX_TIME_FIELD"]] = malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'period',
-                'start',
-            ],
-            nowTimeStr,
-        )
-        alert['firstPacket'] = alert[app.config["MALCOLM_NETWORK_INDEX_TIME_FIELD"]]
-        alert['lastPacket'] = malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'period',
-                'end',
-            ],
-            nowTimeStr,
-        )
-        alert['ecs'] = {}
-        alert['ecs']['version'] = '1.6.0'
-        alert['event'] = {}
-        alert['event']['kind'] = 'alert'
-        alert['event']['start'] = alert['firstPacket']
-        alert['event']['end'] = alert['lastPacket']
-        alert['event']['ingested'] = nowTimeStr
-        alert['event']['provider'] = 'malcolm'
-        alert['event']['dataset'] = 'alerting'
-        alert['event']['module'] = 'alerting'
-        alert['event']['url'] = '/dashboards/app/alerting#/dashboard'
-        alertId = malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'alert',
-            ],
-        )
-        alert['event']['id'] = alertId if alertId else random_id()
-        if alertBody := malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'body',
-            ],
-        ):
-            alert['event']['original'] = alertBody
-        if triggerName := malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'trigger',
-                'name',
-            ],
-        ):
-            alert['event']['reason'] = triggerName
-        if monitorName := malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'monitor',
-                'name',
-            ],
-        ):
-            alert['rule'] = {}
-            alert['rule']['name'] = monitorName
-        if alertSeverity := str(
-            malcolm_utils.deep_get(
-                data,
-                [
-                    'alert',
-                    'trigger',
-                    'severity',
-                ],
-            )
-        ):
-            sevnum = 100 - ((int(alertSeverity) - 1) * 20) if alertSeverity.isdigit() else 40
-            alert['event']['risk_score'] = sevnum
-            alert['event']['risk_score_norm'] = sevnum
-            alert['event']['severity'] = sevnum
-            alert['event']['severity_tags'] = 'Alert'
-        if alertResults := malcolm_utils.deep_get(
-            data,
-            [
-                'alert',
-                'results',
-            ],
-        ):
-            if len(alertResults) > 0:
-                if hitCount := malcolm_utils.deep_get(alertResults[0], ['hits', 'total', 'value'], 0):
-                    alert['event']['hits'] = hitCount
-
-        docDateStr = dateparser.parse(alert[app.config["MALCOLM_NETWORK_INDEX_TIME_FIELD"]]).strftime('%y%m%d')
-        idxResponse = databaseClient.index(
-            index=f"{app.config['MALCOLM_NETWORK_INDEX_PATTERN'].rstrip('*')}{docDateStr}",
-            id=f"{docDateStr}-{alert['event']['id']}",
-            body=alert,
-        )
+    if request.mimetype in ('application/x-ndjson', 'application/ndjson'):
+        data = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+    elif request.is_json and isinstance(payload := request.get_json(), list):
+        data = payload
+    else:
+        data = get_request_arguments(request)
+
+    # translate each alert, keeping the errors of any that can't be in place of their index responses
+    docs = []
+    for item in data if isinstance(data, list) else [data]:
+        try:
+            docs.append(alert_document(item))
+        except Exception as e:
+            docs.append({'error': f"{type(e).__name__}: {str(e)}", 'status': 400})
+    results = iter(bulkIndexer.index([doc for doc in docs if isinstance(doc, tuple)]))
+    idxResponse = [next(results) if isinstance(doc, tuple) else (doc or {}) for doc in docs]
 
     if debugApi:
         print(json.dumps(data))
-        print(json.dumps(alert))
+        print(json.dumps([doc[2] for doc in docs if isinstance(doc, tuple)]))
         print(json.dumps(idxResponse))
-    return jsonify(result=idxResponse)
+    if isinstance(data, list):
+        return jsonify(result=idxResponse, errors=len([x for x in idxResponse if 'error' in x]))
+    else:
+        return jsonify(result=idxResponse[0])
 
 
 @app.errorhandler(Exception)
@@ -27,8 +27,29 @@ class Config(object):
     LOGSTASH_API_PORT = int(f"{os.getenv('LOGSTASH_API_PORT', '9600')}")
     LOGSTASH_HOST = f"{os.getenv('LOGSTASH_HOST', 'logstash')}"
     LOGSTASH_LJ_PORT = int(f"{os.getenv('LOGSTASH_LJ_PORT', '5044')}")
+    MALCOLM_API_AGG_CACHE_GRANULARITY_SEC = int(f"{os.getenv('MALCOLM_API_AGG_CACHE_GRANULARITY_SEC', '60')}")
+    MALCOLM_API_AGG_CACHE_MAX = int(f"{os.getenv('MALCOLM_API_AGG_CACHE_MAX', '256')}")
+    MALCOLM_API_AGG_CACHE_SEC = float(f"{os.getenv('MALCOLM_API_AGG_CACHE_SEC', '60')}")
     MALCOLM_API_DEBUG = f"{os.getenv('MALCOLM_API_DEBUG', 'false')}"
+    MALCOLM_API_EVENT_BATCH_SIZE = int(f"{os.getenv('MALCOLM_API_EVENT_BATCH_SIZE', '500')}")
+    MALCOLM_API_EVENT_BATCH_WAIT_MS = int(f"{os.getenv('MALCOLM_API_EVENT_BATCH_WAIT_MS', '0')}")
+    MALCOLM_API_EXPORT_BATCH_SIZE = int(f"{os.getenv('MALCOLM_API_EXPORT_BATCH_SIZE', '1000')}")
+    MALCOLM_API_EXPORT_CHUNK_BYTES = int(f"{os.getenv('MALCOLM_API_EXPORT_CHUNK_BYTES', '65536')}")
+    MALCOLM_API_EXPORT_SCROLL = f"{os.getenv('MALCOLM_API_EXPORT_SCROLL', '2m')}"
+    MALCOLM_API_FIELD_CACHE_TTL_SEC = int(f"{os.getenv('MALCOLM_API_FIELD_CACHE_TTL_SEC', '300')}")
+    MALCOLM_API_FIELDS_REFRESH_SEC = int(f"{os.getenv('MALCOLM_API_FIELDS_REFRESH_SEC', '300')}")
+    MALCOLM_API_INGEST_HISTORY_SAMPLES = int(f"{os.getenv('MALCOLM_API_INGEST_HISTORY_SAMPLES', '120')}")
+    MALCOLM_API_INGEST_LOOKBACK_SEC = int(f"{os.getenv('MALCOLM_API_INGEST_LOOKBACK_SEC', '120')}")
+    MALCOLM_API_INGEST_MAX_SOURCES = int(f"{os.getenv('MALCOLM_API_INGEST_MAX_SOURCES', '1000')}")
+    MALCOLM_API_INGEST_SAMPLE_SEC = int(f"{os.getenv('MALCOLM_API_INGEST_SAMPLE_SEC', '30')}")
+    MALCOLM_API_INGEST_STALLED_SEC = int(f"{os.getenv('MALCOLM_API_INGEST_STALLED_SEC', '600')}")
     MALCOLM_API_PREFIX = f"{os.getenv('MALCOLM_API_PREFIX', 'mapi')}"
+    MALCOLM_API_READY_CACHE_SEC = float(f"{os.getenv('MALCOLM_API_READY_CACHE_SEC', '5')}")
+    MALCOLM_API_READY_TIMEOUT_SEC = float(f"{os.getenv('MALCOLM_API_READY_TIMEOUT_SEC', '5')}")
+    MALCOLM_API_UPSTREAM_BACKOFF_SEC = float(f"{os.getenv('MALCOLM_API_UPSTREAM_BACKOFF_SEC', '0.5')}")
+    MALCOLM_API_UPSTREAM_POOL_SIZE = int(f"{os.getenv('MALCOLM_API_UPSTREAM_POOL_SIZE', '16')}")
+    MALCOLM_API_UPSTREAM_RETRIES = int(f"{os.getenv('MALCOLM_API_UPSTREAM_RETRIES', '3')}")
+    MALCOLM_API_UPSTREAM_TIMEOUT_SEC = float(f"{os.getenv('MALCOLM_API_UPSTREAM_TIMEOUT_SEC', '60')}")
     MALCOLM_TEMPLATE = f"{os.getenv('MALCOLM_TEMPLATE', 'malcolm_template')}"
     MALCOLM_VERSION = f"{os.getenv('MALCOLM_VERSION', 'unknown')}"
     NETBOX_URL = os.getenv('NETBOX_URL') or 'http://netbox:8080/netbox'
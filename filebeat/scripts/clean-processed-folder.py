@@ -9,11 +9,11 @@ from tempfile import gettempdir
 import errno
 import time
 import fcntl
-import magic
 import json
 import re
 from subprocess import Popen, PIPE, DEVNULL
 from malcolm_utils import LoadFileIfJson, deep_get
+from sniff_common import sniff_file
 
 lockFilename = os.path.join(gettempdir(), '{}.lock'.format(os.path.basename(__file__)))
 cleanLogSeconds = int(os.getenv('LOG_CLEANUP_MINUTES', "30")) * 60
@@ -76,7 +76,7 @@ def checkFile(filename, filebeatReg=None, checkLogs=True, checkArchives=True):
             lastUseTime = nowTime - logTime
 
             # get the file type
-            fileType = magic.from_file(filename, mime=True)
+            fileType = sniff_file(filename).mime
             if (checkLogs is True) and (cleanLogSeconds > 0) and logMimeTypeRegex.match(fileType) is not None:
                 cleanSeconds = cleanLogSeconds
             elif (checkArchives is True) and (cleanZipSeconds > 0) and archiveMimeTypeRegex.match(fileType) is not None:
@@ -12,7 +12,6 @@
 import argparse
 import glob
 import logging
-import magic
 import os
 import pathlib
 import re
@@ -24,6 +23,7 @@ import time
 import malcolm_utils
 from malcolm_utils import eprint, str2bool, remove_suffix
 import watch_common
+from sniff_common import sniff_file
 
 ###################################################################################################
 scriptName = os.path.basename(__file__)
@@ -79,9 +79,8 @@ def file_processor(pathname, **kwargs):
         try:
             os.chown(pathname, uid, gid)
 
-            # get the file magic mime type
-            fileMime = magic.from_file(pathname, mime=True)
-            fileType = magic.from_file(pathname)
+            # get the file magic mime type and description
+            fileMime, fileType = sniff_file(pathname)
 
             if (fileMime in mime_types) or any([re.search(reg, fileType, re.IGNORECASE) for reg in file_type_regexes]):
                 # looks like this is a compressed file (or evtx file), we're assuming it's:
@@ -154,6 +153,16 @@ def main():
         ),
         required=False,
     )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='processorThreads',
+        help="Number of threads processing files once they're ready",
+        metavar='<threads>',
+        type=int,
+        default=int(os.getenv('FILEBEAT_WATCHER_THREADS', str(watch_common.PROCESSOR_THREADS_DEFAULT))),
+        required=False,
+    )
     parser.add_argument(
         '-i',
         '--in',
@@ -263,6 +272,7 @@ def main():
         args.assumeClosedSec,
         shuttingDown,
         logging,
+        processorThreads=args.processorThreads,
     )
 
 
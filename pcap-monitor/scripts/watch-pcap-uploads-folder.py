@@ -12,7 +12,6 @@
 import argparse
 import glob
 import logging
-import magic
 import os
 import pathlib
 import re
@@ -24,6 +23,7 @@ import time
 import malcolm_utils
 from malcolm_utils import eprint, str2bool, remove_suffix
 import watch_common
+from sniff_common import sniff_file
 
 ###################################################################################################
 scriptName = os.path.basename(__file__)
@@ -54,9 +54,8 @@ def file_processor(pathname, **kwargs):
         try:
             os.chown(pathname, uid, gid)
 
-            # get the file magic mime type
-            fileMime = magic.from_file(pathname, mime=True)
-            fileType = magic.from_file(pathname)
+            # get the file magic mime type and description
+            fileMime, fileType = sniff_file(pathname)
 
             if os.path.isdir(pcapDir) and (
                 (fileMime in ('application/vnd.tcpdump.pcap', 'application/x-pcapng'))
@@ -153,6 +152,16 @@ def main():
         default=int(os.getenv('PCAP_PIPELINE_POLLING_ASSUME_CLOSED_SEC', str(watch_common.ASSUME_CLOSED_SEC_DEFAULT))),
         required=False,
     )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='processorThreads',
+        help="Number of threads processing files once they're ready",
+        metavar='<threads>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_WATCHER_THREADS', str(watch_common.PROCESSOR_THREADS_DEFAULT))),
+        required=False,
+    )
     parser.add_argument(
         '-i',
         '--in',
@@ -272,6 +281,7 @@ def main():
         args.assumeClosedSec,
         shuttingDown,
         logging,
+        processorThreads=args.processorThreads,
     )
 
 
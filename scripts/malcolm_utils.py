@@ -5,6 +5,7 @@
 
 import contextlib
 import enum
+import gzip
 import hashlib
 import ipaddress
 import json
@@ -20,8 +21,10 @@ import time
 
 
 from base64 import b64decode
+from collections import deque
 from datetime import datetime
 from multiprocessing import RawValue
+from multiprocessing.pool import ThreadPool
 from subprocess import PIPE, STDOUT, Popen, CalledProcessError
 from tempfile import NamedTemporaryFile
 from threading import Lock
@@ -129,9 +132,9 @@ def base64_decode_if_prefixed(s: str):
 
 ###################################################################################################
 # test if a remote port is open
-def check_socket(host, port):
+def check_socket(host, port, timeout=10):
     with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-        sock.settimeout(10)
+        sock.settimeout(timeout)
         if sock.connect_ex((host, port)) == 0:
             return True
         else:
@@ -400,6 +403,45 @@ def isprivateip(value):
     return result
 
 
+###################################################################################################
+# check whether a path is on a network filesystem (NFS, SMB, etc.), according to /proc/mounts. things
+#   like SQLite's WAL mode (which needs shared memory between processes) aren't safe on these
+NETWORK_FILESYSTEM_TYPES = (
+    '9p',
+    'afs',
+    'ceph',
+    'cifs',
+    'fuse.sshfs',
+    'glusterfs',
+    'lustre',
+    'nfs',
+    'nfs4',
+    'smb3',
+    'smbfs',
+)
+
+
+def isnetworkfilesystem(path):
+    result = False
+    try:
+        realPath = os.path.realpath(path)
+        mountPoint = ''
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    # mount points with spaces, etc. are octal-escaped (e.g., "\040")
+                    mountDir = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                    if ((realPath == mountDir) or realPath.startswith(mountDir.rstrip(os.path.sep) + os.path.sep)) and (
+                        len(mountDir) >= len(mountPoint)
+                    ):
+                        mountPoint = mountDir
+                        result = fields[2] in NETWORK_FILESYSTEM_TYPES
+    except Exception:
+        result = False
+    return result
+
+
 ###################################################################################################
 # return the primary IP (the one with a default route) on the local box
 def get_primary_ip():
@@ -577,6 +619,58 @@ def sha256sum(filename):
     return h.hexdigest()
 
 
+###################################################################################################
+# a write-only file-like object that gzip-compresses what's written to it on several threads at once.
+# the data is compressed in independent blockSize chunks, each of which is written out (in order) as
+# its own gzip member: the result is a valid gzip stream (RFC 1952 allows multiple members) that any
+# gzip reader will decompress as a single file.
+class ParallelGzipWriter:
+    def __init__(self, fileobj, compresslevel=6, threads=None, blockSize=4 * 1024 * 1024):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.threads = max(1, threads if threads else (os.cpu_count() or 1))
+        self.blockSize = blockSize
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.pool = ThreadPool(self.threads)
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(gzip.compress, (block, self.compresslevel)))
+
+    def _drain(self, keep):
+        while len(self.pending) > keep:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.blockSize:
+            self._submit(bytes(self.buffer[: self.blockSize]))
+            del self.buffer[: self.blockSize]
+            # don't let compressed blocks pile up in memory faster than we can write them
+            self._drain(self.threads * 2)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.pool is not None:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self._drain(0)
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
 ###################################################################################################
 # nice human-readable file sizes
 def sizeof_fmt(num, suffix='B'):
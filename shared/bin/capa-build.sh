@@ -20,5 +20,9 @@ python3 ./scripts/cache-ruleset.py rules/ cache
 pyinstaller ./.github/pyinstaller/pyinstaller.spec
 mv ./dist/capa /usr/local/bin/capa
 chmod 755 /usr/local/bin/capa
+# rules, signatures and python package for zeek_carve_scanner.py's in-process capa engines
+mkdir -p /opt/capa
+cp -r ./rules ./sigs /opt/capa/
 deactivate
+python3 -m pip install --break-system-packages --no-compile --no-cache-dir "flare-capa==${CAPA_VERSION}"
 rm -rf /tmp/capa*
\ No newline at end of file
@@ -11,6 +11,7 @@
 ###################################################################################################
 
 import argparse
+import gzip
 import json
 import logging
 import os
@@ -31,14 +32,22 @@ from pcap_utils import (
     FILE_INFO_DICT_TAGS,
     FILE_INFO_FILE_MIME,
     FILE_INFO_FILE_TYPE,
+    PCAP_JOURNAL_HEARTBEAT_SEC,
     PCAP_MIME_TYPES,
+    PCAP_QUEUE_LANE_BULK,
+    PCAP_QUEUE_LANE_LIVE,
+    PCAP_QUEUE_LANE_NAMES,
+    PCAP_QUEUE_LANE_SMALL,
     PCAP_TOPIC_PORT,
+    PersistentFileQueue,
+    split_pcap_by_flow,
     tags_from_filename,
 )
-from malcolm_utils import eprint, str2bool, AtomicInt, run_process, same_file_or_dir
+from malcolm_utils import eprint, str2bool, AtomicInt, ParallelGzipWriter, run_process, same_file_or_dir
 from multiprocessing.pool import ThreadPool
-from collections import deque
+from contextlib import nullcontext
 from itertools import chain, repeat
+from threading import BoundedSemaphore
 
 try:
     from suricata_socket import SuricataSocketClient
@@ -49,6 +58,15 @@ except ModuleNotFoundError:
 ###################################################################################################
 MAX_WORKER_PROCESSES_DEFAULT = 1
 
+# the durable work queue lives in a hidden subdirectory of the PCAP directory by default
+#   (pcap_watcher.py doesn't watch recursively, so it won't see the journal's writes)
+PCAP_QUEUE_DIR_DEFAULT = '.queue'
+
+# uploaded files larger than this go into the bulk lane, which is limited to fewer concurrent workers
+PCAP_QUEUE_BULK_BYTES_DEFAULT = 1024 * 1024 * 1024
+# shortest-job-first aging: each second an item waits is worth this many bytes off of its size
+PCAP_QUEUE_AGING_BYTES_PER_SEC_DEFAULT = 1024 * 1024
+
 PCAP_PROCESSING_MODE_ARKIME = "arkime"
 PCAP_PROCESSING_MODE_ZEEK = "zeek"
 PCAP_PROCESSING_MODE_SURICATA = "suricata"
@@ -75,6 +93,21 @@ ZEEK_STATE_DIR = '.state'
 ZEEK_AUTOZEEK_TAG = 'AUTOZEEK'
 ZEEK_EXTRACTOR_MODE_ENV_VAR = 'ZEEK_EXTRACTOR_MODE'
 ZEEK_LOG_COMPRESSION_LEVEL = 6
+ZEEK_SPLIT_DIR = '.split'
+# logs describing the zeek process itself rather than the traffic; when a PCAP file is split up only the first
+#   chunk's copy of these is kept
+ZEEK_SPLIT_PER_RUN_LOGS = (
+    'capture_loss.log',
+    'loaded_scripts.log',
+    'packet_filter.log',
+    'stats.log',
+)
+ZEEK_LOG_CLOSE_PREFIX = b'#close'
+ZEEK_LOG_TAIL_BYTES = 4096
+ZEEK_LOG_COPY_BYTES = 1024 * 1024
+# archives are written here (under the upload directory, which isn't watched recursively) and then
+#   renamed into the upload directory once they're complete
+ZEEK_UPLOAD_TMP_DIR = '.tmp'
 NETBOX_SITE_ID_TAG_PREFIX = 'NBSITEID'
 USERTAG_TAG = 'USERTAG'
 
@@ -94,6 +127,8 @@ scriptPath = os.path.dirname(os.path.realpath(__file__))
 origPath = os.getcwd()
 shuttingDown = False
 workersCount = AtomicInt(value=0)
+# limits the total number of zeek processes run at once across all workers (including for split PCAP chunks)
+zeekProcessSemaphore = None
 arkimeProvider = os.getenv('ARKIME_ECS_PROVIDER', 'arkime')
 arkimeDataset = os.getenv('ARKIME_ECS_DATASET', 'session')
 
@@ -112,6 +147,17 @@ def pdb_handler(sig, frame):
     pdbFlagged = True
 
 
+###################################################################################################
+# determine which priority lane of the work queue a file belongs in
+def queueLaneForFile(fileInfo, bulkBytes):
+    if fileInfo.get(FILE_INFO_DICT_LIVE, False):
+        return PCAP_QUEUE_LANE_LIVE
+    elif (bulkBytes > 0) and (fileInfo.get(FILE_INFO_DICT_SIZE, 0) > bulkBytes):
+        return PCAP_QUEUE_LANE_BULK
+    else:
+        return PCAP_QUEUE_LANE_SMALL
+
+
 ###################################################################################################
 def arkimeCaptureFileWorker(arkimeWorkerArgs):
     global shuttingDown
@@ -156,12 +202,12 @@ def arkimeCaptureFileWorker(arkimeWorkerArgs):
 
     # loop forever, or until we're told to shut down
     while not shuttingDown:
+        # pull an item from the queue of files that need to be processed, waiting for one to become available
+        queueItem = newFileQueue.get(timeout=1)
+        if queueItem is None:
+            continue
+        queueId, fileInfo = queueItem
         try:
-            # pull an item from the queue of files that need to be processed
-            fileInfo = newFileQueue.popleft()
-        except IndexError:
-            time.sleep(1)
-        else:
             if isinstance(fileInfo, dict) and (FILE_INFO_DICT_NAME in fileInfo):
                 if pcapBaseDir and os.path.isdir(pcapBaseDir):
                     fileInfo[FILE_INFO_DICT_NAME] = os.path.join(pcapBaseDir, fileInfo[FILE_INFO_DICT_NAME])
@@ -238,9 +284,132 @@ def arkimeCaptureFileWorker(arkimeWorkerArgs):
                                 f"{scriptName}[{workerId}]:\t❗\t{arkimeBin} {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])} returned {retcode} {output}"
                             )
 
+        finally:
+            # whether or not it was successful, we're done with this one
+            newFileQueue.ack(queueId)
+
     logger.info(f"{scriptName}[{workerId}]:\tfinished")
 
 
+###################################################################################################
+# run zeek against a PCAP file, with its cwd (and so its logs) in logDir
+def runZeek(zeekBin, pcapFile, zeekScripts, logDir, zeekEnv, logger):
+    os.makedirs(logDir, exist_ok=True)
+    with zeekProcessSemaphore if zeekProcessSemaphore else nullcontext():
+        return run_process([zeekBin, "-r", pcapFile] + zeekScripts, cwd=logDir, env=zeekEnv, logger=logger)
+
+
+# merge the logs zeek wrote for each chunk of a split PCAP file into logDir. JSON logs are just concatenated.
+#   TSV logs get the first chunk's header (#separator, #fields, etc.), then each chunk's records, then the
+#   last chunk's #close line. Only the first chunk's copy of the logs about the zeek process itself is kept.
+def mergeZeekLogs(chunkLogDirs, logDir):
+    logNames = sorted(
+        set(
+            chain.from_iterable(
+                [x for x in os.listdir(chunkLogDir) if x.endswith('.log')]
+                for chunkLogDir in chunkLogDirs
+                if os.path.isdir(chunkLogDir)
+            )
+        )
+    )
+    for logName in logNames:
+        chunkLogs = [
+            os.path.join(chunkLogDir, logName)
+            for chunkLogDir in chunkLogDirs
+            if os.path.isfile(os.path.join(chunkLogDir, logName))
+        ]
+        if logName in ZEEK_SPLIT_PER_RUN_LOGS:
+            chunkLogs = chunkLogs[:1]
+        closeLine = None
+        with open(os.path.join(logDir, logName), 'wb') as dst:
+            for idx, chunkLog in enumerate(chunkLogs):
+                chunkSize = os.path.getsize(chunkLog)
+                with open(chunkLog, 'rb') as src:
+                    # leading header lines (TSV only, JSON logs don't have any)
+                    bodyStart = 0
+                    while (line := src.readline()).startswith(b'#') and not line.startswith(ZEEK_LOG_CLOSE_PREFIX):
+                        if idx == 0:
+                            dst.write(line)
+                        bodyStart = src.tell()
+                    # trailing #close line (TSV only)
+                    bodyEnd = chunkSize
+                    tailStart = max(bodyStart, chunkSize - ZEEK_LOG_TAIL_BYTES)
+                    src.seek(tailStart)
+                    tail = src.read()
+                    if tail.startswith(ZEEK_LOG_CLOSE_PREFIX):
+                        closeIdx = 0
+                    elif (closeIdx := tail.rfind(b'\n' + ZEEK_LOG_CLOSE_PREFIX)) >= 0:
+                        closeIdx += 1
+                    if closeIdx >= 0:
+                        bodyEnd = tailStart + closeIdx
+                        closeLine = tail[closeIdx:]
+                    # the records in between
+                    src.seek(bodyStart)
+                    remaining = bodyEnd - bodyStart
+                    while (remaining > 0) and (buf := src.read(min(remaining, ZEEK_LOG_COPY_BYTES))):
+                        dst.write(buf)
+                        remaining -= len(buf)
+            if closeLine:
+                dst.write(closeLine)
+
+
+# split a large PCAP file into chunks by flow and run zeek on the chunks concurrently, merging the logs
+#   from each chunk into logDir. returns the (retcode, output) of the first failed zeek process (or the
+#   first one if they all succeeded), or None if the file couldn't be split
+def runZeekSplit(zeekBin, pcapFile, zeekScripts, logDir, zeekEnv, chunkCount, logger):
+    chunkDir = os.path.abspath(os.path.join(logDir, ZEEK_SPLIT_DIR))
+    try:
+        pcapChunks = split_pcap_by_flow(pcapFile, os.path.join(chunkDir, 'pcap'), chunkCount)
+    except Exception as e:
+        logger.warning(f"{scriptName}:\t❗\terror splitting {os.path.basename(pcapFile)}: {e}")
+        pcapChunks = None
+
+    result = None
+    if pcapChunks and (len(pcapChunks) > 1):
+        chunkLogDirs = [os.path.join(chunkDir, str(i)) for i in range(len(pcapChunks))]
+        logger.info(f"{scriptName}:\t🔪\t{os.path.basename(pcapFile)} split into {len(pcapChunks)} chunks")
+        with ThreadPool(len(pcapChunks)) as pool:
+            results = pool.starmap(
+                runZeek,
+                [(zeekBin, x, zeekScripts, y, zeekEnv, logger) for x, y in zip(pcapChunks, chunkLogDirs)],
+            )
+        mergeZeekLogs(chunkLogDirs, logDir)
+        result = next((x for x in results if x[0] != 0), results[0])
+
+    shutil.rmtree(chunkDir, ignore_errors=True)
+    return result
+
+
+# archive zeek logs directly into the upload directory. the archive is built in a temporary file on the
+#   same filesystem and atomically renamed into place when it's done, so the upload directory watcher
+#   never sees a partial archive. compressLevel 0 writes an uncompressed tarball, and compressThreads > 1
+#   compresses on several threads at once. returns the name of the archive.
+def archiveZeekLogs(logDir, uploadDir, archiveBaseName, compressLevel, compressThreads):
+    archiveName = archiveBaseName + ('.tar.gz' if compressLevel > 0 else '.tar')
+    tmpDir = os.path.join(uploadDir, ZEEK_UPLOAD_TMP_DIR)
+    os.makedirs(tmpDir, exist_ok=True)
+    tmpArchiveName = os.path.join(tmpDir, archiveName)
+    try:
+        with open(tmpArchiveName, 'xb') as f:
+            if compressLevel <= 0:
+                with tarfile.open(fileobj=f, mode='w|') as tar:
+                    tar.add(logDir, arcname=os.path.basename('.'))
+            elif compressThreads > 1:
+                with ParallelGzipWriter(f, compresslevel=compressLevel, threads=compressThreads) as gz:
+                    with tarfile.open(fileobj=gz, mode='w|') as tar:
+                        tar.add(logDir, arcname=os.path.basename('.'))
+            else:
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=compressLevel) as gz:
+                    with tarfile.open(fileobj=gz, mode='w|') as tar:
+                        tar.add(logDir, arcname=os.path.basename('.'))
+        os.replace(tmpArchiveName, os.path.join(uploadDir, archiveName))
+    except Exception:
+        if os.path.isfile(tmpArchiveName):
+            os.unlink(tmpArchiveName)
+        raise
+    return os.path.join(uploadDir, archiveName)
+
+
 ###################################################################################################
 def zeekFileWorker(zeekWorkerArgs):
     global shuttingDown
@@ -260,6 +429,10 @@ def zeekFileWorker(zeekWorkerArgs):
         defaultExtractFileMode,
         logger,
         debug,
+        splitBytes,
+        splitChunks,
+        compressLevel,
+        compressThreads,
     ) = (
         zeekWorkerArgs[0],
         zeekWorkerArgs[1],
@@ -272,6 +445,10 @@ def zeekFileWorker(zeekWorkerArgs):
         zeekWorkerArgs[8],
         zeekWorkerArgs[9],
         zeekWorkerArgs[10],
+        zeekWorkerArgs[11],
+        zeekWorkerArgs[12],
+        zeekWorkerArgs[13],
+        zeekWorkerArgs[14],
     )
 
     if not logger:
@@ -281,12 +458,12 @@ def zeekFileWorker(zeekWorkerArgs):
 
     # loop forever, or until we're told to shut down
     while not shuttingDown:
+        # pull an item from the queue of files that need to be processed, waiting for one to become available
+        queueItem = newFileQueue.get(timeout=1)
+        if queueItem is None:
+            continue
+        queueId, fileInfo = queueItem
         try:
-            # pull an item from the queue of files that need to be processed
-            fileInfo = newFileQueue.popleft()
-        except IndexError:
-            time.sleep(1)
-        else:
             if isinstance(fileInfo, dict) and (FILE_INFO_DICT_NAME in fileInfo) and os.path.isdir(uploadDir):
                 if pcapBaseDir and os.path.isdir(pcapBaseDir):
                     fileInfo[FILE_INFO_DICT_NAME] = os.path.join(pcapBaseDir, fileInfo[FILE_INFO_DICT_NAME])
@@ -327,19 +504,40 @@ def zeekFileWorker(zeekWorkerArgs):
                                 processTimeUsec = int(round(time.time() * 1000000))
 
                                 # use Zeek to process the pcap
-                                zeekCmd = [zeekBin, "-r", fileInfo[FILE_INFO_DICT_NAME], ZEEK_LOCAL_SCRIPT]
+                                zeekScripts = [ZEEK_LOCAL_SCRIPT]
 
                                 # set file extraction parameters if required
                                 if extractFileMode != ZEEK_EXTRACTOR_MODE_NONE:
-                                    zeekCmd.append(ZEEK_EXTRACTOR_SCRIPT)
+                                    zeekScripts.append(ZEEK_EXTRACTOR_SCRIPT)
                                     if extractFileMode == ZEEK_EXTRACTOR_MODE_INTERESTING:
-                                        zeekCmd.append(ZEEK_EXTRACTOR_SCRIPT_INTERESTING)
+                                        zeekScripts.append(ZEEK_EXTRACTOR_SCRIPT_INTERESTING)
                                         extractFileMode = ZEEK_EXTRACTOR_MODE_MAPPED
 
                                 # execute zeek with the cwd of tmpLogDir so that's where the logs go, and with the updated file carving environment variable
                                 zeekEnv = os.environ.copy()
                                 zeekEnv[ZEEK_EXTRACTOR_MODE_ENV_VAR] = extractFileMode
-                                retcode, output = run_process(zeekCmd, cwd=tmpLogDir, env=zeekEnv, logger=logger)
+
+                                # large files may be split up by flow and processed by several zeek processes at once
+                                zeekResult = None
+                                if (
+                                    (splitBytes > 0)
+                                    and (splitChunks > 1)
+                                    and (os.path.getsize(fileInfo[FILE_INFO_DICT_NAME]) > splitBytes)
+                                ):
+                                    zeekResult = runZeekSplit(
+                                        zeekBin,
+                                        fileInfo[FILE_INFO_DICT_NAME],
+                                        zeekScripts,
+                                        tmpLogDir,
+                                        zeekEnv,
+                                        splitChunks,
+                                        logger,
+                                    )
+                                if zeekResult is None:
+                                    zeekResult = runZeek(
+                                        zeekBin, fileInfo[FILE_INFO_DICT_NAME], zeekScripts, tmpLogDir, zeekEnv, logger
+                                    )
+                                retcode, output = zeekResult
                                 if retcode == 0:
                                     logger.info(
                                         f"{scriptName}[{workerId}]:\t✅\t{os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}"
@@ -357,25 +555,27 @@ def zeekFileWorker(zeekWorkerArgs):
                                 # make sure log files were generated
                                 logFiles = [logFile for logFile in os.listdir(tmpLogDir) if logFile.endswith('.log')]
                                 if len(logFiles) > 0:
-                                    # tar up the results
-                                    tgzFileName = os.path.join(
-                                        tmpLogDir,
-                                        "{}-{}-{}.tar.gz".format(
-                                            os.path.basename(fileInfo[FILE_INFO_DICT_NAME]),
-                                            '_'.join(fileInfo[FILE_INFO_DICT_TAGS]),
-                                            processTimeUsec,
-                                        ),
-                                    )
-                                    with tarfile.open(
-                                        tgzFileName, mode="w:gz", compresslevel=ZEEK_LOG_COMPRESSION_LEVEL
-                                    ) as tar:
-                                        tar.add(tmpLogDir, arcname=os.path.basename('.'))
-
-                                    # relocate the tarball to the upload directory (do it this way instead of with a shutil.move because of
-                                    # the way Docker volume mounts work, ie. avoid "OSError: [Errno 18] Invalid cross-device link").
-                                    # we don't have to explicitly delete it since this whole directory is about to leave context and be removed
-                                    shutil.copy(tgzFileName, uploadDir)
-                                    logger.debug(f"{scriptName}[{workerId}]:\t⏩\t{tgzFileName} → {uploadDir}")
+                                    # tar up the results straight into the upload directory (rather than tarring them up here
+                                    #   and copying the tarball, which would be an extra pass over the data; a shutil.move
+                                    #   won't work because of the way Docker volume mounts work, ie. "OSError: [Errno 18]
+                                    #   Invalid cross-device link")
+                                    try:
+                                        tgzFileName = archiveZeekLogs(
+                                            tmpLogDir,
+                                            uploadDir,
+                                            "{}-{}-{}".format(
+                                                os.path.basename(fileInfo[FILE_INFO_DICT_NAME]),
+                                                '_'.join(fileInfo[FILE_INFO_DICT_TAGS]),
+                                                processTimeUsec,
+                                            ),
+                                            compressLevel,
+                                            compressThreads,
+                                        )
+                                        logger.debug(f"{scriptName}[{workerId}]:\t⏩\t{tgzFileName}")
+                                    except Exception as e:
+                                        logger.error(
+                                            f"{scriptName}[{workerId}]:\t💥\terror archiving logs for {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}: {e}"
+                                        )
 
                                 else:
                                     # zeek returned no log files (or an error)
@@ -388,6 +588,10 @@ def zeekFileWorker(zeekWorkerArgs):
                                     f"{scriptName}[{workerId}]:\t❗\terror creating temporary directory {tmpLogDir}"
                                 )
 
+        finally:
+            # whether or not it was successful, we're done with this one
+            newFileQueue.ack(queueId)
+
     logger.info(f"{scriptName}[{workerId}]:\tfinished")
 
 
@@ -410,6 +614,7 @@ def suricataFileWorker(suricataWorkerArgs):
         suricataConfig,
         logger,
         debug,
+        maxInFlight,
     ) = (
         suricataWorkerArgs[0],
         suricataWorkerArgs[1],
@@ -422,6 +627,7 @@ def suricataFileWorker(suricataWorkerArgs):
         suricataWorkerArgs[8],
         suricataWorkerArgs[9],
         suricataWorkerArgs[10],
+        suricataWorkerArgs[11],
     )
 
     if not logger:
@@ -431,88 +637,116 @@ def suricataFileWorker(suricataWorkerArgs):
 
     suricata = None
     processFailures = 0
+    # the queue items for files submitted to Suricata, which aren't acknowledged until Suricata has finished them
+    submittedQueueIds = {}
 
     # loop forever, or until we're told to shut down
     while not shuttingDown:
         if suricata:
-            try:
-                # pull an item from the queue of files that need to be processed
-                fileInfo = newFileQueue.popleft()
-            except IndexError:
+            # see if Suricata has finished with any of the files we've submitted to it
+            for submission in suricata.update_completed():
+                for submittedQueueId in submittedQueueIds.pop(submission.pcap_file, []):
+                    newFileQueue.ack(submittedQueueId)
+                logger.info(
+                    f"{scriptName}[{workerId}]:\t🏁\t{os.path.basename(submission.pcap_file)} in {submission.latency:.1f} seconds {suricata.stats()}"
+                )
+
+            # leave files in our queue rather than flooding Suricata's if it already has all it can handle
+            if not suricata.has_capacity():
                 time.sleep(1)
                 continue
 
-            if isinstance(fileInfo, dict) and (FILE_INFO_DICT_NAME in fileInfo):
-                # Suricata this PCAP if it's tagged "AUTOSURICATA" or if the global autoSuricata flag is turned on.
-                # However, skip "live" PCAPs Malcolm is capturing and rotating through for Arkime capture,
-                # as Suricata now does its own network capture in Malcolm standalone mode.
-                if (
-                    autoSuricata
-                    or (
-                        (FILE_INFO_DICT_TAGS in fileInfo) and SURICATA_AUTOSURICATA_TAG in fileInfo[FILE_INFO_DICT_TAGS]
-                    )
-                ) and (
-                    forceSuricata
-                    or (
-                        not any(
-                            os.path.basename(fileInfo[FILE_INFO_DICT_NAME]).startswith(prefix)
-                            for prefix in ('mnetsniff', 'mtcpdump')
-                        )
-                    )
-                ):
-                    if pcapBaseDir and os.path.isdir(pcapBaseDir):
-                        fileInfo[FILE_INFO_DICT_NAME] = os.path.join(pcapBaseDir, fileInfo[FILE_INFO_DICT_NAME])
+            # pull an item from the queue of files that need to be processed, waiting for one to become available
+            queueItem = newFileQueue.get(timeout=1)
+            if queueItem is None:
+                continue
+            queueId, fileInfo = queueItem
+            submitted = False
 
-                    if os.path.isfile(fileInfo[FILE_INFO_DICT_NAME]):
-                        # finalize tags list
-                        fileInfo[FILE_INFO_DICT_TAGS] = (
-                            [x for x in fileInfo[FILE_INFO_DICT_TAGS] if (x not in TAGS_NOSHOW)]
-                            if ((FILE_INFO_DICT_TAGS in fileInfo) and autoTag)
-                            else list()
+            try:
+                if isinstance(fileInfo, dict) and (FILE_INFO_DICT_NAME in fileInfo):
+                    # Suricata this PCAP if it's tagged "AUTOSURICATA" or if the global autoSuricata flag is turned on.
+                    # However, skip "live" PCAPs Malcolm is capturing and rotating through for Arkime capture,
+                    # as Suricata now does its own network capture in Malcolm standalone mode.
+                    if (
+                        autoSuricata
+                        or (
+                            (FILE_INFO_DICT_TAGS in fileInfo)
+                            and SURICATA_AUTOSURICATA_TAG in fileInfo[FILE_INFO_DICT_TAGS]
                         )
-                        if extraTags and isinstance(extraTags, list):
-                            fileInfo[FILE_INFO_DICT_TAGS].extend(extraTags)
-                        fileInfo[FILE_INFO_DICT_TAGS] = list(dict.fromkeys(fileInfo[FILE_INFO_DICT_TAGS]))
-                        logger.info(f"{scriptName}[{workerId}]:\t🔎\t{fileInfo}")
-
-                        # Create unique output directory for this PCAP's suricata output
-                        processTimeUsec = int(round(time.time() * 1000000))
-                        output_dir = os.path.join(
-                            uploadDir,
-                            f"suricata-{processTimeUsec}-{workerId}-({','.join(fileInfo[FILE_INFO_DICT_TAGS])})",
+                    ) and (
+                        forceSuricata
+                        or (
+                            not any(
+                                os.path.basename(fileInfo[FILE_INFO_DICT_NAME]).startswith(prefix)
+                                for prefix in ('mnetsniff', 'mtcpdump')
+                            )
                         )
-
-                        try:
-                            logger.info(
-                                f"{scriptName}[{workerId}]:\t📥\tSubmitting {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])} to Suricata"
+                    ):
+                        if pcapBaseDir and os.path.isdir(pcapBaseDir):
+                            fileInfo[FILE_INFO_DICT_NAME] = os.path.join(pcapBaseDir, fileInfo[FILE_INFO_DICT_NAME])
+
+                        if os.path.isfile(fileInfo[FILE_INFO_DICT_NAME]):
+                            # finalize tags list
+                            fileInfo[FILE_INFO_DICT_TAGS] = (
+                                [x for x in fileInfo[FILE_INFO_DICT_TAGS] if (x not in TAGS_NOSHOW)]
+                                if ((FILE_INFO_DICT_TAGS in fileInfo) and autoTag)
+                                else list()
+                            )
+                            if extraTags and isinstance(extraTags, list):
+                                fileInfo[FILE_INFO_DICT_TAGS].extend(extraTags)
+                            fileInfo[FILE_INFO_DICT_TAGS] = list(dict.fromkeys(fileInfo[FILE_INFO_DICT_TAGS]))
+                            logger.info(f"{scriptName}[{workerId}]:\t🔎\t{fileInfo}")
+
+                            # Create unique output directory for this PCAP's suricata output
+                            processTimeUsec = int(round(time.time() * 1000000))
+                            output_dir = os.path.join(
+                                uploadDir,
+                                f"suricata-{processTimeUsec}-{workerId}-({','.join(fileInfo[FILE_INFO_DICT_TAGS])})",
                             )
-                            if suricata.process_pcap(
-                                pcap_file=fileInfo[FILE_INFO_DICT_NAME],
-                                output_dir=output_dir,
-                            ):
-                                # suricata over socket mode doesn't let us know when a PCAP file is done processing,
-                                #   so all we do here is submit it and then we'll let filebeat tail the results
-                                #   as long as it needs to
+
+                            try:
                                 logger.info(
-                                    f"{scriptName}[{workerId}]:\t✅\t{os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}"
+                                    f"{scriptName}[{workerId}]:\t📥\tSubmitting {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])} to Suricata"
                                 )
-                                processFailures = 0
+                                if suricata.process_pcap(
+                                    pcap_file=fileInfo[FILE_INFO_DICT_NAME],
+                                    output_dir=output_dir,
+                                ):
+                                    # suricata will process the PCAP asynchronously (we check for its completion above
+                                    #   before pulling more files from the queue, and acknowledge it then) and filebeat
+                                    #   will tail the results as long as it needs to
+                                    submittedQueueIds.setdefault(fileInfo[FILE_INFO_DICT_NAME], []).append(queueId)
+                                    submitted = True
+                                    logger.info(
+                                        f"{scriptName}[{workerId}]:\t✅\t{os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}"
+                                    )
+                                    processFailures = 0
 
-                            else:
+                                else:
+                                    logger.error(
+                                        f"{scriptName}[{workerId}]:\t❌\tFailed to process {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}"
+                                    )
+                                    processFailures = processFailures + 1
+                            except Exception as e:
                                 logger.error(
-                                    f"{scriptName}[{workerId}]:\t❌\tFailed to process {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}"
+                                    f"{scriptName}[{workerId}]:\t💥\tError processing {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}: {e}"
                                 )
                                 processFailures = processFailures + 1
-                        except Exception as e:
-                            logger.error(
-                                f"{scriptName}[{workerId}]:\t💥\tError processing {os.path.basename(fileInfo[FILE_INFO_DICT_NAME])}: {e}"
-                            )
-                            processFailures = processFailures + 1
 
-                        if processFailures > SURICATA_FAILURES_FORCE_RECONNECT:
-                            # force a reconnect the next time we come around the loop
-                            suricata = None
-                            processFailures = 0
+                            if processFailures > SURICATA_FAILURES_FORCE_RECONNECT:
+                                # force a reconnect the next time we come around the loop. we won't be able to tell
+                                #   when Suricata finishes what we've already submitted, so put it back in the queue
+                                suricata = None
+                                processFailures = 0
+                                for submittedQueueId in chain.from_iterable(submittedQueueIds.values()):
+                                    newFileQueue.nack(submittedQueueId)
+                                submittedQueueIds.clear()
+
+            finally:
+                # unless it's waiting on Suricata, whether or not it was successful we're done with this one
+                if not submitted:
+                    newFileQueue.ack(queueId)
 
         else:
             # create a single socket client for this worker
@@ -522,6 +756,7 @@ def suricataFileWorker(suricataWorkerArgs):
                     logger=logger,
                     debug=debug,
                     output_dir=uploadDir,
+                    max_in_flight=maxInFlight,
                 )
             except Exception as e:
                 logger.error(f"Failed to create Suricata socket client, will retry: {e}")
@@ -556,6 +791,7 @@ def main():
     global args
     global pdbFlagged
     global shuttingDown
+    global zeekProcessSemaphore
 
     parser = argparse.ArgumentParser(description=scriptName, add_help=False, usage='{} <arguments>'.format(scriptName))
     parser.add_argument('--verbose', '-v', action='count', default=1, help='Increase verbosity (e.g., -v, -vv, etc.)')
@@ -625,6 +861,60 @@ def main():
         type=str,
         default='',
     )
+    parser.add_argument(
+        '--queue-file',
+        required=False,
+        dest='queueFile',
+        help="Persistent work queue file (default is a hidden subdirectory of --pcap-directory)",
+        metavar='<filename>',
+        type=str,
+        default=os.getenv('PCAP_PIPELINE_QUEUE_FILE', ''),
+    )
+    parser.add_argument(
+        '--queue-max',
+        required=False,
+        dest='queueMax',
+        help="Maximum number of files held in the work queue before applying backpressure (0 for no limit)",
+        metavar='<count>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_QUEUE_MAX', '0')),
+    )
+    parser.add_argument(
+        '--live-threads',
+        dest='liveThreads',
+        help="Additional worker threads reserved for live (rotated) PCAP files",
+        metavar='<count>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_LIVE_THREADS', '0')),
+        required=False,
+    )
+    parser.add_argument(
+        '--bulk-bytes',
+        dest='bulkBytes',
+        help="Uploaded PCAP files larger than this are scheduled in the bulk lane (0 to disable)",
+        metavar='<bytes>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_BULK_BYTES', str(PCAP_QUEUE_BULK_BYTES_DEFAULT))),
+        required=False,
+    )
+    parser.add_argument(
+        '--bulk-threads',
+        dest='bulkThreads',
+        help="Maximum worker threads concurrently processing bulk lane files (default is --threads minus one); if --threads is 1, this many additional workers dedicated to bulk lane files",
+        metavar='<count>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_BULK_THREADS', '0')),
+        required=False,
+    )
+    parser.add_argument(
+        '--aging',
+        dest='agingBytesPerSec',
+        help="Bytes per second of waiting credited to queued files when ordering by size",
+        metavar='<bytes>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_AGING_BYTES_PER_SEC', str(PCAP_QUEUE_AGING_BYTES_PER_SEC_DEFAULT))),
+        required=False,
+    )
     requiredNamed = parser.add_argument_group('required arguments')
     requiredNamed.add_argument(
         '--pcap-directory',
@@ -717,6 +1007,42 @@ def main():
             type=str,
             default=ZEEK_EXTRACTOR_MODE_NONE,
         )
+        parser.add_argument(
+            '--split-bytes',
+            dest='zeekSplitBytes',
+            help="Split PCAP files larger than this by flow and process the chunks concurrently (0 to disable)",
+            metavar='<bytes>',
+            type=int,
+            default=int(os.getenv('ZEEK_PCAP_SPLIT_BYTES', '0')),
+            required=False,
+        )
+        parser.add_argument(
+            '--split-chunks',
+            dest='zeekSplitChunks',
+            help="Number of chunks (and concurrent Zeek processes) for split PCAP files (default is the number of CPUs)",
+            metavar='<count>',
+            type=int,
+            default=int(os.getenv('ZEEK_PCAP_SPLIT_CHUNKS', '0')),
+            required=False,
+        )
+        parser.add_argument(
+            '--compression-level',
+            dest='zeekCompressLevel',
+            help="gzip compression level for Zeek log archives (0 for an uncompressed tarball)",
+            metavar='<0-9>',
+            type=int,
+            default=int(os.getenv('ZEEK_LOG_COMPRESSION_LEVEL', str(ZEEK_LOG_COMPRESSION_LEVEL))),
+            required=False,
+        )
+        parser.add_argument(
+            '--compression-threads',
+            dest='zeekCompressThreads',
+            help="Threads for compressing each Zeek log archive (0 for the number of CPUs)",
+            metavar='<count>',
+            type=int,
+            default=int(os.getenv('ZEEK_LOG_COMPRESSION_THREADS', '1')),
+            required=False,
+        )
         requiredNamed.add_argument(
             '--zeek-directory',
             dest='zeekUploadDir',
@@ -757,6 +1083,15 @@ def main():
             default=False,
             required=False,
         )
+        parser.add_argument(
+            '--max-in-flight',
+            dest='suricataMaxInFlight',
+            help="Maximum PCAP files submitted to Suricata but not yet processed (0 for no limit)",
+            metavar='<count>',
+            type=int,
+            default=int(os.getenv('SURICATA_PCAP_MAX_IN_FLIGHT', '10')),
+            required=False,
+        )
         requiredNamed.add_argument(
             '--suricata-config',
             dest='suricataConfigFile',
@@ -795,6 +1130,15 @@ def main():
     signal.signal(signal.SIGTERM, shutdown_handler)
     signal.signal(signal.SIGUSR1, pdb_handler)
 
+    if processingMode == PCAP_PROCESSING_MODE_ZEEK:
+        if args.zeekSplitChunks <= 0:
+            args.zeekSplitChunks = os.cpu_count() or 1
+        if args.zeekCompressThreads <= 0:
+            args.zeekCompressThreads = os.cpu_count() or 1
+        # clean up any partially-written archives left over from a previous run (their PCAP files
+        #   will be redelivered from the work queue)
+        shutil.rmtree(os.path.join(args.zeekUploadDir, ZEEK_UPLOAD_TMP_DIR), ignore_errors=True)
+
     if args.extraTags is not None:
         args.extraTags = [
             tag for tag in [re.sub(r'[^A-Za-z0-9 ._-]', '', x.strip()) for x in args.extraTags.split(',')] if tag
@@ -809,80 +1153,134 @@ def main():
     # initialize ZeroMQ context and socket(s) to receive filenames and send scan results
     context = zmq.Context()
 
-    # Socket to subscribe to messages on
-    new_files_socket = context.socket(zmq.SUB)
-    new_files_socket.connect(f"tcp://{args.publisherHost}:{PCAP_TOPIC_PORT}")
-    new_files_socket.setsockopt(zmq.SUBSCRIBE, b"")  # All topics
-    new_files_socket.setsockopt(zmq.LINGER, 0)  # All topics
+    # Socket to receive messages on. pcap_watcher journals the files it publishes and keeps sending them to us
+    #   (identified by our processing mode) until we acknowledge them (see PublishedFileJournal)
+    new_files_socket = context.socket(zmq.DEALER)
+    new_files_socket.setsockopt_string(zmq.IDENTITY, processingMode)
+    new_files_socket.setsockopt(zmq.IMMEDIATE, 1)
+    new_files_socket.setsockopt(zmq.LINGER, 0)
     new_files_socket.RCVTIMEO = 1500
-    logging.info(f"{scriptName}:\tsubscribed to topic at {PCAP_TOPIC_PORT}")
-
-    # we'll pull from the topic in the main thread and queue them for processing by the worker threads
-    newFileQueue = deque()
+    new_files_socket.connect(f"tcp://{args.publisherHost}:{PCAP_TOPIC_PORT}")
+    newFilesSession = os.urandom(8).hex()
+    logging.info(f"{scriptName}:\tconnected to publisher at {PCAP_TOPIC_PORT}")
+
+    # we'll pull from the topic in the main thread and queue them for processing by the worker threads. this
+    #   queue is journaled to disk so that files which haven't been acknowledged by a worker (e.g., because
+    #   the container was restarted) are redelivered the next time we start up
+    if not args.queueFile:
+        args.queueFile = os.path.join(args.pcapBaseDir, PCAP_QUEUE_DIR_DEFAULT, f'{processingMode}.db')
+    #   files are scheduled by lane (live, then small uploads, then bulk uploads) and smallest first within each
+    #   lane, and the bulk lane is capped so that there is always at least one general worker free for the other
+    #   lanes. with only one general worker there's nothing to spare, so it serves every lane in turn unless
+    #   --bulk-threads asks for bulk worker(s) of their own (except for suricata, which only has the one thread
+    #   submitting files to its socket anyway)
+    generalBulkThreads = min(args.bulkThreads if (args.bulkThreads > 0) else args.threads - 1, args.threads - 1)
+    dedicatedBulkThreads = (
+        0 if (generalBulkThreads > 0) or (processingMode == PCAP_PROCESSING_MODE_SURICATA) else args.bulkThreads
+    )
+    # splitting PCAP files multiplies the zeek processes each worker runs, so limit how many run at once
+    #   overall to the larger of the number of workers and the number of chunks per split file
+    if processingMode == PCAP_PROCESSING_MODE_ZEEK:
+        zeekProcessSemaphore = BoundedSemaphore(
+            max(args.threads + args.liveThreads + dedicatedBulkThreads, args.zeekSplitChunks)
+        )
+    newFileQueue = PersistentFileQueue(
+        args.queueFile,
+        maxDepth=args.queueMax,
+        laneCaps={PCAP_QUEUE_LANE_BULK: generalBulkThreads} if (generalBulkThreads > 0) else None,
+        agingBytesPerSec=args.agingBytesPerSec,
+    )
+    logging.info(
+        f"{scriptName}:\tqueue {args.queueFile} holds {newFileQueue.depth()} files ({newFileQueue.redelivered} redelivered)"
+    )
 
     # start worker threads which will pull filenames/tags to be processed by capture
-    if processingMode == PCAP_PROCESSING_MODE_ARKIME:
-        ThreadPool(
-            args.threads,
-            arkimeCaptureFileWorker,
-            (
-                [
-                    newFileQueue,
-                    args.pcapBaseDir,
-                    args.executable,
-                    args.nodeName,
-                    args.nodeHost,
-                    args.autoArkime,
-                    args.forceArkime,
-                    args.extraTags,
-                    args.autoTag,
-                    args.notLocked,
-                    logging,
-                    args.verbose <= logging.DEBUG,
-                ],
-            ),
-        )
-    elif processingMode == PCAP_PROCESSING_MODE_ZEEK:
-        ThreadPool(
-            args.threads,
-            zeekFileWorker,
-            (
-                [
-                    newFileQueue,
-                    args.pcapBaseDir,
-                    args.executable,
-                    args.autoZeek,
-                    args.forceZeek,
-                    args.extraTags,
-                    args.autoTag,
-                    args.zeekUploadDir,
-                    args.zeekExtractFileMode,
-                    logging,
-                    args.verbose <= logging.DEBUG,
-                ],
-            ),
-        )
-    elif processingMode == PCAP_PROCESSING_MODE_SURICATA:
-        ThreadPool(
-            # threading is done inside of Suricata in socket mode, so just use 1 thread to submit PCAP
-            1,
-            suricataFileWorker,
-            (
-                [
-                    newFileQueue,
-                    args.pcapBaseDir,
-                    args.autoSuricata,
-                    args.forceSuricata,
-                    args.suricataSocketPath,
-                    args.extraTags,
-                    args.autoTag,
-                    args.suricataUploadDir,
-                    args.suricataConfigFile,
-                    logging,
-                    args.verbose <= logging.DEBUG,
-                ],
-            ),
-        )
+    #   - args.threads workers serve every lane, highest priority first (subject to the per-lane caps)
+    #   - args.liveThreads additional workers (if any) are reserved for the live lane, so that freshly
+    #       rotated live PCAP doesn't have to wait behind long-running uploads
+    #   - if the general workers can't spare any for the bulk lane, dedicatedBulkThreads additional
+    #       workers (if any) handle it instead
+    generalQueue = (
+        newFileQueue.view([PCAP_QUEUE_LANE_LIVE, PCAP_QUEUE_LANE_SMALL]) if dedicatedBulkThreads else newFileQueue
+    )
+    for workerQueue, workerCount in (
+        (generalQueue, args.threads),
+        (newFileQueue.view([PCAP_QUEUE_LANE_LIVE]), args.liveThreads),
+        (newFileQueue.view([PCAP_QUEUE_LANE_BULK]), dedicatedBulkThreads),
+    ):
+        if workerCount <= 0:
+            continue
+        if processingMode == PCAP_PROCESSING_MODE_ARKIME:
+            ThreadPool(
+                workerCount,
+                arkimeCaptureFileWorker,
+                (
+                    [
+                        workerQueue,
+                        args.pcapBaseDir,
+                        args.executable,
+                        args.nodeName,
+                        args.nodeHost,
+                        args.autoArkime,
+                        args.forceArkime,
+                        args.extraTags,
+                        args.autoTag,
+                        args.notLocked,
+                        logging,
+                        args.verbose <= logging.DEBUG,
+                    ],
+                ),
+            )
+        elif processingMode == PCAP_PROCESSING_MODE_ZEEK:
+            ThreadPool(
+                workerCount,
+                zeekFileWorker,
+                (
+                    [
+                        workerQueue,
+                        args.pcapBaseDir,
+                        args.executable,
+                        args.autoZeek,
+                        args.forceZeek,
+                        args.extraTags,
+                        args.autoTag,
+                        args.zeekUploadDir,
+                        args.zeekExtractFileMode,
+                        logging,
+                        args.verbose <= logging.DEBUG,
+                        args.zeekSplitBytes,
+                        args.zeekSplitChunks,
+                        args.zeekCompressLevel,
+                        args.zeekCompressThreads,
+                    ],
+                ),
+            )
+        elif (processingMode == PCAP_PROCESSING_MODE_SURICATA) and (workerQueue is generalQueue):
+            ThreadPool(
+                # threading is done inside of Suricata in socket mode, so just use 1 thread to submit PCAP
+                1,
+                suricataFileWorker,
+                (
+                    [
+                        workerQueue,
+                        args.pcapBaseDir,
+                        args.autoSuricata,
+                        args.forceSuricata,
+                        args.suricataSocketPath,
+                        args.extraTags,
+                        args.autoTag,
+                        args.suricataUploadDir,
+                        args.suricataConfigFile,
+                        logging,
+                        args.verbose <= logging.DEBUG,
+                        args.suricataMaxInFlight,
+                    ],
+                ),
+            )
+
+    # the journal epoch and ID of the last message we queued, to ignore any the publisher sends again
+    lastMessage = (None, 0)
+    lastHeartbeat = 0
 
     while not shuttingDown:
         # for debugging
@@ -890,20 +1288,72 @@ def main():
             pdbFlagged = False
             breakpoint()
 
-        # accept a file info dict from new_files_socket as json
+        # let the publisher know we're here (and, if we've restarted, that it should start over with what
+        #   we haven't acknowledged)
+        if time.time() - lastHeartbeat >= PCAP_JOURNAL_HEARTBEAT_SEC:
+            try:
+                new_files_socket.send_string(json.dumps({'session': newFilesSession}), flags=zmq.NOBLOCK)
+            except zmq.Again:
+                # not connected to the publisher at the moment
+                pass
+            lastHeartbeat = time.time()
+
+        # accept a journaled file info dict from new_files_socket as json
         try:
-            fileInfo = json.loads(new_files_socket.recv_string())
+            message = json.loads(new_files_socket.recv_string())
         except zmq.Again:
             # no file received due to timeout, we'll go around and try again
-            fileInfo = None
+            message = None
+        if (not isinstance(message, dict)) or (message.get('session') != newFilesSession):
+            # sent before the publisher heard from us, it'll send it again
+            continue
+        messageEpoch, messageId, fileInfo = message.get('epoch'), message.get('id', 0), message.get('info')
+
+        queued = False
+        if (messageEpoch == lastMessage[0]) and (messageId <= lastMessage[1]):
+            # we've already queued this one
+            queued = True
+
+        elif (messageEpoch == lastMessage[0]) and (messageId > lastMessage[1] + 1):
+            # we missed something (e.g., while reconnecting), so wait for the publisher to send it again
+            #   rather than acknowledging past it
+            continue
+
+        elif isinstance(fileInfo, dict) and (FILE_INFO_DICT_NAME in fileInfo):
+            # queue for the workers to process with capture (blocking if the queue is full)
+            queueLane = queueLaneForFile(fileInfo, args.bulkBytes)
+            while (not shuttingDown) and (
+                newFileQueue.put(
+                    fileInfo,
+                    lane=queueLane,
+                    size=fileInfo.get(FILE_INFO_DICT_SIZE, 0),
+                    timeout=1,
+                )
+                is None
+            ):
+                logging.debug(f"{scriptName}:\t🕑\t{fileInfo}")
+            queued = not shuttingDown
+            if queued:
+                logging.info(f"{scriptName}:\t📨\t{PCAP_QUEUE_LANE_NAMES[queueLane]}\t{fileInfo}")
 
-        if isinstance(fileInfo, dict) and (FILE_INFO_DICT_NAME in fileInfo):
-            # queue for the workers to process with capture
-            newFileQueue.append(fileInfo)
-            logging.info(f"{scriptName}:\t📨\t{fileInfo}")
+        else:
+            # nothing we can do with this one, but acknowledge it so it isn't sent again
+            queued = True
+
+        if queued:
+            if (messageEpoch != lastMessage[0]) or (messageId > lastMessage[1]):
+                lastMessage = (messageEpoch, messageId)
+            try:
+                new_files_socket.send_string(
+                    json.dumps({'session': newFilesSession, 'ack': messageId}), flags=zmq.NOBLOCK
+                )
+            except zmq.Again:
+                # the publisher will send it again, and we'll acknowledge it then
+                pass
 
     # graceful shutdown
     logging.info(f"{scriptName}: shutting down...")
+    newFileQueue.close()
     time.sleep(5)
 
 
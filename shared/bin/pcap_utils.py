@@ -3,7 +3,16 @@
 
 # Copyright (c) 2025 Battelle Energy Alliance, LLC.  All rights reserved.
 
+import json
+import os
 import re
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from malcolm_utils import isnetworkfilesystem
 
 ###################################################################################################
 PCAP_TOPIC_PORT = 30441
@@ -27,3 +36,574 @@ def tags_from_filename(filespec):
     # tags to ignore explicitly
     regex = re.compile(r'^(\d+|p?cap|dmp|log|bro|zeek|suricata|m?tcpdump|m?netsniff)$', re.IGNORECASE)
     return list(filter(lambda i: not regex.search(i), map(str.strip, filter(None, re.split(tagSplitterRe, filespec)))))
+
+
+###################################################################################################
+# split a PCAP or PCAPNG file into chunkCount files by hashing each packet's (direction-independent)
+#   IP address pair and protocol, so that all of the packets of a flow end up in the same chunk. Ports
+#   aren't used, as they aren't in every fragment of a fragmented datagram, and packets that aren't IP
+#   go into the first chunk. Returns the list of chunk files containing packets, or None if the file's
+#   format or link type isn't one we know how to parse.
+PCAP_SPLIT_BUFFER_SIZE = 4 * 1024 * 1024
+
+# link types whose headers we can get past to the IP layer (see https://www.tcpdump.org/linktypes.html)
+PCAP_LINKTYPE_NULL = 0
+PCAP_LINKTYPE_ETHERNET = 1
+PCAP_LINKTYPE_RAW = 101
+PCAP_LINKTYPE_LINUX_SLL = 113
+PCAP_LINKTYPE_IPV4 = 228
+PCAP_LINKTYPE_IPV6 = 229
+PCAP_LINKTYPE_LINUX_SLL2 = 276
+PCAP_SPLIT_LINKTYPES = (
+    PCAP_LINKTYPE_NULL,
+    PCAP_LINKTYPE_ETHERNET,
+    PCAP_LINKTYPE_RAW,
+    PCAP_LINKTYPE_LINUX_SLL,
+    PCAP_LINKTYPE_IPV4,
+    PCAP_LINKTYPE_IPV6,
+    PCAP_LINKTYPE_LINUX_SLL2,
+)
+
+PCAPNG_BLOCK_SHB = 0x0A0D0D0A
+PCAPNG_BLOCK_IDB = 0x00000001
+PCAPNG_BLOCK_PB = 0x00000002
+PCAPNG_BLOCK_SPB = 0x00000003
+PCAPNG_BLOCK_EPB = 0x00000006
+
+PCAP_IPV6_EXTENSION_HEADERS = (0, 43, 44, 51, 60)
+
+
+def _ip_flow_hash(data, offset):
+    if len(data) <= offset:
+        return None
+    version = data[offset] >> 4
+    if (version == 4) and (len(data) >= offset + 20):
+        proto = data[offset + 9]
+        a, b = data[offset + 12 : offset + 16], data[offset + 16 : offset + 20]
+    elif (version == 6) and (len(data) >= offset + 40):
+        proto = data[offset + 6]
+        a, b = data[offset + 8 : offset + 24], data[offset + 24 : offset + 40]
+        # skip over extension headers (hop-by-hop, routing, fragment, authentication, destination) to get
+        #   to the transport protocol, which is there even in fragments that don't carry the transport header
+        nextHeader = offset + 40
+        while (proto in PCAP_IPV6_EXTENSION_HEADERS) and (len(data) >= nextHeader + 8):
+            if proto == 44:
+                extLen = 8
+            elif proto == 51:
+                extLen = (data[nextHeader + 1] + 2) * 4
+            else:
+                extLen = (data[nextHeader + 1] + 1) * 8
+            proto, nextHeader = data[nextHeader], nextHeader + extLen
+    else:
+        return None
+    if a > b:
+        a, b = b, a
+    return zlib.crc32(a + b + bytes((proto,)))
+
+
+def _packet_flow_hash(linkType, data):
+    if linkType == PCAP_LINKTYPE_ETHERNET:
+        offset = 12
+        etherType = data[offset : offset + 2]
+        # skip over 802.1Q/802.1ad VLAN tags
+        while etherType in (b'\x81\x00', b'\x88\xa8', b'\x91\x00'):
+            offset += 4
+            etherType = data[offset : offset + 2]
+        offset += 2
+    elif linkType == PCAP_LINKTYPE_LINUX_SLL:
+        etherType, offset = data[14:16], 16
+    elif linkType == PCAP_LINKTYPE_LINUX_SLL2:
+        etherType, offset = data[0:2], 20
+    elif linkType == PCAP_LINKTYPE_NULL:
+        # the address family is in the capturing host's byte order, but IPv4 (2) and the various
+        #   IPv6 values all fit in a byte and we just look at the IP version nibble anyway
+        etherType, offset = None, 4
+    elif linkType in (PCAP_LINKTYPE_RAW, PCAP_LINKTYPE_IPV4, PCAP_LINKTYPE_IPV6):
+        etherType, offset = None, 0
+    else:
+        return None
+    if (etherType is not None) and (etherType not in (b'\x08\x00', b'\x86\xdd')):
+        return None
+    return _ip_flow_hash(data, offset)
+
+
+def split_pcap_by_flow(pcapFile, outputDir, chunkCount):
+    chunkCount = max(1, chunkCount)
+    with open(pcapFile, 'rb', buffering=PCAP_SPLIT_BUFFER_SIZE) as f:
+        header = f.read(24)
+        if len(header) < 24:
+            return None
+        magic = header[:4]
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            endian, isNg = '<', False
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            endian, isNg = '>', False
+        elif magic == b'\x0a\x0d\x0d\x0a':
+            endian, isNg = None, True
+        else:
+            return None
+
+        if (not isNg) and ((struct.unpack(endian + 'I', header[20:24])[0] & 0x0FFFFFFF) not in PCAP_SPLIT_LINKTYPES):
+            return None
+
+        os.makedirs(outputDir, exist_ok=True)
+        baseName, ext = os.path.splitext(os.path.basename(pcapFile))
+        chunkFiles = [os.path.join(outputDir, f'{baseName}.{i}{ext if ext else ".pcap"}') for i in range(chunkCount)]
+        packetCounts = [0] * chunkCount
+        outs = [open(x, 'wb', buffering=PCAP_SPLIT_BUFFER_SIZE) for x in chunkFiles]
+        try:
+            if not isNg:
+                linkType = struct.unpack(endian + 'I', header[20:24])[0] & 0x0FFFFFFF
+                recordHeader = struct.Struct(endian + 'IIII')
+                for out in outs:
+                    out.write(header)
+                while True:
+                    record = f.read(16)
+                    if len(record) < 16:
+                        break
+                    data = f.read(recordHeader.unpack(record)[2])
+                    flowHash = _packet_flow_hash(linkType, data)
+                    idx = 0 if flowHash is None else flowHash % chunkCount
+                    outs[idx].write(record)
+                    outs[idx].write(data)
+                    packetCounts[idx] += 1
+
+            else:
+                f.seek(0)
+                linkTypes = []
+                while True:
+                    blockHeader = f.read(8)
+                    if len(blockHeader) < 8:
+                        break
+                    if struct.unpack('<I', blockHeader[0:4])[0] == PCAPNG_BLOCK_SHB:
+                        # new section, which may have a different byte order and its own set of interfaces
+                        byteOrder = f.read(4)
+                        endian = '<' if byteOrder == b'\x4d\x3c\x2b\x1a' else '>'
+                        blockLen = struct.unpack(endian + 'I', blockHeader[4:8])[0]
+                        block = blockHeader + byteOrder + f.read(blockLen - 12)
+                        linkTypes = []
+                    else:
+                        blockLen = struct.unpack(endian + 'I', blockHeader[4:8])[0]
+                        block = blockHeader + f.read(blockLen - 8)
+                    if len(block) < blockLen:
+                        break
+                    blockType = struct.unpack(endian + 'I', block[0:4])[0]
+                    data = None
+                    if blockType == PCAPNG_BLOCK_IDB:
+                        linkTypes.append(struct.unpack(endian + 'H', block[8:10])[0])
+                    elif blockType == PCAPNG_BLOCK_EPB:
+                        ifaceId, capLen = (
+                            struct.unpack(endian + 'I', block[8:12])[0],
+                            struct.unpack(endian + 'I', block[20:24])[0],
+                        )
+                        data = block[28 : 28 + capLen]
+                    elif blockType == PCAPNG_BLOCK_PB:
+                        ifaceId, capLen = (
+                            struct.unpack(endian + 'H', block[8:10])[0],
+                            struct.unpack(endian + 'I', block[20:24])[0],
+                        )
+                        data = block[28 : 28 + capLen]
+                    elif blockType == PCAPNG_BLOCK_SPB:
+                        # the captured length is the original length, unless that was truncated to fit the block
+                        ifaceId, capLen = 0, min(struct.unpack(endian + 'I', block[8:12])[0], blockLen - 16)
+                        data = block[12 : 12 + capLen]
+                    if data is None:
+                        # section headers, interface descriptions, name resolution, etc. go to every chunk
+                        for out in outs:
+                            out.write(block)
+                    else:
+                        flowHash = _packet_flow_hash(linkTypes[ifaceId], data) if (ifaceId < len(linkTypes)) else None
+                        idx = 0 if flowHash is None else flowHash % chunkCount
+                        outs[idx].write(block)
+                        packetCounts[idx] += 1
+
+        finally:
+            for out in outs:
+                out.close()
+
+    for idx, chunkFile in enumerate(chunkFiles):
+        if packetCounts[idx] == 0:
+            os.unlink(chunkFile)
+    return [chunkFile for idx, chunkFile in enumerate(chunkFiles) if packetCounts[idx] > 0]
+
+
+###################################################################################################
+# the pipeline's SQLite databases default to hidden directories alongside the PCAP files, which may be on
+#   a network filesystem. WAL mode relies on shared memory that those can't provide, so fall back to a
+#   rollback journal there
+def sqlite_journal_mode(path):
+    return 'DELETE' if (path and (path != ':memory:') and isnetworkfilesystem(path)) else 'WAL'
+
+
+###################################################################################################
+# a disk-backed (SQLite) queue of file info dicts for the PCAP processors. Items are leased by get()
+#   and remain in the journal until they are ack()'ed by the consumer that processed them; anything
+#   still leased when the process dies is put back up for delivery the next time the queue is opened.
+#   put() blocks (backpressure) while the queue holds maxDepth items, and get() blocks on a condition
+#   variable until an item is available.
+# Items are put into numbered lanes (lower numbers are higher priority). get() serves the highest
+#   priority lane which has something pending and which isn't already at its concurrency cap (in
+#   laneCaps, 0 meaning unlimited), and within a lane serves the smallest file first, crediting each
+#   item agingBytesPerSec for every second it has been waiting so big files aren't starved forever.
+PCAP_QUEUE_STATE_PENDING = 0
+PCAP_QUEUE_STATE_LEASED = 1
+
+PCAP_QUEUE_LANE_LIVE = 0
+PCAP_QUEUE_LANE_SMALL = 1
+PCAP_QUEUE_LANE_BULK = 2
+PCAP_QUEUE_LANE_NAMES = {
+    PCAP_QUEUE_LANE_LIVE: 'live',
+    PCAP_QUEUE_LANE_SMALL: 'small',
+    PCAP_QUEUE_LANE_BULK: 'bulk',
+}
+
+
+class PersistentFileQueue:
+    def __init__(self, path, maxDepth=0, laneCaps=None, agingBytesPerSec=0):
+        self.path = path
+        self.maxDepth = maxDepth
+        self.laneCaps = laneCaps if laneCaps else {}
+        self.agingBytesPerSec = agingBytesPerSec
+        self.closed = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        if path and (path != ':memory:'):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path if path else ':memory:', check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute(f'PRAGMA journal_mode={sqlite_journal_mode(path)}')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS queue ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'info TEXT NOT NULL, '
+                'state INTEGER NOT NULL DEFAULT 0, '
+                'enqueued REAL NOT NULL, '
+                'leased REAL, '
+                'lane INTEGER NOT NULL DEFAULT 0, '
+                'size INTEGER NOT NULL DEFAULT 0)'
+            )
+            # journals created before lanes existed just get everything put in lane 0
+            columns = [x[1] for x in self.conn.execute('PRAGMA table_info(queue)').fetchall()]
+            for column in ('lane', 'size'):
+                if column not in columns:
+                    self.conn.execute(f'ALTER TABLE queue ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS queue_state ON queue (state, id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS queue_lane ON queue (state, lane, size)')
+            # anything left leased by a previous run was never acknowledged, so redeliver it
+            self.redelivered = self.conn.execute(
+                'UPDATE queue SET state = ?, leased = NULL WHERE state = ?',
+                (PCAP_QUEUE_STATE_PENDING, PCAP_QUEUE_STATE_LEASED),
+            ).rowcount
+
+    def _depth(self):
+        return self.conn.execute('SELECT COUNT(*) FROM queue').fetchone()[0]
+
+    def depth(self):
+        with self.lock:
+            return self._depth()
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM queue WHERE state = ?', (PCAP_QUEUE_STATE_PENDING,)
+            ).fetchone()[0]
+
+    def pendingByLane(self):
+        with self.lock:
+            return dict(
+                self.conn.execute(
+                    'SELECT lane, COUNT(*) FROM queue WHERE state = ? GROUP BY lane', (PCAP_QUEUE_STATE_PENDING,)
+                ).fetchall()
+            )
+
+    def leasedByLane(self):
+        with self.lock:
+            return self._leasedByLane()
+
+    def _leasedByLane(self):
+        return dict(
+            self.conn.execute(
+                'SELECT lane, COUNT(*) FROM queue WHERE state = ? GROUP BY lane', (PCAP_QUEUE_STATE_LEASED,)
+            ).fetchall()
+        )
+
+    # append a file info dict to a lane, blocking while the queue is full. returns the new item's ID,
+    #   or None if the timeout expired (or the queue was closed) before there was room
+    def put(self, fileInfo, lane=0, size=0, timeout=None):
+        with self.cond:
+            if (self.maxDepth > 0) and not self.cond.wait_for(
+                lambda: self.closed or (self._depth() < self.maxDepth), timeout=timeout
+            ):
+                return None
+            if self.closed:
+                return None
+            queueId = self.conn.execute(
+                'INSERT INTO queue (info, state, enqueued, lane, size) VALUES (?, ?, ?, ?, ?)',
+                (json.dumps(fileInfo), PCAP_QUEUE_STATE_PENDING, time.time(), lane, size),
+            ).lastrowid
+            self.cond.notify_all()
+            return queueId
+
+    # lease the next pending item (optionally only from the given lanes), blocking until one is available.
+    #   returns (id, fileInfo), or None if the timeout expired (or the queue was closed) before anything showed up
+    def get(self, timeout=None, lanes=None):
+        with self.cond:
+            row = None
+
+            def _next():
+                nonlocal row
+                leased = self._leasedByLane()
+                capped = [lane for lane, cap in self.laneCaps.items() if (cap > 0) and (leased.get(lane, 0) >= cap)]
+                query = 'SELECT id, info FROM queue WHERE state = ?'
+                params = [PCAP_QUEUE_STATE_PENDING]
+                if capped:
+                    query += f" AND lane NOT IN ({','.join('?' * len(capped))})"
+                    params.extend(capped)
+                if lanes:
+                    query += f" AND lane IN ({','.join('?' * len(lanes))})"
+                    params.extend(lanes)
+                query += ' ORDER BY lane, size - ((? - enqueued) * ?), id LIMIT 1'
+                params.extend([time.time(), self.agingBytesPerSec])
+                row = self.conn.execute(query, params).fetchone()
+                return self.closed or (row is not None)
+
+            if (not self.cond.wait_for(_next, timeout=timeout)) or (row is None):
+                return None
+            self.conn.execute(
+                'UPDATE queue SET state = ?, leased = ? WHERE id = ?', (PCAP_QUEUE_STATE_LEASED, time.time(), row[0])
+            )
+            return row[0], json.loads(row[1])
+
+    # the consumer is done with this item (successfully or not), remove it from the journal
+    def ack(self, queueId):
+        with self.cond:
+            self.conn.execute('DELETE FROM queue WHERE id = ?', (queueId,))
+            self.cond.notify_all()
+
+    # the consumer couldn't handle this item right now, make it available for delivery again
+    def nack(self, queueId):
+        with self.cond:
+            self.conn.execute(
+                'UPDATE queue SET state = ?, leased = NULL WHERE id = ?', (PCAP_QUEUE_STATE_PENDING, queueId)
+            )
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # a view of this queue whose get() only serves items from certain lanes
+    def view(self, lanes):
+        return PersistentFileQueueView(self, lanes)
+
+
+class PersistentFileQueueView:
+    def __init__(self, queue, lanes):
+        self.queue = queue
+        self.lanes = list(lanes)
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout, lanes=self.lanes)
+
+    def ack(self, queueId):
+        self.queue.ack(queueId)
+
+    def nack(self, queueId):
+        self.queue.nack(queueId)
+
+
+###################################################################################################
+# A persistent (sqlite3) journal of the file info dicts pcap_watcher publishes on PCAP_TOPIC_PORT, so
+#   that a processor which isn't connected (e.g., while it's restarting) when a file is published still
+#   gets it once it's back. Each processor (consumer) acknowledges the messages it has queued, in order,
+#   and the journal keeps the highest ID each consumer has acknowledged. Messages are pruned once every
+#   consumer has acknowledged them, or after PCAP_JOURNAL_RETAIN_SEC regardless, and consumers which
+#   haven't been heard from in that long are forgotten.
+# The journal's epoch is generated when it's created, so consumers can tell when the message IDs they've
+#   seen so far no longer mean anything (i.e., the journal was deleted and started over).
+# Messages and acknowledgements travel over ROUTER (pcap_watcher) / DEALER (processor) sockets:
+#   - the processor sends {"session": <random per process>} every PCAP_JOURNAL_HEARTBEAT_SEC, and
+#     {"session": ..., "ack": <id>} for each message it has queued
+#   - pcap_watcher sends {"session": ..., "epoch": ..., "id": <id>, "info": <file info dict>} for up to
+#     PCAP_JOURNAL_WINDOW unacknowledged messages, starting over from the consumer's acknowledged ID when it
+#     shows up with a new session or hasn't acknowledged anything for PCAP_JOURNAL_RESEND_SEC
+#   - the processor only queues (and acknowledges) messages for its own session which follow the last one
+#     it queued, so nothing is skipped if some were lost while (re)connecting
+PCAP_JOURNAL_RETAIN_SEC = 7 * 24 * 60 * 60
+PCAP_JOURNAL_HEARTBEAT_SEC = 5
+PCAP_JOURNAL_RESEND_SEC = 60
+PCAP_JOURNAL_WINDOW = 100
+
+
+class PublishedFileJournal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path and (path != ':memory:'):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path if path else ':memory:', check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute(f'PRAGMA journal_mode={sqlite_journal_mode(path)}')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'info TEXT NOT NULL, '
+                'published REAL NOT NULL)'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS consumers (name TEXT PRIMARY KEY, acked INTEGER NOT NULL, seen REAL NOT NULL)'
+            )
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.conn.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)', ('epoch', os.urandom(8).hex()))
+            self.epoch = self.conn.execute('SELECT value FROM meta WHERE key = ?', ('epoch',)).fetchone()[0]
+
+    def depth(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    # record a file info dict to be published, returning its message ID
+    def append(self, fileInfo):
+        with self.lock:
+            return self.conn.execute(
+                'INSERT INTO messages (info, published) VALUES (?, ?)', (json.dumps(fileInfo), time.time())
+            ).lastrowid
+
+    # up to limit (id, fileInfo) messages following messageId, oldest first
+    def after(self, messageId, limit):
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, info FROM messages WHERE id > ? ORDER BY id LIMIT ?', (messageId, limit)
+            ).fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    # the highest message ID consumer has acknowledged (0 for a consumer we haven't heard from before)
+    def acked(self, consumer):
+        with self.lock:
+            row = self.conn.execute('SELECT acked FROM consumers WHERE name = ?', (consumer,)).fetchone()
+        return row[0] if row else 0
+
+    # record that consumer is still around and has acknowledged everything up to (and including) messageId
+    def ack(self, consumer, messageId):
+        with self.lock:
+            self.conn.execute(
+                'INSERT INTO consumers (name, acked, seen) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET acked = MAX(acked, excluded.acked), seen = excluded.seen',
+                (consumer, messageId, time.time()),
+            )
+
+    # remove consumers we haven't heard from and messages nobody needs anymore, returning the number of
+    #   messages removed
+    def prune(self):
+        cutoff = time.time() - PCAP_JOURNAL_RETAIN_SEC
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.execute('DELETE FROM consumers WHERE seen < ?', (cutoff,))
+                pruned = self.conn.execute('DELETE FROM messages WHERE published < ?', (cutoff,)).rowcount
+                row = self.conn.execute('SELECT MIN(acked) FROM consumers').fetchone()
+                if row and (row[0] is not None):
+                    pruned += self.conn.execute('DELETE FROM messages WHERE id <= ?', (row[0],)).rowcount
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return pruned
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+###################################################################################################
+# A persistent (sqlite3) index of the PCAP files Arkime has already processed (copied from its
+#   "arkime_files" index), so that pcap_watcher can check for duplicates locally rather than running
+#   a leading-wildcard query against the files index for every new file. As with those queries, a
+#   file is a duplicate if Arkime has a file for the same node with the same size whose name ends
+#   with the file's path relative to the watched directory.
+# Each node's sync watermark is the lowest Arkime file number ("num") which still needs to be (re)read.
+#   A full sync removes that node's files which weren't seen since it started (i.e., which Arkime has
+#   since expired).
+class ProcessedFileIndex:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        if path and (path != ':memory:'):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path if path else ':memory:', check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute(f'PRAGMA journal_mode={sqlite_journal_mode(path)}')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS processed ('
+                'node TEXT NOT NULL, '
+                'name TEXT NOT NULL, '
+                'basename TEXT NOT NULL, '
+                'size INTEGER NOT NULL, '
+                'seen REAL NOT NULL, '
+                'PRIMARY KEY (node, name, size))'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS processed_basename ON processed (node, basename, size)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS sync (node TEXT PRIMARY KEY, num INTEGER NOT NULL, synced REAL NOT NULL)'
+            )
+
+    def count(self, node):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM processed WHERE node = ?', (node,)).fetchone()[0]
+
+    def contains(self, node, relativePath, size):
+        suffix = os.path.sep + relativePath
+        with self.lock:
+            names = self.conn.execute(
+                'SELECT name FROM processed WHERE node = ? AND basename = ? AND size = ?',
+                (node, os.path.basename(relativePath), size),
+            ).fetchall()
+        return any(name.endswith(suffix) for (name,) in names)
+
+    # record (name, size) tuples for files Arkime has processed
+    def add(self, node, files):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO processed (node, name, basename, size, seen) VALUES (?, ?, ?, ?, ?)',
+                    [(node, name, os.path.basename(name), size, now) for name, size in files],
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    # the lowest Arkime file number still to be read for node, and the time its last full sync started (0 for never)
+    def watermark(self, node):
+        with self.lock:
+            row = self.conn.execute('SELECT num, synced FROM sync WHERE node = ?', (node,)).fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    # record the end of a sync for node. for a full sync (fullSyncStarted being when it began), forget
+    #   any files which weren't seen by it
+    def synced(self, node, num, fullSyncStarted=None):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                if fullSyncStarted is not None:
+                    self.conn.execute('DELETE FROM processed WHERE node = ? AND seen < ?', (node, fullSyncStarted))
+                    synced = fullSyncStarted
+                else:
+                    row = self.conn.execute('SELECT synced FROM sync WHERE node = ?', (node,)).fetchone()
+                    synced = row[0] if row else 0
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO sync (node, num, synced) VALUES (?, ?, ?)', (node, num, synced)
+                )
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -13,7 +13,6 @@ import argparse
 import glob
 import json
 import logging
-import magic
 import os
 import pathlib
 import re
@@ -31,32 +30,54 @@ from pcap_utils import (
     FILE_INFO_FILE_MIME,
     FILE_INFO_FILE_TYPE,
     PCAP_MIME_TYPES,
+    PCAP_JOURNAL_RESEND_SEC,
+    PCAP_JOURNAL_WINDOW,
     PCAP_TOPIC_PORT,
+    ProcessedFileIndex,
+    PublishedFileJournal,
     tags_from_filename,
 )
 import malcolm_utils
 from malcolm_utils import eprint, str2bool, ParseCurlFile, remove_prefix, touch
 import watch_common
+from sniff_common import sniff_file
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from multiprocessing.pool import ThreadPool
 
+from threading import Lock, Thread
 from urllib.parse import urlparse
 from urllib3.exceptions import NewConnectionError
 
-from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver
+from watchdog.events import FileCreatedEvent
 from watchdog.utils import WatchdogShutdownError
 
 ###################################################################################################
 MINIMUM_CHECKED_FILE_SIZE_DEFAULT = 24
 MAXIMUM_CHECKED_FILE_SIZE_DEFAULT = 32 * 1024 * 1024 * 1024
+PUBLISHED_JOURNAL_DIR_DEFAULT = '.journal'
 
 ###################################################################################################
 # for querying the Arkime's "arkime_files" OpenSearch index to avoid re-processing (duplicating sessions for)
 # files that have already been processed
 ARKIME_FILES_INDEX = "arkime_files"
 ARKIME_FILE_SIZE_FIELD = "filesize"
+ARKIME_FILE_NAME_FIELD = "name"
+ARKIME_FILE_NUM_FIELD = "num"
+
+# the files from the "arkime_files" index are also kept in a local index (see ProcessedFileIndex), which is
+#   updated with new files every --index-sync-sec seconds and fully resynchronized (dropping files Arkime
+#   has expired) every PROCESSED_INDEX_FULL_SYNC_SEC seconds
+PROCESSED_INDEX_DIR_DEFAULT = '.index'
+PROCESSED_INDEX_FULL_SYNC_SEC = 3600
+PROCESSED_INDEX_SYNC_BATCH = 1000
+# a file Arkime doesn't know the size of yet holds the sync watermark back so it's read again until it does, but
+#   only for this long (after that it's left for the next full sync to pick up)
+PROCESSED_INDEX_INCOMPLETE_SEC = PROCESSED_INDEX_FULL_SYNC_SEC
+# once the local index has been synced, a file that isn't in it hasn't been processed, unless it's one we've sent
+#   to be processed ourselves (which Arkime may have done since the sync started). up to this many of those are
+#   remembered, and still checked with OpenSearch, until they show up in the local index
+PROCESSED_INDEX_PUBLISHED_MAX = 100000
 
 ###################################################################################################
 pdbFlagged = False
@@ -168,20 +189,201 @@ class EventWatcher:
 
             self.useOpenSearch = connected and healthy
 
+        # keep a local index of the files Arkime has already processed to check new files against, only
+        #   falling back to querying OpenSearch for files that aren't in it before it's first been synced
+        #   or that we've sent to be processed since then (see PROCESSED_INDEX_PUBLISHED_MAX)
+        self.processedIndex = None
+        self.processedIndexSynced = False
+        self.processedIndexIncomplete = {}
+        self.publishedLock = Lock()
+        self.published = OrderedDict()
+        if self.useOpenSearch and (args.indexSyncSec > 0):
+            self.processedIndex = ProcessedFileIndex(args.indexFile)
+            self.logger.info(
+                f"{scriptName}:	index {args.indexFile} holds {self.processedIndex.count(args.nodeName)} processed files"
+            )
+            self.processedIndexThread = Thread(target=self.syncProcessedIndexLoop, name='index-sync', daemon=True)
+            self.processedIndexThread.start()
+
+        # files to be processed are recorded in a journal and sent from there to each processor until it
+        #   acknowledges them (see PublishedFileJournal), so they aren't lost while a processor is restarting
+        self.journal = PublishedFileJournal(args.journalFile)
+        self.logger.info(
+            f"{scriptName}:\tjournal {args.journalFile} holds {self.journal.depth()} files (epoch {self.journal.epoch})"
+        )
+
         # initialize ZeroMQ context and socket(s) to publish messages to
         self.context = zmq.Context()
 
-        # Socket to send messages on
+        # Socket to send messages on (only used by publishLoop, as ZeroMQ sockets aren't thread-safe)
         self.logger.info(f"{scriptName}:\tbinding publisher port {PCAP_TOPIC_PORT}")
-        self.topic_socket = self.context.socket(zmq.PUB)
+        self.topic_socket = self.context.socket(zmq.ROUTER)
+        # a restarted processor reconnecting with the same identity takes over from its old connection
+        self.topic_socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.topic_socket.setsockopt(zmq.LINGER, 0)
         self.topic_socket.bind(f"tcp://*:{PCAP_TOPIC_PORT}")
-
-        # todo: do I want to set this? probably not since this guy's whole job is to send
-        # and if he can't then what's the point? just block
-        # self.topic_socket.SNDTIMEO = 5000
+        self.publishThread = Thread(target=self.publishLoop, name='publish', daemon=True)
+        self.publishThread.start()
 
         self.logger.info(f"{scriptName}:\tEventWatcher initialized")
 
+    ###################################################################################################
+    # copy this node's files from Arkime's files index to the local index: either just the files we haven't
+    #   read yet (or hadn't finished being written last time) or, for a full sync, all of them
+    def syncProcessedIndex(self, full=False):
+        global args
+        global SearchClass
+
+        syncStarted = time.time()
+        fromNum = 0 if full else self.processedIndex.watermark(args.nodeName)[0]
+        s = (
+            SearchClass(using=self.openSearchClient, index=ARKIME_FILES_INDEX)
+            .filter("term", node=args.nodeName)
+            .source([ARKIME_FILE_NUM_FIELD, ARKIME_FILE_NAME_FIELD, ARKIME_FILE_SIZE_FIELD])
+            .params(size=PROCESSED_INDEX_SYNC_BATCH)
+        )
+        if fromNum > 0:
+            s = s.filter("range", **{ARKIME_FILE_NUM_FIELD: {"gte": fromNum}})
+
+        files = []
+        fileCount = 0
+        maxNum = fromNum - 1
+        incompleteNum = None
+        # when each file Arkime didn't know the size of was first seen that way (keeping those that this sync won't
+        #   read again, which the next full sync will)
+        incompleteSince = {num: since for num, since in self.processedIndexIncomplete.items() if num < fromNum}
+        for hit in s.scan():
+            fileInfo = hit.to_dict()
+            fileNum = fileInfo.get(ARKIME_FILE_NUM_FIELD, 0)
+            maxNum = max(maxNum, fileNum)
+            if (ARKIME_FILE_NAME_FIELD in fileInfo) and (ARKIME_FILE_SIZE_FIELD in fileInfo):
+                files.append((fileInfo[ARKIME_FILE_NAME_FIELD], fileInfo[ARKIME_FILE_SIZE_FIELD]))
+            else:
+                # Arkime doesn't know this file's size yet, so pick it up again next time (unless it's been
+                #   like that for so long that it probably never will)
+                incompleteSince[fileNum] = self.processedIndexIncomplete.get(fileNum, syncStarted)
+                if syncStarted - incompleteSince[fileNum] < PROCESSED_INDEX_INCOMPLETE_SEC:
+                    incompleteNum = fileNum if (incompleteNum is None) else min(incompleteNum, fileNum)
+            if len(files) >= PROCESSED_INDEX_SYNC_BATCH:
+                self.processedIndex.add(args.nodeName, files)
+                fileCount += len(files)
+                files = []
+        if files:
+            self.processedIndex.add(args.nodeName, files)
+            fileCount += len(files)
+
+        self.processedIndex.synced(
+            args.nodeName,
+            incompleteNum if (incompleteNum is not None) else (maxNum + 1),
+            fullSyncStarted=syncStarted if full else None,
+        )
+        self.processedIndexIncomplete = incompleteSince
+        self.processedIndexSynced = True
+        self.logger.debug(
+            f"{scriptName}:	{'fully ' if full else ''}synced {fileCount} files from {ARKIME_FILES_INDEX} in {time.time() - syncStarted:.3f} seconds"
+        )
+
+    def syncProcessedIndexLoop(self):
+        global args
+        global shuttingDown
+
+        while not shuttingDown[0]:
+            try:
+                self.syncProcessedIndex(
+                    full=(
+                        time.time() - self.processedIndex.watermark(args.nodeName)[1] >= PROCESSED_INDEX_FULL_SYNC_SEC
+                    )
+                )
+            except Exception as e:
+                self.logger.error(f"{scriptName}:	error syncing {ARKIME_FILES_INDEX}: {e}")
+            sleepCount = 0
+            while (not shuttingDown[0]) and (sleepCount < args.indexSyncSec):
+                time.sleep(1)
+                sleepCount += 1
+
+    def wasPublished(self, publishedKey):
+        with self.publishedLock:
+            return publishedKey in self.published
+
+    ###################################################################################################
+    # send journaled files to each connected processor and record their acknowledgements
+    def publishLoop(self):
+        global shuttingDown
+
+        # consumer name -> {session, sent (highest message ID sent), acked (highest acknowledged), progress, seen}
+        consumers = {}
+        lastPruned = time.time()
+
+        while not shuttingDown[0]:
+            try:
+                # handle heartbeats and acknowledgements from processors
+                while self.topic_socket.poll(timeout=250, flags=zmq.POLLIN):
+                    identity, message = self.topic_socket.recv_multipart()
+                    consumer = identity.decode('utf-8', errors='replace')
+                    message = json.loads(message)
+                    now = time.time()
+                    state = consumers.get(consumer)
+                    if (state is None) or (state['session'] != message.get('session')):
+                        # a processor we haven't heard from (or which has restarted), so start over from
+                        #   the last message it acknowledged
+                        acked = self.journal.acked(consumer)
+                        self.journal.ack(consumer, acked)
+                        state = {
+                            'session': message.get('session'),
+                            'sent': acked,
+                            'acked': acked,
+                            'progress': now,
+                            'seen': now,
+                        }
+                        consumers[consumer] = state
+                        self.logger.info(f"{scriptName}:\t🤝\t{consumer} (from message {acked + 1})")
+                    if isinstance(message.get('ack'), int) and (message['ack'] > state['acked']):
+                        self.journal.ack(consumer, message['ack'])
+                        state['acked'] = message['ack']
+                        state['sent'] = max(state['sent'], state['acked'])
+                        state['progress'] = state['seen'] = now
+                    elif now - state['seen'] >= PCAP_JOURNAL_RESEND_SEC:
+                        # just a heartbeat, but note every so often that it's still around
+                        self.journal.ack(consumer, state['acked'])
+                        state['seen'] = now
+
+                # send each processor what it hasn't acknowledged yet, a window's worth at a time
+                now = time.time()
+                for consumer, state in consumers.items():
+                    if (state['sent'] > state['acked']) and (now - state['progress'] >= PCAP_JOURNAL_RESEND_SEC):
+                        # nothing acknowledged in a while (the processor may have missed some messages while
+                        #   reconnecting, or it may just be busy), so send the unacknowledged ones again
+                        self.logger.debug(f"{scriptName}:\t🔁\t{consumer} (from message {state['acked'] + 1})")
+                        state['sent'] = state['acked']
+                        state['progress'] = now
+                    windowLeft = state['acked'] + PCAP_JOURNAL_WINDOW - state['sent']
+                    if windowLeft > 0:
+                        for messageId, fileInfo in self.journal.after(state['sent'], windowLeft):
+                            self.topic_socket.send_multipart(
+                                [
+                                    consumer.encode('utf-8'),
+                                    json.dumps(
+                                        {
+                                            'session': state['session'],
+                                            'epoch': self.journal.epoch,
+                                            'id': messageId,
+                                            'info': fileInfo,
+                                        }
+                                    ).encode('utf-8'),
+                                ]
+                            )
+                            state['sent'] = messageId
+
+                if now - lastPruned >= PCAP_JOURNAL_RESEND_SEC:
+                    pruned = self.journal.prune()
+                    if pruned > 0:
+                        self.logger.debug(f"{scriptName}:\tpruned {pruned} files from journal")
+                    lastPruned = now
+
+            except Exception as e:
+                self.logger.error(f"{scriptName}:\terror publishing: {e}")
+                time.sleep(1)
+
     ###################################################################################################
     # set up event processor to append processed events from to the event queue
     def processFile(self, pathname):
@@ -194,8 +396,7 @@ class EventWatcher:
         # the entity must be a regular PCAP file and actually exist
         if os.path.isfile(pathname):
             # get the file magic description and mime type
-            fileMime = magic.from_file(pathname, mime=True)
-            fileType = magic.from_file(pathname)
+            fileMime, fileType = sniff_file(pathname)
 
             # get the file size, in bytes to compare against sane values
             fileSize = os.path.getsize(pathname)
@@ -206,7 +407,19 @@ class EventWatcher:
 
                 # check with Arkime's files index in OpenSearch and make sure it's not a duplicate
                 fileIsDuplicate = False
-                if self.useOpenSearch:
+                publishedKey = (relativePath, fileSize)
+                if (self.processedIndex is not None) and self.processedIndex.contains(
+                    args.nodeName, relativePath, fileSize
+                ):
+                    fileIsDuplicate = True
+                    with self.publishedLock:
+                        self.published.pop(publishedKey, None)
+
+                elif self.useOpenSearch and not (
+                    (self.processedIndex is not None)
+                    and self.processedIndexSynced
+                    and not self.wasPublished(publishedKey)
+                ):
                     s = (
                         SearchClass(using=self.openSearchClient, index=ARKIME_FILES_INDEX)
                         .filter("term", node=args.nodeName)
@@ -217,6 +430,8 @@ class EventWatcher:
                         fileInfo = hit.to_dict()
                         if (ARKIME_FILE_SIZE_FIELD in fileInfo) and (fileInfo[ARKIME_FILE_SIZE_FIELD] == fileSize):
                             fileIsDuplicate = True
+                            if (self.processedIndex is not None) and (ARKIME_FILE_NAME_FIELD in fileInfo):
+                                self.processedIndex.add(args.nodeName, [(fileInfo[ARKIME_FILE_NAME_FIELD], fileSize)])
                             break
 
                 if fileIsDuplicate:
@@ -238,10 +453,16 @@ class EventWatcher:
                             ),
                             FILE_INFO_DICT_TAGS: tags_from_filename(relativePath),
                         }
-                        self.topic_socket.send_string(json.dumps(fileInfo))
+                        self.journal.append(fileInfo)
+                        if self.processedIndex is not None:
+                            with self.publishedLock:
+                                self.published[publishedKey] = True
+                                self.published.move_to_end(publishedKey)
+                                while len(self.published) > PROCESSED_INDEX_PUBLISHED_MAX:
+                                    self.published.popitem(last=False)
                         self.logger.info(f"{scriptName}:\t📫\t{fileInfo}")
-                    except zmq.Again:
-                        self.logger.debug(f"{scriptName}:\t🕑\t{pathname}")
+                    except Exception as e:
+                        self.logger.error(f"{scriptName}:\t💥\t{pathname}: {e}")
 
             else:
                 # too small/big to care about, or the wrong type, ignore it
@@ -383,6 +604,24 @@ def main():
         default=False,
         required=False,
     )
+    parser.add_argument(
+        '--index-file',
+        dest='indexFile',
+        help="Local index of files already processed by Arkime (default is a hidden subdirectory of --directory)",
+        metavar='<filename>',
+        type=str,
+        default=os.getenv('PCAP_PIPELINE_INDEX_FILE', ''),
+        required=False,
+    )
+    parser.add_argument(
+        '--index-sync-sec',
+        dest='indexSyncSec',
+        help=f"Seconds between updates of the local index from {ARKIME_FILES_INDEX} (0 to query {ARKIME_FILES_INDEX} for every file instead)",
+        metavar='<seconds>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_INDEX_SYNC_SEC', '60')),
+        required=False,
+    )
     parser.add_argument(
         '--start-sleep',
         dest='startSleepSec',
@@ -423,6 +662,25 @@ def main():
         default=int(os.getenv('PCAP_PIPELINE_POLLING_ASSUME_CLOSED_SEC', str(watch_common.ASSUME_CLOSED_SEC_DEFAULT))),
         required=False,
     )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='processorThreads',
+        help="Number of threads processing files once they're ready",
+        metavar='<threads>',
+        type=int,
+        default=int(os.getenv('PCAP_PIPELINE_WATCHER_THREADS', str(watch_common.PROCESSOR_THREADS_DEFAULT))),
+        required=False,
+    )
+    parser.add_argument(
+        '--journal-file',
+        dest='journalFile',
+        help="Journal of files published for processing (default is a hidden subdirectory of --directory)",
+        metavar='<filename>',
+        type=str,
+        default=os.getenv('PCAP_PIPELINE_JOURNAL_FILE', ''),
+        required=False,
+    )
     requiredNamed = parser.add_argument_group('required arguments')
     requiredNamed.add_argument(
         '-d', '--directory', dest='baseDir', help='Directory to monitor', metavar='<directory>', type=str, required=True
@@ -496,6 +754,13 @@ def main():
         logging.info(f'{scriptName}:\tcreating "{args.baseDir}" to monitor')
         pathlib.Path(args.baseDir).mkdir(parents=False, exist_ok=True)
 
+    # by default the local index of processed files is kept in a hidden directory alongside them
+    if not args.indexFile:
+        args.indexFile = os.path.join(args.baseDir, PROCESSED_INDEX_DIR_DEFAULT, f'{args.nodeName}.db')
+    # by default the journal of published files is kept in a hidden directory alongside them
+    if not args.journalFile:
+        args.journalFile = os.path.join(args.baseDir, PUBLISHED_JOURNAL_DIR_DEFAULT, f'{args.nodeName}-published.db')
+
     # if recursion was requested, get list of directories to monitor
     watchDirs = []
     while len(watchDirs) == 0:
@@ -507,7 +772,7 @@ def main():
     # begin threaded watch of path(s)
     time.sleep(1)
 
-    observer = PollingObserver() if args.polling else Observer()
+    observer = watch_common.create_observer(args.polling, args.assumeClosedSec)
     handler = watch_common.FileOperationEventHandler(
         logger=None,
         polling=args.polling,
@@ -530,7 +795,11 @@ def main():
                 for preexistingFile in [
                     os.path.join(watchDir, x) for x in pathlib.Path(watchDir).iterdir() if x.is_file()
                 ]:
-                    touch(preexistingFile)
+                    if args.polling:
+                        # the polling observer only notices files when they change, so hand them over directly
+                        handler.on_any_event(FileCreatedEvent(preexistingFile))
+                    else:
+                        touch(preexistingFile)
                     filesTouched += 1
             if filesTouched > 0:
                 logging.info(f"{scriptName}:\tfound {filesTouched} preexisting files to check")
@@ -549,6 +818,7 @@ def main():
                     workerThreadCount,
                     shuttingDown,
                     logging,
+                    args.processorThreads,
                 ],
             ),
         )
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2025 Battelle Energy Alliance, LLC.  All rights reserved.
+
+###################################################################################################
+# Identify a file's type (both its MIME type and its libmagic description) from a single read of
+#   the file's header. The formats the watchers care about most are recognized by their magic
+#   numbers without calling libmagic at all, and results are cached by the file's identity
+#   (device, inode, size and mtime) so a file seen by more than one step isn't read again.
+###################################################################################################
+
+import os
+import struct
+import threading
+
+import magic
+
+from collections import namedtuple, OrderedDict
+
+# how much of the file is read for libmagic to look at
+SNIFF_HEADER_BYTES = 64 * 1024
+
+# how many files' results are remembered
+SNIFF_CACHE_MAX = 8192
+
+FileType = namedtuple("FileType", ["mime", "description"], rename=False)
+
+EMPTY_FILE_TYPE = FileType('inode/x-empty', 'empty')
+
+PCAP_MAGIC_MICROSECONDS = 0xA1B2C3D4
+PCAP_MAGIC_NANOSECONDS = 0xA1B23C4D
+PCAPNG_MAGIC_SHB = b'\x0a\x0d\x0d\x0a'
+PCAPNG_MAGIC_BYTE_ORDER = 0x1A2B3C4D
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+EVTX_MAGIC = b'ElfFile\x00'
+
+_sniffCache = OrderedDict()
+_sniffCacheLock = threading.Lock()
+_magicHandles = threading.local()
+
+
+###################################################################################################
+# recognize formats by their magic numbers, returning None if libmagic needs to have a look
+def sniff_magic_numbers(header):
+    if len(header) >= 24:
+        for endian, endianName in (('<', 'little-endian'), ('>', 'big-endian')):
+            magicNumber, versionMajor, versionMinor, _, _, snapLen, linkType = struct.unpack(
+                f'{endian}IHHiIII', header[:24]
+            )
+            if magicNumber in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+                resolution = 'microsecond' if (magicNumber == PCAP_MAGIC_MICROSECONDS) else 'nanosecond'
+                return FileType(
+                    'application/vnd.tcpdump.pcap',
+                    f'pcap capture file, {resolution} ts ({endianName}) - version {versionMajor}.{versionMinor} (link type {linkType}, capture length {snapLen})',
+                )
+
+    if (len(header) >= 16) and (header[:4] == PCAPNG_MAGIC_SHB):
+        for endian in ('<', '>'):
+            byteOrderMagic, versionMajor, versionMinor = struct.unpack(f'{endian}IHH', header[8:16])
+            if byteOrderMagic == PCAPNG_MAGIC_BYTE_ORDER:
+                return FileType('application/x-pcapng', f'pcapng capture file - version {versionMajor}.{versionMinor}')
+
+    if header[:3] == GZIP_MAGIC + b'\x08':
+        return FileType('application/gzip', 'gzip compressed data')
+
+    if header[:4] == ZSTD_MAGIC:
+        return FileType('application/zstd', 'Zstandard compressed data')
+
+    if header[:8] == EVTX_MAGIC:
+        return FileType('application/x-ms-evtx', 'MS Windows Event Log')
+
+    return None
+
+
+###################################################################################################
+# libmagic handles aren't safe to share between threads without locking, so each thread gets its own
+def _magic_handles():
+    handles = getattr(_magicHandles, 'handles', None)
+    if handles is None:
+        handles = (magic.Magic(mime=True), magic.Magic())
+        _magicHandles.handles = handles
+    return handles
+
+
+###################################################################################################
+def sniff_buffer(header):
+    if not header:
+        return EMPTY_FILE_TYPE
+    if (fileType := sniff_magic_numbers(header)) is None:
+        mimeMagic, descriptionMagic = _magic_handles()
+        fileType = FileType(mimeMagic.from_buffer(header), descriptionMagic.from_buffer(header))
+    return fileType
+
+
+###################################################################################################
+# returns the FileType (mime, description) of pathname, raising OSError if it can't be read
+def sniff_file(pathname):
+    fileStat = os.stat(pathname)
+    cacheKey = (fileStat.st_dev, fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns)
+    with _sniffCacheLock:
+        if (fileType := _sniffCache.get(cacheKey, None)) is not None:
+            _sniffCache.move_to_end(cacheKey)
+            return fileType
+
+    if fileStat.st_size > 0:
+        with open(pathname, 'rb') as f:
+            header = f.read(SNIFF_HEADER_BYTES)
+    else:
+        header = b''
+    fileType = sniff_buffer(header)
+
+    with _sniffCacheLock:
+        _sniffCache[cacheKey] = fileType
+        _sniffCache.move_to_end(cacheKey)
+        while len(_sniffCache) > SNIFF_CACHE_MAX:
+            _sniffCache.popitem(last=False)
+
+    return fileType
@@ -4,12 +4,51 @@ import json
 import logging
 import os
 import socket
+import threading
 import time
 import malcolm_utils
-from typing import Optional, Dict, Any, Union
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Union
 
 
 SuricataMaxRetriesDefault = 30
+SuricataMaxInFlightDefault = 10
+SuricataRecvSize = 4096
+SuricataProtocolVersion = "0.2"
+
+
+class SuricataPcapSubmission:
+    """A PCAP file submitted to Suricata, and when (if) Suricata has finished with it"""
+
+    def __init__(
+        self,
+        pcap_file: str,
+        output_dir: str,
+    ):
+        self.pcap_file = pcap_file
+        self.output_dir = output_dir
+        self.submitted = time.time()
+        self.completed = None
+        self.done = threading.Event()
+
+    def complete(
+        self,
+    ) -> None:
+        self.completed = time.time()
+        self.done.set()
+
+    @property
+    def latency(
+        self,
+    ) -> float:
+        """Seconds between submission and completion (or so far, if not yet completed)"""
+        return (self.completed if self.completed else time.time()) - self.submitted
+
+    def wait(
+        self,
+        timeout: Optional[float] = None,
+    ) -> bool:
+        return self.done.wait(timeout)
 
 
 class SuricataSocketClient:
@@ -24,6 +63,7 @@ class SuricataSocketClient:
         retry_delay: int = 1,
         process_pcap_wait_delay: int = 1,
         output_dir: str = '/var/log/suricata',
+        max_in_flight: int = SuricataMaxInFlightDefault,
     ):
         self.socket_path = socket_path
         self.logger = logger or logging.getLogger(__name__)
@@ -33,6 +73,13 @@ class SuricataSocketClient:
         self.output_dir = output_dir
         self.debug_enabled = debug
         self.debug_log = os.path.join(self.output_dir, 'socket_debug.log')
+        self.max_in_flight = max_in_flight
+        self.recv_buffer = b''
+        # PCAP files we've submitted that Suricata hasn't finished yet, oldest first
+        self.in_flight = OrderedDict()
+        self.completed_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
 
         # Ensure log directory exists
         os.makedirs(os.path.dirname(self.debug_log), exist_ok=True)
@@ -76,15 +123,17 @@ class SuricataSocketClient:
                 self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
                 self.sock.settimeout(5)  # 5 second timeout
                 self.sock.connect(self.socket_path)
+                self.recv_buffer = b''
                 self._debug(f"Successfully connected to Suricata socket after {attempts+1} attempts")
 
-                # Initial version handshake - this is a special case, not a command
-                handshake = json.dumps({"version": "0.1"}) + "\n"
+                # Initial version handshake - this is a special case, not a command. Suricata only terminates
+                #   its responses with a newline for clients speaking version 0.2 or later (as suricatasc does)
+                handshake = json.dumps({"version": SuricataProtocolVersion}) + "\n"
                 self._debug(f"Sending handshake: {handshake.strip()}")
                 self.sock.send(handshake.encode('utf-8'))
 
                 # Read response
-                response = self.sock.recv(4096).decode('utf-8')
+                response = self._recv_response()
                 self._debug(f"Handshake response: {response.strip()}")
 
                 try:
@@ -112,6 +161,29 @@ class SuricataSocketClient:
         self._debug(f"ERROR: {error_msg}")
         raise ConnectionError(error_msg)
 
+    def _recv_response(
+        self,
+    ) -> str:
+        """Read one newline-terminated response from the socket, however many reads it takes"""
+        while b'\n' not in self.recv_buffer:
+            received = self.sock.recv(SuricataRecvSize)
+            if not received:
+                # connection closed, return whatever we have
+                response, self.recv_buffer = self.recv_buffer, b''
+                return response.decode('utf-8')
+            self.recv_buffer += received
+            # in case the newline never comes (i.e., Suricata is speaking version 0.1), a complete JSON
+            #   document is a complete response
+            if b'\n' not in self.recv_buffer:
+                try:
+                    json.loads(self.recv_buffer)
+                    response, self.recv_buffer = self.recv_buffer, b''
+                    return response.decode('utf-8')
+                except ValueError:
+                    pass
+        response, self.recv_buffer = self.recv_buffer.split(b'\n', 1)
+        return response.decode('utf-8')
+
     def _send_command(
         self,
         command: Dict[str, Any],
@@ -127,7 +199,7 @@ class SuricataSocketClient:
                 self.sock.send(command_json.encode('utf-8'))
 
                 # Read response
-                response = self.sock.recv(4096).decode('utf-8')
+                response = self._recv_response()
                 self._debug(f"Response received: {response.strip()}")
 
                 if not response:
@@ -158,12 +230,84 @@ class SuricataSocketClient:
 
         return None
 
+    def pcap_file_list(
+        self,
+    ) -> Optional[List[str]]:
+        """Return the list of PCAP files queued in Suricata (not including the one currently being processed)"""
+        response = self._send_command({"command": "pcap-file-list"})
+        if response is None:
+            return None
+        return malcolm_utils.deep_get(response, ["message", "files"], [])
+
+    def pcap_file_number(
+        self,
+    ) -> Optional[int]:
+        """Return the number of PCAP files queued in Suricata (not including the one currently being processed)"""
+        response = self._send_command({"command": "pcap-file-number"})
+        if response is None:
+            return None
+        return response.get("message", 0)
+
+    def pcap_current(
+        self,
+    ) -> Optional[str]:
+        """Return the PCAP file Suricata is currently processing (or an empty string if none)"""
+        response = self._send_command({"command": "pcap-current"})
+        if response is None:
+            return None
+        current = response.get("message", "")
+        return current if current and (current != "None") else ""
+
+    def update_completed(
+        self,
+    ) -> List[SuricataPcapSubmission]:
+        """Check with Suricata which submitted PCAP files it has finished, and return them"""
+        completed = []
+        if self.in_flight:
+            queued = self.pcap_file_list()
+            current = self.pcap_current()
+            if (queued is not None) and (current is not None):
+                active = set(queued)
+                if current:
+                    active.add(current)
+                # Suricata processes PCAP files in the order they were submitted, so once we find one it is
+                #   still working on (or has yet to get to) everything after that is still in flight as well
+                for pcap_file in list(self.in_flight.keys()):
+                    if pcap_file in active:
+                        break
+                    submission = self.in_flight.pop(pcap_file)
+                    submission.complete()
+                    self.completed_count += 1
+                    self.latency_total += submission.latency
+                    self.latency_max = max(self.latency_max, submission.latency)
+                    self._debug(f"Completed PCAP: {pcap_file} in {submission.latency:.1f}s")
+                    completed.append(submission)
+        return completed
+
+    def has_capacity(
+        self,
+    ) -> bool:
+        """Return True if another PCAP file may be submitted without exceeding max_in_flight"""
+        return (self.max_in_flight <= 0) or (len(self.in_flight) < self.max_in_flight)
+
+    def stats(
+        self,
+    ) -> Dict[str, Any]:
+        """Return counts and latency (in seconds) of PCAP files submitted to Suricata"""
+        return {
+            "in_flight": len(self.in_flight),
+            "completed": self.completed_count,
+            "latency_avg": (self.latency_total / self.completed_count) if self.completed_count else 0.0,
+            "latency_max": self.latency_max,
+            "oldest_in_flight": next(iter(self.in_flight.values())).latency if self.in_flight else 0.0,
+        }
+
     def process_pcap(
         self,
         pcap_file: str,
         output_dir: str,
-    ) -> bool:
-        """Submit a PCAP file to Suricata for processing"""
+    ) -> Optional[SuricataPcapSubmission]:
+        """Submit a PCAP file to Suricata for processing, returning its submission (to track completion)"""
         try:
             self._debug(f"\nProcessing PCAP: {pcap_file}")
 
@@ -173,7 +317,7 @@ class SuricataSocketClient:
                 self._debug(f"Created output directory: {output_dir}")
             except Exception as e:
                 self._debug(f"ERROR: Failed to create output directory {output_dir}: {e}")
-                return False
+                return None
             eve_json_file = os.path.join(output_dir, "eve.json")
 
             submit_response = self._send_command(
@@ -187,14 +331,17 @@ class SuricataSocketClient:
             )
             if not submit_response or submit_response.get("return") != "OK":
                 self._debug(f"ERROR: Failed to process PCAP: {submit_response}")
-                return False
+                return None
 
             self._debug(f"Successfully queued PCAP: {pcap_file}")
-            return True
+            submission = SuricataPcapSubmission(pcap_file, output_dir)
+            self.in_flight.pop(pcap_file, None)
+            self.in_flight[pcap_file] = submission
+            return submission
 
         except Exception as e:
             self._debug(f"ERROR: Exception processing PCAP: {e}")
-            return False
+            return None
 
     def close(
         self,
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import ctypes
+import ctypes.util
+import hashlib
 import os
 import json
 import logging
+import select
+import struct
 import time
 
 from malcolm_utils import AtomicInt, ContextLockedOrderedDict, same_file_or_dir
 
 from watchdog.events import (
+    DirDeletedEvent,
     FileSystemEventHandler,
     FileMovedEvent,
     FileModifiedEvent,
@@ -18,14 +24,25 @@ from watchdog.events import (
     FileDeletedEvent,
 )
 
+from bisect import bisect_left
+from functools import partial
+from heapq import heapify, heappop, heappush
 from multiprocessing.pool import ThreadPool
-from threading import get_native_id
+from queue import Queue
+from tempfile import gettempdir
+from threading import get_native_id, Condition, Lock, Thread
 from watchdog.utils import WatchdogShutdownError
 from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver
+from watchdog.observers.api import BaseObserver, EventEmitter, DEFAULT_EMITTER_TIMEOUT, DEFAULT_OBSERVER_TIMEOUT
 from collections import namedtuple, defaultdict, OrderedDict
 
 ASSUME_CLOSED_SEC_DEFAULT = 10
+PROCESSOR_THREADS_DEFAULT = 1
+PROCESSOR_QUEUE_DEPTH = 16
+LATENCY_LOG_INTERVAL_SEC = 60
+MOD_DECK_MAX_DEFAULT = 100000
+MOD_DECK_MAX_AGE_SEC_DEFAULT = 3600
+WORKER_MAX_WAIT_SEC = 1.0
 
 OperationEvent = namedtuple("OperationEvent", ["timestamp", "operation", "size"], rename=False)
 
@@ -37,10 +54,14 @@ class FileOperationEventHandler(FileSystemEventHandler):
         logger,
         polling,
         *args,
+        modDeckMax=MOD_DECK_MAX_DEFAULT,
+        modDeckMaxAgeSec=MOD_DECK_MAX_AGE_SEC_DEFAULT,
         **kwargs,
     ):
         super().__init__(*args, **kwargs)
         self.polling = polling
+        self.modDeckMax = modDeckMax
+        self.modDeckMaxAgeSec = modDeckMaxAgeSec
         self.logger = logger if logger else logging
         self.workerPid = get_native_id()
         self.updateTime()
@@ -57,13 +78,82 @@ class FileOperationEventHandler(FileSystemEventHandler):
         #   self.modDeck until we promote them to self.deck for processing.
         #   Once gorakhargosh/watchdog#800 is pulled (resolving gorakhargosh/watchdog#260)
         #   we can get rid of this complication and just ignore attribute-only events.
+        #   Files that never get promoted are evicted from self.modDeck (oldest first) once
+        #   they're older than modDeckMaxAgeSec or there are more than modDeckMax of them.
         self.modDeck = OrderedDict()
+        # self.readyHeap is a min-heap of (timestamp, filename) for the files in self.deck that
+        #   will be ready for processing once they've been quiet long enough, keyed on the timestamp
+        #   of their newest operation (0 for a FileClosedEvent, so those come first).
+        #   self.readyKeys maps those filenames to their current key; heap entries that don't
+        #   match it are stale and are skipped when they come up. self.readyChanged shares
+        #   self.deck's lock and is notified when a file is scheduled at the top of the heap.
+        self.readyHeap = []
+        self.readyKeys = {}
+        self.readyChanged = Condition(self.deck.lock)
 
     def done(self):
         return True
 
     def updateTime(self):
-        self.nowTime = int(time.time())
+        self.nowTime = time.time()
+
+    def schedule(self, fName):
+        # (re)schedule fName according to its history in self.deck, must be called with self.deck locked
+        fileHistory = self.deck.get(fName, None)
+        if fileHistory and (
+            # - If we're polling, the file is ready once it's been quiet long enough
+            self.polling
+            # - If we're not polling, but we have a timestamp == 0, then we had a FileClosedEvent and can be processed
+            or (fileHistory[-1].timestamp == 0)
+            # - If we're not polling, and the only items in this item's history are "created" or "moved" then
+            #     this was atomically moved in from another directory on the same filesystem and can be processed
+            #     once it's been quiet long enough
+            or (not any(x.operation not in ('created', 'moved') for x in fileHistory))
+        ):
+            readyKey = fileHistory[-1].timestamp
+            if self.readyKeys.get(fName, None) != readyKey:
+                self.readyKeys[fName] = readyKey
+                heappush(self.readyHeap, (readyKey, fName))
+                if self.readyHeap[0] == (readyKey, fName):
+                    self.readyChanged.notify()
+        else:
+            self.readyKeys.pop(fName, None)
+
+        # don't let stale entries pile up in the heap for files that are written to for a long time
+        if len(self.readyHeap) > 2 * len(self.readyKeys) + 1024:
+            self.readyHeap = [(readyKey, fileName) for fileName, readyKey in self.readyKeys.items()]
+            heapify(self.readyHeap)
+
+    def pop_ready(self, assumeClosedSec, limit, nowTime):
+        # remove and return up to limit (filename, history) tuples from self.deck for files that are ready
+        #   for processing, along with the number of seconds until the next file will be ready (or None
+        #   if nothing else is scheduled). must be called with self.deck locked.
+        readyFiles = []
+        while self.readyHeap:
+            readyKey, fName = self.readyHeap[0]
+            if self.readyKeys.get(fName, None) != readyKey:
+                heappop(self.readyHeap)
+            elif readyKey + assumeClosedSec > nowTime:
+                return readyFiles, readyKey + assumeClosedSec - nowTime
+            elif len(readyFiles) >= limit:
+                return readyFiles, 0
+            else:
+                heappop(self.readyHeap)
+                del self.readyKeys[fName]
+                fileHistory = self.deck.pop(fName, None)
+                if fileHistory is not None:
+                    readyFiles.append((fName, fileHistory))
+        return readyFiles, None
+
+    def evict_mod_deck(self, nowTime):
+        # self.modDeck is in the order files were added to it (their timestamps aren't updated until they're
+        #   promoted), so only the front needs to be checked. must be called with self.deck locked.
+        while self.modDeck:
+            fName, fileHistory = next(iter(self.modDeck.items()))
+            if (len(self.modDeck) <= self.modDeckMax) and (fileHistory[-1].timestamp + self.modDeckMaxAgeSec > nowTime):
+                break
+            self.modDeck.popitem(last=False)
+            self.logger.debug(f"⌛\t{fName}\t{self.workerPid}")
 
     def on_any_event(self, event):
         fName = None
@@ -158,6 +248,10 @@ class FileOperationEventHandler(FileSystemEventHandler):
                             d[fName] = self.modDeck.pop(fName)
                             d[fName].append(newOpLog)
 
+                        else:
+                            # still nothing but open/attribute-only events, leave it where it is in modDeck
+                            noop = True
+
                     else:
                         # this is a file we were not previously tracking at all, in either deck
 
@@ -185,6 +279,7 @@ class FileOperationEventHandler(FileSystemEventHandler):
                             # if a file is deleted I guess we don't need to track it any more
                             d.pop(fName, None)
                             self.modDeck.pop(fName, None)
+                            self.readyKeys.pop(fName, None)
                             fName = None
 
                         else:
@@ -199,10 +294,54 @@ class FileOperationEventHandler(FileSystemEventHandler):
                         if fName in self.modDeck:
                             self.logger.debug(f"➋\t{fName}\t{json.dumps(self.modDeck[fName])}\t{self.workerPid}")
 
+                    if fNameOld:
+                        self.schedule(fNameOld)
+                    if fName and not noop:
+                        self.schedule(fName)
+                    self.evict_mod_deck(self.nowTime)
+
                 except Exception as e:
                     self.logger.error(f"⨳\t{fName}\t{e}\t{self.workerPid}")
 
 
+###################################################################################################
+class LatencyHistogram(object):
+    # upper bounds (in seconds) of the histogram's buckets, with one more bucket for anything larger
+    BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, seconds):
+        seconds = max(seconds, 0.0)
+        with self.lock:
+            self.counts[bisect_left(self.BUCKETS, seconds)] += 1
+            self.total += seconds
+            self.maximum = max(self.maximum, seconds)
+
+    def quantile(self, q):
+        # returns the upper bound of the bucket containing the qth quantile
+        with self.lock:
+            target = q * sum(self.counts)
+            seen = 0
+            for idx, count in enumerate(self.counts):
+                seen += count
+                if (count > 0) and (seen >= target):
+                    return self.BUCKETS[idx] if (idx < len(self.BUCKETS)) else self.maximum
+            return 0.0
+
+    def __str__(self):
+        with self.lock:
+            count = sum(self.counts)
+            mean = (self.total / count) if (count > 0) else 0.0
+            maximum = self.maximum
+        return f"{self.name}: n={count} mean={mean:.3f}s p50<={self.quantile(0.5)}s p90<={self.quantile(0.9)}s p99<={self.quantile(0.99)}s max={maximum:.3f}s"
+
+
 ###################################################################################################
 def ProcessFileEventWorker(workerArgs):
     (
@@ -214,6 +353,7 @@ def ProcessFileEventWorker(workerArgs):
         workerThreadCount,
         shutDown,
         logger,
+        processorThreads,
     ) = (
         workerArgs[0],
         workerArgs[1],
@@ -223,67 +363,658 @@ def ProcessFileEventWorker(workerArgs):
         workerArgs[5],
         workerArgs[6],
         workerArgs[7],
+        workerArgs[8] if len(workerArgs) > 8 else PROCESSOR_THREADS_DEFAULT,
     )
     if not logger:
         logger = logging
+    processorThreads = max(processorThreads or PROCESSOR_THREADS_DEFAULT, 1)
+    extraArgs = fileProcessorKwargs if fileProcessorKwargs and isinstance(fileProcessorKwargs, dict) else {}
+
+    # ready files are handed off to the processor threads through a bounded queue so that fileProcessor
+    #   (which may be slow) runs outside of the deck lock and doesn't hold up on_any_event. when the
+    #   queue is full, ready files are left in the deck until the processors catch up.
+    readyQueue = Queue(maxsize=processorThreads * PROCESSOR_QUEUE_DEPTH)
+    latencies = OrderedDict(
+        [
+            ('waiting', LatencyHistogram('waiting')),
+            ('queued', LatencyHistogram('queued')),
+            ('processing', LatencyHistogram('processing')),
+        ]
+    )
+
+    def processor(processorId):
+        with workerThreadCount as workerId:
+            processorPid = get_native_id()
+            logger.debug(f"۞\tprocessor {processorId} started\t[{processorPid}:{workerId}]")
+            while True:
+                item = readyQueue.get()
+                try:
+                    if item is None:
+                        break
+                    fileName, waitedSec, queuedTime = item
+                    startTime = time.time()
+                    latencies['queued'].observe(startTime - queuedTime)
+                    if fileProcessor is not None:
+                        try:
+                            fileProcessor(
+                                fileName,
+                                **extraArgs,
+                            )
+                        except Exception as e:
+                            logger.error(f"⨳\t{fileName}\t{e}\t[{processorPid}:{workerId}]")
+                    latencies['processing'].observe(time.time() - startTime)
+                    logger.info(f"🖄\tprocessed\t{fileName} at {waitedSec} seconds\t[{processorPid}:{workerId}]")
+                finally:
+                    if readyQueue.empty():
+                        # wake up the worker in case it's waiting on the processors to catch up
+                        with handler.deck:
+                            handler.readyChanged.notify()
+                    readyQueue.task_done()
+            logger.debug(f"⛒\tprocessor {processorId} finished\t[{processorPid}:{workerId}]")
 
     with workerThreadCount as workerId:
         workerPid = get_native_id()
-        logger.info(f"۞\tstarted\t[{workerPid}:{workerId}]")
+        logger.info(f"۞\tstarted with {processorThreads} processor(s)\t[{workerPid}:{workerId}]")
 
-        sleepInterval = 0.5
+        processors = [
+            Thread(target=processor, args=(processorId,), name=f"processor-{processorId}", daemon=True)
+            for processorId in range(processorThreads)
+        ]
+        for processorThread in processors:
+            processorThread.start()
+
+        statsTime = time.time()
+        processedCount = 0
         while (not shutDown[0]) and observer.is_alive():
-            time.sleep(sleepInterval)
-            sleepInterval = min(sleepInterval + 1.0, 5.0)
+            slots = readyQueue.maxsize - readyQueue.qsize()
 
-            nowTime = int(time.time())
+            with handler.deck:
+                nowTime = time.time()
+                handler.evict_mod_deck(nowTime)
+                readyFiles, readyInSec = handler.pop_ready(assumeClosedSec, max(slots, 0), nowTime)
+                if not readyFiles:
+                    if (slots > 0) and (readyInSec is not None):
+                        # sleep until the next file is ready (or until on_any_event schedules one sooner)
+                        logger.debug(f"⏿\tnext file ready in {readyInSec:.3f} seconds\t[{workerPid}:{workerId}]")
+                        handler.readyChanged.wait(min(readyInSec, WORKER_MAX_WAIT_SEC))
+                    else:
+                        # nothing is scheduled, or the processors are backed up and will notify when they catch up
+                        handler.readyChanged.wait(WORKER_MAX_WAIT_SEC)
+                    continue
 
-            with handler.deck as d:
-                for fileName, fileHistory in list(d.items()):
-                    logger.debug(f"⏿ checking {fileName}\t{json.dumps(fileHistory)}\t[{workerPid}:{workerId}]")
+            # hand off the ready files outside of the deck lock (there are at most as many as there are free slots)
+            queuedTime = time.time()
+            for fileName, fileHistory in readyFiles:
+                logger.debug(f"⏿ ready {fileName}\t{json.dumps(fileHistory)}\t[{workerPid}:{workerId}]")
+                waitedSec = (nowTime - fileHistory[-1].timestamp) if (fileHistory[-1].timestamp > 0) else 0
+                latencies['waiting'].observe(waitedSec)
+                readyQueue.put((fileName, round(waitedSec, 3), queuedTime))
+            processedCount += len(readyFiles)
 
-                    if len(fileHistory) > 0:
-                        if nowTime < fileHistory[-1].timestamp + assumeClosedSec:
-                            # we can break because the list is ordered
-                            logger.debug(
-                                f"⎊\tbreaking early because {nowTime} < {fileHistory[-1].timestamp + assumeClosedSec}\t[{workerPid}:{workerId}]"
-                            )
-                            break
-
-                        elif (
-                            # - If we're polling, rely on the timestamp comparison done above and process this file
-                            handler.polling
-                            # - If we're not polling, but we have a timestamp == 0, then we had a FileClosedEvent and can be processed
-                            or (fileHistory[-1].timestamp == 0)
-                            # - If we're not polling, and the item has expired (timestamp comparison done above) and the only items
-                            #     in this item's history are "created" or "moved" then this was atomically moved in from another directory
-                            #     on the same filesystem and should be processed now
-                            or (
-                                not any(
-                                    set([x.operation for x in fileHistory if x.operation not in ('created', 'moved')])
-                                )
-                            )
-                        ):
-                            del d[fileName]
-                            if fileProcessor is not None:
-                                extraArgs = (
-                                    fileProcessorKwargs
-                                    if fileProcessorKwargs and isinstance(fileProcessorKwargs, dict)
-                                    else {}
-                                )
-                                fileProcessor(
-                                    fileName,
-                                    **extraArgs,
-                                )
-                            logger.info(
-                                f"🖄\tprocessed\t{fileName} at {(nowTime-fileHistory[-1].timestamp) if (fileHistory[-1].timestamp > 0) else 0} seconds\t[{workerPid}:{workerId}]"
-                            )
-                            sleepInterval = 0.5
+            if (processedCount > 0) and (queuedTime - statsTime >= LATENCY_LOG_INTERVAL_SEC):
+                logger.info(f"⏱\t{'; '.join(str(x) for x in latencies.values())}\t[{workerPid}:{workerId}]")
+                statsTime = queuedTime
+                processedCount = 0
+
+        # let the processors finish what's already been queued, then stop them
+        for processorThread in processors:
+            readyQueue.put(None)
+        for processorThread in processors:
+            processorThread.join()
 
         time.sleep(1)
+        logger.info(f"⏱\t{'; '.join(str(x) for x in latencies.values())}\t[{workerPid}:{workerId}]")
         logger.info(f"⛒\tfinished\t[{workerPid}:{workerId}]")
 
 
+###################################################################################################
+# Observers (for use in place of watchdog's Observer and PollingObserver) which scale better to
+#   directories with lots of files and lots of churn. Use create_observer to get the right one.
+
+# inotify(7), called directly through libc
+INOTIFY_IN_CLOSE_WRITE = 0x00000008
+INOTIFY_IN_MOVED_FROM = 0x00000040
+INOTIFY_IN_MOVED_TO = 0x00000080
+INOTIFY_IN_CREATE = 0x00000100
+INOTIFY_IN_DELETE = 0x00000200
+INOTIFY_IN_DELETE_SELF = 0x00000400
+INOTIFY_IN_MOVE_SELF = 0x00000800
+INOTIFY_IN_Q_OVERFLOW = 0x00004000
+INOTIFY_IN_IGNORED = 0x00008000
+INOTIFY_IN_ONLYDIR = 0x01000000
+INOTIFY_IN_DONT_FOLLOW = 0x02000000
+INOTIFY_IN_EXCL_UNLINK = 0x04000000
+INOTIFY_IN_ISDIR = 0x40000000
+INOTIFY_WATCH_MASK = (
+    INOTIFY_IN_CLOSE_WRITE
+    | INOTIFY_IN_MOVED_FROM
+    | INOTIFY_IN_MOVED_TO
+    | INOTIFY_IN_CREATE
+    | INOTIFY_IN_DELETE
+    | INOTIFY_IN_DELETE_SELF
+    | INOTIFY_IN_MOVE_SELF
+    | INOTIFY_IN_ONLYDIR
+    | INOTIFY_IN_DONT_FOLLOW
+    | INOTIFY_IN_EXCL_UNLINK
+)
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INOTIFY_READ_BYTES = 64 * 1024
+INOTIFY_BATCH_MAX_BYTES = 4 * 1024 * 1024
+# how long to let a burst of events accumulate before reading them, so events for the same file coalesce
+INOTIFY_BATCH_SEC = 0.1
+# when the kernel's event queue overflows, files changed (mtime or ctime, which renames update) since shortly
+#   before the previous read are reported again, rather than everything in the tree
+INOTIFY_OVERFLOW_SLACK_SEC = 2
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _libc.inotify_init1.argtypes = [ctypes.c_int]
+    _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    INOTIFY_AVAILABLE = True
+except (OSError, AttributeError):
+    _libc = None
+    INOTIFY_AVAILABLE = False
+
+# polling: files whose mtime (or last observed change) is older than this are assumed to be done being
+#   written and are only stat'ed when their directory changes or during a full scan (every
+#   POLLING_FULL_SCAN_SEC seconds). a directory's listing is only trusted while its mtime is unchanged and
+#   at least POLLING_DIR_SLACK_SEC older than when it was listed (timestamps are coarse, clocks may skew).
+POLLING_HOT_SEC_DEFAULT = 60
+POLLING_FULL_SCAN_SEC_DEFAULT = 300
+POLLING_DIR_SLACK_SEC = 5
+POLLING_SNAPSHOT_SAVE_SEC = 60
+POLLING_SNAPSHOT_VERSION = 1
+
+
+class InotifyBatchEmitter(EventEmitter):
+    # Watches only for files being closed after writing (FileClosedEvent), moved in (FileCreatedEvent),
+    #   renamed (FileMovedEvent) or removed (FileDeletedEvent), not for every open, write and attribute
+    #   change. Events are read a burst at a time and repeated events for a file within a burst are
+    #   coalesced into one. For recursive watches, directories are watched as they're created or moved in,
+    #   and files already in them are reported as created.
+    def __init__(self, event_queue, watch, *, timeout=DEFAULT_EMITTER_TIMEOUT, event_filter=None):
+        super().__init__(event_queue, watch, timeout=timeout, event_filter=event_filter)
+        self._lock = Lock()
+        self._fd = None
+        self._wdPaths = {}
+        # an IN_MOVED_FROM at the very end of a batch, which might be paired in the next one
+        self._heldMove = None
+        self._lastRead = 0
+
+    def on_thread_start(self):
+        fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._fd = fd
+        self._lastRead = time.time()
+        self._watch_tree(self.watch.path, None)
+
+    def on_thread_stop(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _watch_tree(self, path, batch, changedSince=None):
+        # add watches for path (and, if recursive, its subdirectories). if batch is given, files found are
+        #   added to it as created (only those changed since changedSince, if it's given)
+        dirs = [path]
+        while dirs:
+            dirPath = dirs.pop()
+            wd = _libc.inotify_add_watch(self._fd, os.fsencode(dirPath), INOTIFY_WATCH_MASK)
+            if wd < 0:
+                logging.warning(f"👁\tcould not watch {dirPath}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._wdPaths[wd] = dirPath
+            if self.watch.is_recursive or (batch is not None):
+                try:
+                    entries = list(os.scandir(dirPath))
+                except OSError:
+                    continue
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.watch.is_recursive:
+                                dirs.append(entry.path)
+                        elif (batch is not None) and entry.is_file(follow_symlinks=False):
+                            if changedSince is not None:
+                                fileStat = entry.stat(follow_symlinks=False)
+                                if max(fileStat.st_mtime, fileStat.st_ctime) < changedSince:
+                                    continue
+                            batch.add(entry.path, FileCreatedEvent(entry.path))
+                    except OSError:
+                        pass
+
+    def _unwatch_tree(self, path):
+        for wd, dirPath in list(self._wdPaths.items()):
+            if (dirPath == path) or dirPath.startswith(path + os.sep):
+                _libc.inotify_rm_watch(self._fd, wd)
+                self._wdPaths.pop(wd, None)
+
+    def _move_tree(self, srcPath, destPath, batch):
+        for wd, dirPath in list(self._wdPaths.items()):
+            if (dirPath == srcPath) or dirPath.startswith(srcPath + os.sep):
+                self._wdPaths[wd] = destPath + dirPath[len(srcPath) :]
+        for root, _, fileNames in os.walk(destPath):
+            for fileName in fileNames:
+                movedPath = os.path.join(root, fileName)
+                batch.add(movedPath, FileMovedEvent(srcPath + movedPath[len(destPath) :], movedPath))
+
+    def _read(self):
+        chunks = []
+        total = 0
+        while total < INOTIFY_BATCH_MAX_BYTES:
+            try:
+                chunk = os.read(self._fd, INOTIFY_READ_BYTES)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+            total += len(chunk)
+        return b''.join(chunks)
+
+    def _parse(self, data):
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, nameLen = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + nameLen].rstrip(b'\0'))
+            offset += nameLen
+            yield wd, mask, cookie, name
+
+    def _unpaired_move_from(self, srcPath, isDir, batch):
+        # moved out of the watched tree
+        if isDir:
+            self._unwatch_tree(srcPath)
+        else:
+            batch.delete(srcPath)
+
+    def queue_events(self, timeout):
+        try:
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+        except (OSError, TypeError, ValueError):
+            # the descriptor was closed out from under us while stopping
+            return
+        if (not readable) and (self._heldMove is None):
+            return
+        if readable and self.stopped_event.wait(INOTIFY_BATCH_SEC):
+            return
+
+        with self._lock:
+            if (self._fd is None) or (not self.should_keep_running()):
+                return
+            batch = InotifyBatch()
+            moves = OrderedDict()
+            if self._heldMove is not None:
+                moves[self._heldMove[0]] = self._heldMove[1:]
+                self._heldMove = None
+
+            lastRead, self._lastRead = self._lastRead, time.time()
+            rawEvents = list(self._parse(self._read()))
+            for idx, (wd, mask, cookie, name) in enumerate(rawEvents):
+                if mask & INOTIFY_IN_Q_OVERFLOW:
+                    logging.warning(f"👁\tinotify queue overflowed for {self.watch.path}, rescanning")
+                    self._watch_tree(self.watch.path, batch, changedSince=lastRead - INOTIFY_OVERFLOW_SLACK_SEC)
+                    continue
+
+                dirPath = self._wdPaths.get(wd, None)
+                if dirPath is None:
+                    continue
+                if mask & INOTIFY_IN_IGNORED:
+                    self._wdPaths.pop(wd, None)
+                    continue
+                if mask & (INOTIFY_IN_DELETE_SELF | INOTIFY_IN_MOVE_SELF):
+                    if dirPath == self.watch.path:
+                        self.queue_event(DirDeletedEvent(dirPath))
+                        self.stop()
+                        return
+                    continue
+
+                path = os.path.join(dirPath, name)
+                isDir = bool(mask & INOTIFY_IN_ISDIR)
+                if mask & INOTIFY_IN_MOVED_FROM:
+                    if (idx == len(rawEvents) - 1) and not readable:
+                        self._unpaired_move_from(path, isDir, batch)
+                    elif idx == len(rawEvents) - 1:
+                        # its IN_MOVED_TO may not have been queued yet, hang on to it until the next batch
+                        self._heldMove = (cookie, path, isDir)
+                    else:
+                        moves[cookie] = (path, isDir)
+
+                elif mask & INOTIFY_IN_MOVED_TO:
+                    srcPath, _ = moves.pop(cookie, (None, None))
+                    if isDir:
+                        if srcPath is not None:
+                            self._move_tree(srcPath, path, batch)
+                        elif self.watch.is_recursive:
+                            self._watch_tree(path, batch)
+                    elif srcPath is not None:
+                        batch.add(path, FileMovedEvent(srcPath, path))
+                    else:
+                        batch.add(path, FileCreatedEvent(path))
+
+                elif isDir:
+                    if (mask & INOTIFY_IN_CREATE) and self.watch.is_recursive:
+                        self._watch_tree(path, batch)
+                    elif mask & INOTIFY_IN_DELETE:
+                        self._unwatch_tree(path)
+
+                elif mask & INOTIFY_IN_CLOSE_WRITE:
+                    batch.add(path, FileClosedEvent(path))
+
+                elif mask & INOTIFY_IN_DELETE:
+                    batch.delete(path)
+
+            for srcPath, isDir in moves.values():
+                self._unpaired_move_from(srcPath, isDir, batch)
+
+        for event in batch.events():
+            self.queue_event(event)
+
+
+class InotifyBatch(object):
+    # events for a single batch, in the order of each file's most recent event
+    def __init__(self):
+        self.pending = OrderedDict()
+
+    def add(self, path, event):
+        pathEvents = self.pending.pop(path, [])
+        if pathEvents and (type(pathEvents[-1]) is type(event)) and (pathEvents[-1].src_path == event.src_path):
+            # the same thing happened to this file again, just keep the latest
+            pathEvents[-1] = event
+        else:
+            pathEvents.append(event)
+        self.pending[path] = pathEvents
+
+    def delete(self, path):
+        # anything else that happened to a file that's now deleted doesn't matter, other than it
+        #   having been moved here from somewhere else (in which case that's been deleted too)
+        pathEvents = [
+            FileDeletedEvent(event.src_path)
+            for event in self.pending.pop(path, [])
+            if isinstance(event, FileMovedEvent) and (event.src_path != path)
+        ]
+        pathEvents.append(FileDeletedEvent(path))
+        self.pending[path] = pathEvents
+
+    def events(self):
+        for pathEvents in self.pending.values():
+            yield from pathEvents
+
+
+class InotifyBatchObserver(BaseObserver):
+    def __init__(self, *, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        super().__init__(InotifyBatchEmitter, timeout=timeout)
+
+
+class SnapshotPollingEmitter(EventEmitter):
+    # Polls a directory tree like watchdog's PollingEmitter, but incrementally: a directory whose mtime
+    #   hasn't changed since it was listed isn't listed again, and only its files which are still being
+    #   written ("hot" ones) are stat'ed. Everything is checked again every fullScanSec seconds. The
+    #   snapshot is saved to snapshotDir (if given) so that restarting doesn't require walking and
+    #   stat'ing the whole tree again.
+    def __init__(
+        self,
+        event_queue,
+        watch,
+        *,
+        timeout=DEFAULT_EMITTER_TIMEOUT,
+        event_filter=None,
+        snapshotDir=None,
+        hotSec=POLLING_HOT_SEC_DEFAULT,
+        fullScanSec=POLLING_FULL_SCAN_SEC_DEFAULT,
+    ):
+        super().__init__(event_queue, watch, timeout=timeout, event_filter=event_filter)
+        self._lock = Lock()
+        self._hotSec = hotSec
+        self._fullScanSec = fullScanSec
+        self._lastFullScan = 0
+        self._lastSave = 0
+        self._dirty = False
+        # self._dirs maps each directory to [mtime (ns), time listed, {file name: [inode, size, mtime (ns),
+        #   time we saw it change]}, set of subdirectory names]
+        self._dirs = {}
+        self._snapshotFile = (
+            os.path.join(
+                snapshotDir,
+                f"watch-{hashlib.sha1(f'{os.path.abspath(watch.path)}:{watch.is_recursive}'.encode()).hexdigest()}.json",
+            )
+            if snapshotDir
+            else None
+        )
+
+    def on_thread_start(self):
+        with self._lock:
+            # without a snapshot to compare against, what's there now is just the starting point. with one,
+            #   report whatever changed while we weren't watching
+            loaded = self._load()
+            changes = self._scan(full=False, baseline=not loaded)
+            self._lastFullScan = time.time()
+            self._save()
+        if loaded:
+            self._queue_changes(*changes)
+
+    def on_thread_stop(self):
+        with self._lock:
+            self._save()
+
+    def _load(self):
+        if self._snapshotFile and os.path.isfile(self._snapshotFile):
+            try:
+                with open(self._snapshotFile, 'r') as f:
+                    snapshot = json.load(f)
+                if (
+                    (snapshot.get('version', 0) == POLLING_SNAPSHOT_VERSION)
+                    and (snapshot.get('path', None) == self.watch.path)
+                    and (snapshot.get('recursive', None) == self.watch.is_recursive)
+                ):
+                    self._dirs = {
+                        dirPath: [dirMtime, listed, {name: info + [0] for name, info in files.items()}, set(subdirs)]
+                        for dirPath, (dirMtime, listed, files, subdirs) in snapshot['dirs'].items()
+                    }
+                    return True
+            except Exception as e:
+                logging.warning(f"👁\tcould not load {self._snapshotFile}: {e}")
+                self._dirs = {}
+        return False
+
+    def _save(self):
+        if self._snapshotFile and self._dirty:
+            try:
+                tmpFile = f"{self._snapshotFile}.tmp"
+                with open(tmpFile, 'w') as f:
+                    json.dump(
+                        {
+                            'version': POLLING_SNAPSHOT_VERSION,
+                            'path': self.watch.path,
+                            'recursive': self.watch.is_recursive,
+                            'dirs': {
+                                dirPath: [
+                                    dirMtime,
+                                    listed,
+                                    {name: info[:3] for name, info in files.items()},
+                                    list(subdirs),
+                                ]
+                                for dirPath, (dirMtime, listed, files, subdirs) in self._dirs.items()
+                            },
+                        },
+                        f,
+                        separators=(',', ':'),
+                    )
+                os.replace(tmpFile, self._snapshotFile)
+                self._dirty = False
+            except Exception as e:
+                logging.warning(f"👁\tcould not save {self._snapshotFile}: {e}")
+            self._lastSave = time.time()
+
+    def _is_hot(self, info, nowTime):
+        return max(info[2] / 1e9, info[3]) + self._hotSec >= nowTime
+
+    def _scan(self, full, baseline=False):
+        # returns (created, deleted, modified) as ({path: inode}, {path: inode}, [path])
+        nowTime = time.time()
+        # files seen for the first time when building the baseline are only hot if their mtime says so
+        changedAt = 0 if baseline else nowTime
+        created, deleted, modified = {}, {}, []
+        visited = set()
+        dirs = [self.watch.path]
+        while dirs:
+            dirPath = dirs.pop()
+            visited.add(dirPath)
+            try:
+                dirStat = os.stat(dirPath)
+            except OSError:
+                if dirPath == self.watch.path:
+                    raise
+                continue
+
+            prev = self._dirs.get(dirPath, None)
+            if (
+                (not full)
+                and prev
+                and (prev[0] == dirStat.st_mtime_ns)
+                and (dirStat.st_mtime_ns / 1e9 + POLLING_DIR_SLACK_SEC < prev[1])
+            ):
+                # the directory's entries haven't changed, so only check the files that may still be being written
+                files, subdirs = prev[2], prev[3]
+                for name, info in list(files.items()):
+                    if self._is_hot(info, nowTime):
+                        filePath = os.path.join(dirPath, name)
+                        try:
+                            fileStat = os.stat(filePath, follow_symlinks=False)
+                        except OSError:
+                            deleted[filePath] = info[0]
+                            files.pop(name, None)
+                            self._dirty = True
+                            continue
+                        if (fileStat.st_size != info[1]) or (fileStat.st_mtime_ns != info[2]):
+                            modified.append(filePath)
+                            files[name] = [fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns, nowTime]
+                            self._dirty = True
+
+            else:
+                oldFiles = prev[2] if prev else {}
+                files, subdirs = {}, set()
+                try:
+                    entries = list(os.scandir(dirPath))
+                except OSError:
+                    entries = []
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.add(entry.name)
+                            continue
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        info = oldFiles.get(entry.name, None)
+                        if (not full) and info and (info[0] == entry.inode()) and (not self._is_hot(info, nowTime)):
+                            # the same file as before, and it's been quiet
+                            files[entry.name] = info
+                            continue
+                        fileStat = entry.stat(follow_symlinks=False)
+                        if (info is None) or (info[0] != fileStat.st_ino):
+                            if info is not None:
+                                deleted[entry.path] = info[0]
+                            created[entry.path] = fileStat.st_ino
+                            files[entry.name] = [fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns, changedAt]
+                        elif (fileStat.st_size != info[1]) or (fileStat.st_mtime_ns != info[2]):
+                            modified.append(entry.path)
+                            files[entry.name] = [fileStat.st_ino, fileStat.st_size, fileStat.st_mtime_ns, nowTime]
+                        else:
+                            files[entry.name] = info
+                    except OSError:
+                        continue
+                for name, info in oldFiles.items():
+                    if name not in files:
+                        deleted[os.path.join(dirPath, name)] = info[0]
+                self._dirs[dirPath] = [dirStat.st_mtime_ns, nowTime, files, subdirs]
+                self._dirty = True
+
+            if self.watch.is_recursive:
+                dirs.extend(os.path.join(dirPath, subdir) for subdir in subdirs)
+
+        # directories that are gone
+        for dirPath in [x for x in self._dirs if x not in visited]:
+            for name, info in self._dirs.pop(dirPath)[2].items():
+                deleted[os.path.join(dirPath, name)] = info[0]
+            self._dirty = True
+
+        return created, deleted, modified
+
+    def queue_events(self, timeout):
+        # timeout is the polling interval
+        if self.stopped_event.wait(timeout):
+            return
+
+        with self._lock:
+            if not self.should_keep_running():
+                return
+            nowTime = time.time()
+            full = nowTime - self._lastFullScan >= self._fullScanSec
+            try:
+                created, deleted, modified = self._scan(full)
+            except OSError:
+                self.queue_event(DirDeletedEvent(self.watch.path))
+                self.stop()
+                return
+            if full:
+                self._lastFullScan = nowTime
+            if self._dirty and (nowTime - self._lastSave >= POLLING_SNAPSHOT_SAVE_SEC):
+                self._save()
+
+        self._queue_changes(created, deleted, modified)
+
+    def _queue_changes(self, created, deleted, modified):
+        # files which disappeared from one place and showed up in another with the same inode were moved
+        createdInodes = {inode: path for path, inode in created.items()}
+        moved = []
+        for srcPath, inode in list(deleted.items()):
+            if (destPath := createdInodes.pop(inode, None)) is not None:
+                moved.append((srcPath, destPath))
+                deleted.pop(srcPath)
+                created.pop(destPath)
+
+        for srcPath in deleted:
+            self.queue_event(FileDeletedEvent(srcPath))
+        for srcPath in modified:
+            self.queue_event(FileModifiedEvent(srcPath))
+        for srcPath in created:
+            self.queue_event(FileCreatedEvent(srcPath))
+        for srcPath, destPath in moved:
+            self.queue_event(FileMovedEvent(srcPath, destPath))
+
+
+class SnapshotPollingObserver(BaseObserver):
+    def __init__(
+        self,
+        *,
+        timeout=DEFAULT_OBSERVER_TIMEOUT,
+        snapshotDir=None,
+        hotSec=POLLING_HOT_SEC_DEFAULT,
+        fullScanSec=POLLING_FULL_SCAN_SEC_DEFAULT,
+    ):
+        super().__init__(
+            partial(SnapshotPollingEmitter, snapshotDir=snapshotDir, hotSec=hotSec, fullScanSec=fullScanSec),
+            timeout=timeout,
+        )
+
+
+def create_observer(polling, assumeClosedSec=ASSUME_CLOSED_SEC_DEFAULT):
+    if polling:
+        # files need to be checked for as long as they might still be written to
+        return SnapshotPollingObserver(
+            snapshotDir=gettempdir(),
+            hotSec=max(POLLING_HOT_SEC_DEFAULT, 2 * assumeClosedSec),
+        )
+    elif INOTIFY_AVAILABLE:
+        return InotifyBatchObserver()
+    else:
+        return Observer()
+
+
 def WatchAndProcessDirectory(
     directories,
     polling,
@@ -293,8 +1024,9 @@ def WatchAndProcessDirectory(
     assumeClosedSec,
     shuttingDown,
     logger,
+    processorThreads=PROCESSOR_THREADS_DEFAULT,
 ):
-    observer = PollingObserver() if polling else Observer()
+    observer = create_observer(polling, assumeClosedSec)
     loggerToUse = logger if logger else logging
     handler = FileOperationEventHandler(
         logger=loggerToUse,
@@ -319,6 +1051,7 @@ def WatchAndProcessDirectory(
                     workerThreadCount,
                     shuttingDown,
                     loggerToUse,
+                    processorThreads,
                 ],
             ),
         )
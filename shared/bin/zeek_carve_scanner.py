@@ -29,6 +29,9 @@ from zeek_carve_utils import (
     BroSignatureLine,
     CapaScan,
     CarvedFileSubscriberThreaded,
+    CLAM_BATCH_SIZE,
+    CLAM_MAX_SESSIONS,
+    CLAM_STREAM_MAX_BYTES,
     ClamAVScan,
     extracted_filespec_to_fields,
     FILE_SCAN_RESULT_DESCRIPTION,
@@ -45,6 +48,9 @@ from zeek_carve_utils import (
     PRESERVE_PRESERVED_DIR_NAME,
     PRESERVE_QUARANTINED,
     PRESERVE_QUARANTINED_DIR_NAME,
+    SCAN_CACHE_FILE_SUFFIX,
+    SCAN_CACHE_MAX_ENTRIES,
+    ScanResultCache,
     SINK_PORT,
     VENTILATOR_PORT,
     VirusTotalSearch,
@@ -54,7 +60,7 @@ from zeek_carve_utils import (
     ZEEK_SIGNATURE_NOTICE,
 )
 import malcolm_utils
-from malcolm_utils import eprint, str2bool, AtomicInt
+from malcolm_utils import eprint, str2bool, AtomicInt, sha256sum
 
 
 ###################################################################################################
@@ -108,7 +114,7 @@ def locate_file(fileInfo):
 
 
 ###################################################################################################
-def scanFileWorker(checkConnInfo, carvedFileSub):
+def scanFileWorker(checkConnInfo, carvedFileSub, scanCache=None):
     global shuttingDown
     global scanWorkersCount
 
@@ -131,6 +137,8 @@ def scanFileWorker(checkConnInfo, carvedFileSub):
 
             fileInfo = None
             fileName = None
+            fileHash = None
+            rulesetVersion = None
             retrySubmitFile = False  # todo: maximum file retry count?
 
             # loop forever, or until we're told to shut down
@@ -160,8 +168,36 @@ def scanFileWorker(checkConnInfo, carvedFileSub):
                     retrySubmitFile = False
                     # read watched file information from the subscription
                     fileInfo = carvedFileSub.Pull(scanWorkerId=scanWorkerId)
+                    fileHash = None
+                    rulesetVersion = None
 
                 fileName = locate_file(fileInfo)
+
+                # if we've already scanned this exact payload with the current ruleset, reuse that result
+                if (
+                    (scanCache is not None)
+                    and (fileHash is None)
+                    and (fileName is not None)
+                    and os.path.isfile(fileName)
+                ):
+                    rulesetVersion = checkConnInfo.ruleset_version()
+                    if rulesetVersion is not None:
+                        try:
+                            fileHash = sha256sum(fileName)
+                        except OSError:
+                            fileHash = None
+                    if fileHash is not None:
+                        cachedResult = scanCache.get(fileHash, checkConnInfo.scanner_name(), rulesetVersion)
+                        if cachedResult is not None:
+                            cachedResult[FILE_SCAN_RESULT_FILE] = fileName
+                            retrySubmitFile = False
+                            try:
+                                scanned_files_socket.send_string(json.dumps(cachedResult))
+                                logging.info(f"{scriptName}[{scanWorkerId}]:\t♻️\t{fileName}")
+                            except zmq.Again:
+                                logging.debug(f"{scriptName}[{scanWorkerId}]:\t🕑\t{fileName}")
+                            continue
+
                 if (fileName is not None) and os.path.isfile(fileName):
                     # file exists, submit for scanning
                     logging.info(f"{scriptName}[{scanWorkerId}]:\t🔎\t{json.dumps(fileInfo)}")
@@ -185,7 +221,7 @@ def scanFileWorker(checkConnInfo, carvedFileSub):
                             fileName=fileName,
                             fileSize=fileSize,
                             fileType=fileInfo[FILE_SCAN_RESULT_FILE_TYPE],
-                            block=False,
+                            block=True,
                         ),
                     )
                     if scan.submissionResponse is not None:
@@ -196,9 +232,13 @@ def scanFileWorker(checkConnInfo, carvedFileSub):
                         requestComplete = False
 
                         # todo: maximum time we wait for a single file to be scanned?
+                        checkCount = 0
                         while (not requestComplete) and (not shuttingDown):
-                            # wait a moment then check to see if the scan is complete
-                            time.sleep(scan.provider.check_interval())
+                            # check to see if the scan is complete (the synchronous providers will already be
+                            # finished by the time submit returns), waiting a moment between subsequent checks
+                            if checkCount > 0:
+                                time.sleep(scan.provider.check_interval())
+                            checkCount += 1
                             response = scan.provider.check_result(scan.submissionResponse)
 
                             if isinstance(response, AnalyzerResult):
@@ -227,13 +267,25 @@ def scanFileWorker(checkConnInfo, carvedFileSub):
                                 eprint(f"{scriptName}[{scanWorkerId}]:\t❗{fileName} {scanResult}")
 
                     else:
-                        # we were denied (rate limiting, probably), so we'll need wait for a slot to clear up
+                        # we were denied (timed out waiting for the rate limiter or the engine), so try again
                         retrySubmitFile = True
 
                     if requestComplete and (scanResult is not None):
+                        scanResultDict = scan.provider.format(fileName, scanResult)
+
+                        # only successful scans are cached, errors get another chance next time (including those
+                        #   reported as a successful request with an error result, like capa's timeouts)
+                        if (
+                            (fileHash is not None)
+                            and isinstance(scanResult, AnalyzerResult)
+                            and scanResult.success
+                            and not (isinstance(scanResult.result, dict) and ("error" in scanResult.result))
+                        ):
+                            scanCache.put(fileHash, scan.provider.scanner_name(), rulesetVersion, scanResultDict)
+
                         try:
                             # Send results to sink
-                            scanned_files_socket.send_string(json.dumps(scan.provider.format(fileName, scanResult)))
+                            scanned_files_socket.send_string(json.dumps(scanResultDict))
                             logging.info(f"{scriptName}[{scanWorkerId}]:\t✅\t{fileName}")
 
                         except zmq.Again:
@@ -286,6 +338,36 @@ def main():
         default=None,
         required=False,
     )
+    parser.add_argument(
+        '--stats-interval',
+        dest='statsInterval',
+        help="Seconds between reporting rate limiter wait time metrics (0 to disable)",
+        metavar='<seconds>',
+        type=int,
+        default=int(os.getenv('EXTRACTED_FILE_SCANNER_STATS_INTERVAL_SEC', 300)),
+        required=False,
+    )
+    parser.add_argument(
+        '--cache-dir',
+        dest='cacheDir',
+        help="Directory for persistent scan result cache",
+        metavar='<pathspec>',
+        type=str,
+        default=os.getenv(
+            'EXTRACTED_FILE_SCAN_CACHE_DIR',
+            os.path.join(os.getenv('ZEEK_LOG_DIRECTORY', '/zeek/logs'), '.scan_cache'),
+        ),
+        required=False,
+    )
+    parser.add_argument(
+        '--cache-max',
+        dest='cacheMax',
+        help="Maximum number of scan results to cache (0 to disable caching)",
+        metavar='<entries>',
+        type=int,
+        default=int(os.getenv('EXTRACTED_FILE_SCAN_CACHE_MAX', SCAN_CACHE_MAX_ENTRIES)),
+        required=False,
+    )
     parser.add_argument(
         '--vtot-api', dest='vtotApi', help="VirusTotal API key", metavar='<API key>', type=str, required=False
     )
@@ -309,6 +391,53 @@ def main():
         required=False,
         default=None,
     )
+    parser.add_argument(
+        '--clamav-address',
+        dest='clamAvAddress',
+        help="ClamAV TCP address (host[:port]) to use instead of the socket file (implies --clamav-instream)",
+        metavar='<host[:port]>',
+        type=str,
+        required=False,
+        default=os.getenv('CLAMD_ADDRESS', None),
+    )
+    parser.add_argument(
+        '--clamav-instream',
+        dest='clamAvInstream',
+        metavar='true|false',
+        help="Stream file contents to ClamAV rather than having it read them from the filesystem",
+        type=str2bool,
+        nargs='?',
+        const=True,
+        default=str2bool(os.getenv('CLAMD_INSTREAM', default='False')),
+        required=False,
+    )
+    parser.add_argument(
+        '--clamav-sessions',
+        dest='clamAvSessions',
+        help="Number of persistent ClamAV sessions",
+        metavar='<sessions>',
+        type=int,
+        default=int(os.getenv('CLAMD_MAX_SESSIONS', CLAM_MAX_SESSIONS)),
+        required=False,
+    )
+    parser.add_argument(
+        '--clamav-batch',
+        dest='clamAvBatchSize',
+        help="Maximum number of files submitted to a ClamAV session at once",
+        metavar='<files>',
+        type=int,
+        default=int(os.getenv('CLAMD_BATCH_SIZE', CLAM_BATCH_SIZE)),
+        required=False,
+    )
+    parser.add_argument(
+        '--clamav-stream-max',
+        dest='clamAvStreamMaxBytes',
+        help="Maximum size of file to stream to ClamAV (should match clamd.conf StreamMaxLength)",
+        metavar='<bytes>',
+        type=int,
+        default=int(os.getenv('CLAMD_STREAM_MAX_BYTES', os.getenv('EXTRACTED_FILE_MAX_BYTES', CLAM_STREAM_MAX_BYTES))),
+        required=False,
+    )
     parser.add_argument(
         '--yara',
         dest='enableYara',
@@ -345,6 +474,17 @@ def main():
     parser.add_argument(
         '--capa-rules', dest='capaRulesDir', help="Capa Rules Directory", metavar='<pathspec>', type=str, required=False
     )
+    parser.add_argument(
+        '--capa-in-process',
+        dest='capaInProcess',
+        metavar='true|false',
+        help="Analyze files with long-lived capa engine processes rather than running capa for each file",
+        type=str2bool,
+        nargs='?',
+        const=True,
+        default=str2bool(os.getenv('EXTRACTED_FILE_CAPA_IN_PROCESS', default='True')),
+        required=False,
+    )
     parser.add_argument(
         '--capa-verbose',
         dest='capaVerbose',
@@ -397,6 +537,7 @@ def main():
             logger=logging,
             rulesDirs=yaraDirs,
             reqLimit=args.reqLimit,
+            compiledDir=args.cacheDir,
         )
     elif args.enableCapa:
         checkConnInfo = CapaScan(
@@ -404,6 +545,7 @@ def main():
             rulesDir=args.capaRulesDir,
             verboseHits=args.capaVerbose,
             reqLimit=args.reqLimit,
+            inProcess=args.capaInProcess,
         )
     else:
         if not args.enableClamAv:
@@ -412,8 +554,26 @@ def main():
             logger=logging,
             socketFileName=args.clamAvSocket,
             reqLimit=args.reqLimit,
+            address=args.clamAvAddress,
+            instream=args.clamAvInstream,
+            sessions=args.clamAvSessions,
+            batchSize=args.clamAvBatchSize,
+            streamMaxBytes=args.clamAvStreamMaxBytes,
         )
 
+    # scanners which can identify their ruleset share a cache of previous results keyed on file content hash
+    scanCache = None
+    if (args.cacheMax > 0) and args.cacheDir and (not isinstance(checkConnInfo, VirusTotalSearch)):
+        try:
+            scanCache = ScanResultCache(
+                os.path.join(args.cacheDir, checkConnInfo.scanner_name() + SCAN_CACHE_FILE_SUFFIX),
+                maxEntries=args.cacheMax,
+            )
+            logging.info(f"{scriptName}:\tscan result cache {scanCache.path} ({len(scanCache)} entries)")
+        except Exception as e:
+            scanCache = None
+            logging.warning(f"{scriptName}:\tscan result cache disabled: {e}")
+
     carvedFileSub = CarvedFileSubscriberThreaded(
         logger=logging,
         host='localhost',
@@ -422,13 +582,25 @@ def main():
     )
 
     # start scanner threads which will pull filenames to be scanned and send the results to the logger
-    ThreadPool(checkConnInfo.max_requests(), scanFileWorker, ([checkConnInfo, carvedFileSub]))
+    ThreadPool(checkConnInfo.max_requests(), scanFileWorker, ([checkConnInfo, carvedFileSub, scanCache]))
+    statsTime = time.time()
     while not shuttingDown:
         if pdbFlagged:
             pdbFlagged = False
             breakpoint()
         time.sleep(0.2)
 
+        # periodically report how long files are waiting on the scanner's rate limiter
+        if args.statsInterval and (time.time() - statsTime >= args.statsInterval):
+            statsTime = time.time()
+            if limiterStats := checkConnInfo.limiter_stats():
+                logging.info(
+                    f"{scriptName}:\t⏱️\t{checkConnInfo.scanner_name()} "
+                    + f"active={limiterStats['active']} waiting={limiterStats['waiting']} "
+                    + f"acquired={limiterStats['acquired']} denied={limiterStats['denied']} "
+                    + f"wait_avg={limiterStats['wait_avg']:.3f}s wait_max={limiterStats['wait_max']:.3f}s"
+                )
+
     # graceful shutdown
     if debug:
         eprint(f"{scriptName}: shutting down...")
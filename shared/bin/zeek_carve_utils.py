@@ -3,13 +3,20 @@
 
 # Copyright (c) 2025 Battelle Energy Alliance, LLC.  All rights reserved.
 
-import clamd
+import hashlib
+import importlib.util
 import logging
+import multiprocessing
 import json
 import os
+import queue
 import re
 import requests
+import socket
+import sqlite3
+import struct
 import sys
+import tempfile
 import time
 import yara
 import zmq
@@ -17,15 +24,17 @@ import zmq
 from abc import ABC, abstractmethod
 from bs4 import BeautifulSoup
 from collections import Counter
-from collections import deque
 from collections import defaultdict
 from datetime import datetime
 from multiprocessing import RawValue
 from subprocess import PIPE, Popen
+from threading import Condition
 from threading import get_ident
+from threading import Event
 from threading import Lock
+from threading import Thread
 
-from malcolm_utils import eprint, sha256sum, run_process, AtomicInt, dictsearch
+from malcolm_utils import eprint, sha256sum, run_process, dictsearch
 
 ###################################################################################################
 VENTILATOR_PORT = 5987
@@ -72,6 +81,15 @@ CLAM_SUBMIT_TIMEOUT_SEC = 10
 CLAM_CHECK_INTERVAL = 0.1
 CLAM_ENGINE_ID = 'ClamAV'
 CLAM_FOUND_KEY = 'FOUND'
+CLAM_VERSION_CHECK_INTERVAL_SEC = 60
+CLAM_DEFAULT_SOCKET_FILE = '/var/run/clamav/clamd.ctl'
+CLAM_DEFAULT_PORT = 3310
+CLAM_MAX_SESSIONS = 2  # long-lived clamd sessions (IDSESSION) over which requests are pipelined
+CLAM_BATCH_SIZE = 8  # maximum requests pipelined over a session in one round trip
+CLAM_SESSION_TIMEOUT_SEC = 300
+CLAM_STREAM_CHUNK_BYTES = 64 * 1024
+CLAM_STREAM_MAX_BYTES = 25 * 1024 * 1024  # clamd.conf StreamMaxLength default
+CLAM_RESPONSE_REGEX = re.compile(r"^(?P<path>.*): ((?P<signature>.+) )?(?P<status>(FOUND|OK|ERROR))$")
 
 ###################################################################################################
 # Yara Interface
@@ -82,6 +100,9 @@ YARA_ENGINE_ID = 'Yara'
 YARA_MAX_REQS = 8  # maximum scanning threads concurrently
 YARA_CHECK_INTERVAL = 0.1
 YARA_RUN_TIMEOUT_SEC = 300
+YARA_RULES_CHECK_INTERVAL_SEC = 60
+YARA_COMPILED_PREFIX = 'yara-'
+YARA_COMPILED_SUFFIX = '.yarc'
 
 ###################################################################################################
 # Capa
@@ -112,6 +133,15 @@ CAPA_VIV_SUFFIX = '.viv'
 CAPA_VIV_MIME = 'data'
 CAPA_ATTACK_KEY = 'attack'
 CAPA_RUN_TIMEOUT_SEC = 300
+# rules and FLIRT signatures for the in-process capa engine (see capa-build.sh)
+CAPA_HOME_DIR = os.getenv('CAPA_HOME', '/opt/capa')
+CAPA_DEFAULT_RULES_DIR = os.path.join(CAPA_HOME_DIR, 'rules')
+CAPA_DEFAULT_SIGS_DIR = os.path.join(CAPA_HOME_DIR, 'sigs')
+
+###################################################################################################
+# scan result cache
+SCAN_CACHE_MAX_ENTRIES = 100000
+SCAN_CACHE_FILE_SUFFIX = '.db'
 
 ###################################################################################################
 
@@ -323,6 +353,255 @@ class CarvedFileSubscriberThreaded:
         return fileinfo
 
 
+###################################################################################################
+# return a digest identifying the contents of a set of rules files (or directories containing them), used to tell
+#   when a scanner's ruleset has changed out from under results that were cached with it
+def rules_digest(paths, extra=None):
+    h = hashlib.sha256()
+    fileNames = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                fileNames.update(
+                    [
+                        os.path.join(root, file)
+                        for file in files
+                        if not (file.startswith(".") or file.startswith("~") or file.startswith("_"))
+                    ]
+                )
+        elif os.path.isfile(path):
+            fileNames.add(path)
+    for fileName in sorted(fileNames):
+        try:
+            h.update(f"{fileName}\0{sha256sum(fileName)}\0".encode())
+        except OSError:
+            pass
+    if extra is not None:
+        h.update(f"{extra}".encode())
+    return h.hexdigest()
+
+
+###################################################################################################
+# a persistent, size-bounded (least-recently-used eviction) cache of formatted scan results, keyed on
+#   the content hash of the scanned file, the scanner name and the scanner's ruleset version, so that
+#   the same payload carved over and over again only needs to be scanned once per ruleset
+class ScanResultCache:
+    def __init__(self, path, maxEntries=SCAN_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        if path and (path != ':memory:'):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path if path else ':memory:', check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                'hash TEXT NOT NULL, '
+                'scanner TEXT NOT NULL, '
+                'version TEXT NOT NULL, '
+                'result TEXT NOT NULL, '
+                'accessed REAL NOT NULL, '
+                'PRIMARY KEY (hash, scanner, version))'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+            self.count = self.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    # the first time we see a new ruleset version for a scanner, anything cached with its old ruleset(s) is stale
+    def _check_version(self, scanner, version):
+        if self.versions.get(scanner) != version:
+            self.count -= self.conn.execute(
+                'DELETE FROM results WHERE scanner = ? AND version != ?', (scanner, version)
+            ).rowcount
+            self.versions[scanner] = version
+
+    def __len__(self):
+        with self.lock:
+            return self.count
+
+    # returns the cached result dict, or None if this file hasn't been scanned with this ruleset
+    def get(self, fileHash, scanner, version):
+        with self.lock:
+            self._check_version(scanner, version)
+            row = self.conn.execute(
+                'SELECT result FROM results WHERE hash = ? AND scanner = ? AND version = ?',
+                (fileHash, scanner, version),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute(
+                'UPDATE results SET accessed = ? WHERE hash = ? AND scanner = ? AND version = ?',
+                (time.time(), fileHash, scanner, version),
+            )
+        try:
+            return json.loads(row[0])
+        except (ValueError, TypeError):
+            return None
+
+    def put(self, fileHash, scanner, version, result):
+        with self.lock:
+            self._check_version(scanner, version)
+            self.count += self.conn.execute(
+                'INSERT OR IGNORE INTO results (hash, scanner, version, result, accessed) VALUES (?, ?, ?, ?, ?)',
+                (fileHash, scanner, version, json.dumps(result), time.time()),
+            ).rowcount
+            if (self.maxEntries > 0) and (self.count > self.maxEntries):
+                self.count -= self.conn.execute(
+                    'DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY accessed LIMIT ?)',
+                    (self.count - self.maxEntries,),
+                ).rowcount
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+###################################################################################################
+# limits requests to a scanning engine both by how many may be in progress at once (maxConcurrent) and by how
+#   many may be started in a given window (a token bucket of rateLimit tokens refilled over rateLimitSec seconds).
+#   acquire blocks on a condition variable until a slot and a token are available (or the timeout expires),
+#   and keeps track of how long callers had to wait
+class ScanLimiter:
+    def __init__(self, maxConcurrent=0, rateLimit=0, rateLimitSec=60):
+        self.maxConcurrent = maxConcurrent
+        self.rateLimit = rateLimit
+        self.rateLimitSec = rateLimitSec
+        self.cond = Condition(Lock())
+        self.active = 0
+        self.tokens = float(rateLimit)
+        self.refilled = time.monotonic()
+        self.waiting = 0
+        self.acquired = 0
+        self.denied = 0
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+    def _refill(self, nowTime):
+        if self.rateLimit > 0:
+            self.tokens = min(
+                float(self.rateLimit),
+                self.tokens + ((nowTime - self.refilled) * self.rateLimit / self.rateLimitSec),
+            )
+        self.refilled = nowTime
+
+    # how long until a request could be allowed (0 if it could go now, None if it's waiting on a release)
+    def _delay(self, nowTime):
+        if (self.maxConcurrent > 0) and (self.active >= self.maxConcurrent):
+            return None
+        if (self.rateLimit > 0) and (self.tokens < 1.0):
+            return (1.0 - self.tokens) * self.rateLimitSec / self.rateLimit
+        return 0
+
+    # returns True if the request may proceed (in which case release must be called when it's done)
+    def acquire(self, block=True, timeout=None):
+        startTime = time.monotonic()
+        with self.cond:
+            self.waiting += 1
+            try:
+                while True:
+                    nowTime = time.monotonic()
+                    self._refill(nowTime)
+                    delay = self._delay(nowTime)
+                    if delay == 0:
+                        break
+                    remaining = None if (timeout is None) else (startTime + timeout - nowTime)
+                    if (not block) or ((remaining is not None) and (remaining <= 0)):
+                        self.denied += 1
+                        return False
+                    waitFor = [x for x in (delay, remaining) if x is not None]
+                    self.cond.wait(timeout=min(waitFor) if waitFor else None)
+                self.active += 1
+                if self.rateLimit > 0:
+                    self.tokens -= 1.0
+                waitTime = time.monotonic() - startTime
+                self.acquired += 1
+                self.waitTotal += waitTime
+                self.waitMax = max(self.waitMax, waitTime)
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.cond:
+            self.active = max(0, self.active - 1)
+            self.cond.notify()
+
+    # queue wait time metrics for reporting
+    def stats(self):
+        with self.cond:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'acquired': self.acquired,
+                'denied': self.denied,
+                'wait_avg': (self.waitTotal / self.acquired) if (self.acquired > 0) else 0.0,
+                'wait_max': self.waitMax,
+            }
+
+
+###################################################################################################
+# a pool of long-lived scanning engine processes (see capa_engine_process and yara_engine_process) which do
+#   their expensive setup (e.g., loading rules) once when they start. each engine is called as
+#   target(conn, *args) and first sends back a count of the rules it loaded, then answers requests sent
+#   over its pipe until it receives None. a request is handed to an idle engine, and if the engine doesn't
+#   answer within the timeout it's killed and replaced with a fresh one (started with the current args)
+class ScanEnginePool:
+    def __init__(self, workers, target, args=(), timeout=None, name='engine', logger=None):
+        self.target = target
+        self.args = args
+        self.timeout = timeout
+        self.name = name
+        self.logger = logger if logger else logging
+        # spawn rather than fork, as the scanner process is multithreaded
+        self.context = multiprocessing.get_context('spawn')
+        self.idle = queue.Queue()
+        for i in range(workers):
+            self.idle.put(self._start_engine())
+
+    def _start_engine(self):
+        parentConn, childConn = self.context.Pipe()
+        engine = self.context.Process(target=self.target, args=(childConn, *self.args), daemon=True)
+        engine.start()
+        childConn.close()
+        return engine, parentConn
+
+    def _stop_engine(self, engine, conn):
+        engine.kill()
+        engine.join(timeout=5)
+        conn.close()
+
+    # returns the engine's reply to the request, or a dict with an "error" key
+    def analyze(self, request):
+        engine, conn = self.idle.get()
+        try:
+            conn.send(request)
+            while True:
+                if not conn.poll(self.timeout):
+                    self.logger.info(f"{get_ident()}: {self.name} engine {engine.pid} timed out on {request}")
+                    self._stop_engine(engine, conn)
+                    engine, conn = self._start_engine()
+                    return {"error": f"Timed out after {self.timeout} seconds"}
+                reply = conn.recv()
+                if isinstance(reply, int):
+                    # a new engine sends its rule count when it's done loading them, before it gets to the request
+                    self.logger.info(f"{get_ident()}: {self.name} engine {engine.pid} loaded {reply} rules")
+                else:
+                    return reply
+        except (EOFError, OSError) as e:
+            self.logger.info(f"{get_ident()}: {self.name} engine {engine.pid} failed: {str(e)}")
+            self._stop_engine(engine, conn)
+            engine, conn = self._start_engine()
+            return {"error": str(e)}
+        finally:
+            self.idle.put((engine, conn))
+
+
 ###################################################################################################
 class FileScanProvider(ABC):
     @staticmethod
@@ -358,6 +637,15 @@ class FileScanProvider(ABC):
         # returns result dict based on response (see FILE_SCAN_RESULT_* above)
         pass
 
+    def ruleset_version(self):
+        # returns a string identifying the current rules/signatures, or None if results shouldn't be cached
+        return None
+
+    def limiter_stats(self):
+        # returns the ScanLimiter metrics (if any) for this provider's requests
+        limiter = getattr(self, 'limiter', None)
+        return limiter.stats() if isinstance(limiter, ScanLimiter) else {}
+
 
 ###################################################################################################
 # class for searching for a hash with a VirusTotal public API, handling rate limiting
@@ -366,10 +654,9 @@ class VirusTotalSearch(FileScanProvider):
     # constructor
     def __init__(self, apiKey, reqLimit=None, reqLimitSec=None):
         self.apiKey = apiKey
-        self.lock = Lock()
-        self.history = deque()
         self.reqLimit = reqLimit if reqLimit else VTOT_MAX_REQS
         self.reqLimitSec = reqLimitSec if reqLimitSec else VTOT_MAX_SEC
+        self.limiter = ScanLimiter(rateLimit=self.reqLimit, rateLimitSec=self.reqLimitSec)
 
     @staticmethod
     def scanner_name():
@@ -391,42 +678,17 @@ class VirusTotalSearch(FileScanProvider):
         if timeout is None:
             timeout = self.reqLimitSec + 5
 
-        allowed = False
         response = None
 
-        # timeout only applies if block=True
-        timeoutTime = int(time.time()) + timeout
-
-        # while limit only repeats if block=True
-        while (not allowed) and (response is None):
-            with self.lock:
-                # first make sure we haven't exceeded rate limits
-                nowTime = int(time.time())
-
-                if len(self.history) < self.reqLimit:
-                    # we've done fewer than the allowed requests, so assume we're good to go
-                    self.history.append(nowTime + self.reqLimitSec)
-                    allowed = True
-
-                elif self.history[0] < nowTime:
-                    # we've done more than the allowed requests, but the oldest one is older than the window
-                    _ = self.history.popleft()
-                    self.history.append(nowTime + self.reqLimitSec)
-                    allowed = True
-
-            if allowed:
-                try:
-                    response = requests.get(VTOT_URL, params={'apikey': self.apiKey, 'resource': sha256sum(fileName)})
-                except requests.exceptions.RequestException:
-                    # things are bad
-                    return None
-
-            elif block and (nowTime < timeoutTime):
-                # rate limited, wait for a bit and come around and try again
-                time.sleep(1)
-
-            else:
-                break
+        # wait (only if block=True) for the rate limit to allow another request
+        if self.limiter.acquire(block=block, timeout=timeout):
+            try:
+                response = requests.get(VTOT_URL, params={'apikey': self.apiKey, 'resource': sha256sum(fileName)})
+            except requests.exceptions.RequestException:
+                # things are bad
+                response = None
+            finally:
+                self.limiter.release()
 
         return response
 
@@ -508,6 +770,123 @@ class VirusTotalSearch(FileScanProvider):
         return result
 
 
+###################################################################################################
+# a long-lived connection to clamd (over its unix socket, or TCP if address is host[:port]) using IDSESSION,
+#   over which several SCAN or INSTREAM commands can be pipelined and their (ID-tagged) replies collected
+class ClamdSession:
+    def __init__(
+        self,
+        socketFileName=None,
+        address=None,
+        timeout=CLAM_SESSION_TIMEOUT_SEC,
+        streamMaxBytes=CLAM_STREAM_MAX_BYTES,
+    ):
+        self.socketFileName = socketFileName if socketFileName else CLAM_DEFAULT_SOCKET_FILE
+        self.address = address
+        self.timeout = timeout
+        self.streamMaxBytes = streamMaxBytes
+        self.sock = None
+        self.buffer = b''
+        self.nextId = 1
+
+    def connect(self):
+        self.close()
+        if self.address:
+            host, _, port = self.address.rpartition(':') if (':' in self.address) else (self.address, '', '')
+            sock = socket.create_connection((host, int(port) if port else CLAM_DEFAULT_PORT), timeout=self.timeout)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socketFileName)
+        sock.sendall(b'zIDSESSION\0')
+        self.sock = sock
+        self.buffer = b''
+        self.nextId = 1
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(b'zEND\0')
+            except OSError:
+                pass
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _recv_reply(self):
+        while b'\0' not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError('clamd closed the session')
+            self.buffer += data
+        reply, self.buffer = self.buffer.split(b'\0', 1)
+        replyId, _, reply = reply.decode(errors='replace').partition(': ')
+        return int(replyId), reply
+
+    # send a command (with no arguments, e.g., VERSION) and return its reply
+    def command(self, cmd):
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(f'z{cmd}\0'.encode())
+        cmdId = self.nextId
+        self.nextId += 1
+        while True:
+            replyId, reply = self._recv_reply()
+            if replyId == cmdId:
+                return reply
+
+    # pipeline scans of several files over the session (by path with SCAN, or by sending the file's contents
+    #   with INSTREAM), returning a list of (status, signature) tuples in the same order as fileNames
+    def scan(self, fileNames, instream=False):
+        if self.sock is None:
+            self.connect()
+        results = [None] * len(fileNames)
+        pending = {}
+        for idx, fileName in enumerate(fileNames):
+            if instream:
+                try:
+                    f = open(fileName, 'rb')
+                except OSError as e:
+                    results[idx] = ('ERROR', str(e))
+                    continue
+                with f:
+                    if os.fstat(f.fileno()).st_size > self.streamMaxBytes:
+                        # clamd would drop the whole session for this, so don't even try
+                        results[idx] = ('ERROR', 'INSTREAM size limit exceeded')
+                        continue
+                    self.sock.sendall(b'zINSTREAM\0')
+                    while chunk := f.read(CLAM_STREAM_CHUNK_BYTES):
+                        self.sock.sendall(struct.pack('!L', len(chunk)) + chunk)
+                    self.sock.sendall(struct.pack('!L', 0))
+            else:
+                self.sock.sendall(f'zSCAN {fileName}\0'.encode())
+            pending[self.nextId] = idx
+            self.nextId += 1
+
+        while pending:
+            replyId, reply = self._recv_reply()
+            if replyId in pending:
+                match = CLAM_RESPONSE_REGEX.match(reply)
+                results[pending.pop(replyId)] = (
+                    (match.group('status'), match.group('signature')) if match else ('ERROR', reply)
+                )
+
+        return results
+
+
+# a file queued for ClamAVScan's session dispatcher threads
+class ClamAVRequest:
+    __slots__ = ('fileName', 'result', 'failed', 'done')
+
+    def __init__(self, fileName=None):
+        self.fileName = fileName
+        self.result = AnalyzerResult()
+        self.failed = False
+        self.done = Event()
+
+
 ###################################################################################################
 # class for scanning a file with ClamAV
 class ClamAVScan(FileScanProvider):
@@ -518,11 +897,31 @@ class ClamAVScan(FileScanProvider):
         logger=None,
         socketFileName=None,
         reqLimit=None,
+        address=None,
+        instream=False,
+        sessions=None,
+        batchSize=None,
+        streamMaxBytes=None,
     ):
-        self.scanningFilesCount = AtomicInt(value=0)
         self.logger = logger if logger else logging
         self.socketFileName = socketFileName
+        self.address = address
+        # without a shared filesystem (i.e., a remote clamd) the file contents have to be streamed to clamd
+        self.instream = instream or bool(address)
         self.reqLimit = reqLimit if reqLimit else CLAM_MAX_REQS
+        self.sessions = sessions if sessions else CLAM_MAX_SESSIONS
+        self.batchSize = batchSize if batchSize else CLAM_BATCH_SIZE
+        self.streamMaxBytes = streamMaxBytes if streamMaxBytes else CLAM_STREAM_MAX_BYTES
+        self.limiter = ScanLimiter(maxConcurrent=self.reqLimit)
+        self.versionLock = Lock()
+        self.version = None
+        self.versionChecked = 0
+
+        # requests are handed off to dispatcher threads, each of which owns a clamd session and pipelines
+        #   whatever requests have queued up (up to batchSize) over it in a single round trip
+        self.requests = queue.Queue()
+        for i in range(self.sessions):
+            Thread(target=self._dispatch, daemon=True).start()
 
     @staticmethod
     def scanner_name():
@@ -535,65 +934,85 @@ class ClamAVScan(FileScanProvider):
     def check_interval():
         return CLAM_CHECK_INTERVAL
 
-    # ---------------------------------------------------------------------------------
-    # submit a file to scan with ClamAV, respecting rate limiting. return scan result
-    def submit(self, fileName=None, fileSize=None, fileType=None, block=False, timeout=CLAM_SUBMIT_TIMEOUT_SEC):
-        clamavResult = AnalyzerResult()
-        allowed = False
-        connected = False
-
-        # timeout only applies if block=True
-        timeoutTime = int(time.time()) + timeout
-
-        # while limit only repeats if block=True
-        while (not allowed) and (not clamavResult.finished):
-            nowTime = int(time.time())
-
-            if not connected:
-                self.logger.debug(f"{get_ident()}: ClamAV attempting connection")
-                clamAv = (
-                    clamd.ClamdUnixSocket(path=self.socketFileName)
-                    if self.socketFileName is not None
-                    else clamd.ClamdUnixSocket()
-                )
-            try:
-                clamAv.ping()
-                connected = True
-                self.logger.debug(f"{get_ident()}: ClamAV connected!")
-            except Exception as e:
-                connected = False
-                self.logger.info(f"{get_ident()}: ClamAV connection failed: {str(e)}")
-
-            if connected:
-                # first make sure we haven't exceeded rate limits
-                if self.scanningFilesCount.increment() <= self.reqLimit:
-                    # we've got fewer than the allowed requests open, so we're good to go!
-                    allowed = True
-                else:
-                    self.scanningFilesCount.decrement()
+    def _new_session(self):
+        return ClamdSession(
+            socketFileName=self.socketFileName,
+            address=self.address,
+            streamMaxBytes=self.streamMaxBytes,
+        )
 
-            if connected and allowed:
+    # ---------------------------------------------------------------------------------
+    # clamd's VERSION response includes the signature database version (e.g., "ClamAV 1.4.2/27552/Thu Feb 13 ...")
+    #   which changes whenever freshclam pulls new signatures and clamd reloads them
+    def ruleset_version(self):
+        with self.versionLock:
+            nowTime = time.time()
+            if (self.version is None) or (nowTime - self.versionChecked >= CLAM_VERSION_CHECK_INTERVAL_SEC):
+                session = self._new_session()
                 try:
-                    self.logger.debug(f'{get_ident()} ClamAV scanning: {fileName}')
-                    clamavResult.result = clamAv.scan(fileName)
-                    self.logger.debug(f'{get_ident()} ClamAV scan result: {clamavResult.result}')
-                    clamavResult.success = clamavResult.result is not None
-                    clamavResult.finished = True
+                    self.version = session.command('VERSION')
                 except Exception as e:
-                    if clamavResult.result is None:
-                        clamavResult.result = str(e)
-                    self.logger.info(f'{get_ident()} ClamAV scan error: {clamavResult.result}')
+                    self.version = None
+                    self.logger.debug(f"{get_ident()}: ClamAV version check failed: {str(e)}")
                 finally:
-                    self.scanningFilesCount.decrement()
+                    session.close()
+                self.versionChecked = nowTime
+            return self.version
 
-            elif block and (nowTime < timeoutTime):
-                # rate limited, wait for a bit and come around and try again
-                time.sleep(1)
+    # ---------------------------------------------------------------------------------
+    # session dispatcher thread: wait for a request, then gather up whatever else is queued and scan them together
+    def _dispatch(self):
+        session = self._new_session()
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
 
-            else:
-                break
+            self.logger.debug(f"{get_ident()} ClamAV scanning: {[x.fileName for x in batch]}")
+            results = None
+            for attempt in range(2):
+                # the session may have been closed by clamd (e.g., IdleTimeout) since we last used it, so reconnect
+                #   and try once more before giving up on these files for now
+                try:
+                    results = session.scan([x.fileName for x in batch], instream=self.instream)
+                    break
+                except Exception as e:
+                    session.close()
+                    self.logger.info(f"{get_ident()}: ClamAV session failed: {str(e)}")
+            self.logger.debug(f"{get_ident()} ClamAV scan result: {results}")
+
+            for idx, request in enumerate(batch):
+                if results is None:
+                    request.failed = True
+                else:
+                    status, signature = results[idx]
+                    if status == 'ERROR':
+                        request.result.result = {"error": signature}
+                        request.result.success = False
+                    else:
+                        request.result.result = {request.fileName: (status, signature)}
+                        request.result.success = True
+                    request.result.finished = True
+                request.done.set()
+
+    # ---------------------------------------------------------------------------------
+    # submit a file to scan with ClamAV, respecting rate limiting. return scan result, or None if
+    #   we couldn't get a slot before the timeout (only applies if block=True) or couldn't talk to clamd
+    def submit(self, fileName=None, fileSize=None, fileType=None, block=False, timeout=CLAM_SUBMIT_TIMEOUT_SEC):
+        if not self.limiter.acquire(block=block, timeout=timeout):
+            return None
 
-        return clamavResult
+        try:
+            request = ClamAVRequest(fileName)
+            self.requests.put(request)
+            request.done.wait()
+        finally:
+            self.limiter.release()
+
+        return None if request.failed else request.result
 
     # ---------------------------------------------------------------------------------
     # return the result of the previously scanned file
@@ -642,6 +1061,26 @@ class ClamAVScan(FileScanProvider):
         return result
 
 
+###################################################################################################
+# yara engine process: load a compiled ruleset saved by YaraScan, then match files sent over the pipe until told
+#   to stop, replying with the list of matching rule names. each request is (compiledRulesFile, fileName), so when
+#   YaraScan compiles a new ruleset the engines pick it up with their next request
+def yara_engine_process(conn, compiledRulesFile):
+    rules = yara.load(compiledRulesFile)
+    conn.send(len(list(rules)))
+
+    while (request := conn.recv()) is not None:
+        requestRulesFile, fileName = request
+        try:
+            if requestRulesFile != compiledRulesFile:
+                rules = yara.load(requestRulesFile)
+                compiledRulesFile = requestRulesFile
+            result = [match.rule for match in rules.match(fileName, timeout=YARA_RUN_TIMEOUT_SEC)]
+        except Exception as e:
+            result = {"error": str(e)}
+        conn.send(result)
+
+
 ###################################################################################################
 # class for scanning a file with Yara
 class YaraScan(FileScanProvider):
@@ -652,29 +1091,125 @@ class YaraScan(FileScanProvider):
         logger=None,
         rulesDirs=[],
         reqLimit=None,
+        compiledDir=None,
+        checkInterval=YARA_RULES_CHECK_INTERVAL_SEC,
     ):
-        self.scanningFilesCount = AtomicInt(value=0)
         self.logger = logger if logger else logging
         self.reqLimit = reqLimit if reqLimit else YARA_MAX_REQS
-        self.ruleFilespecs = {}
-        for yaraDir in rulesDirs:
+        self.limiter = ScanLimiter(maxConcurrent=self.reqLimit)
+        self.rulesDirs = list(rulesDirs)
+        try:
+            os.makedirs(compiledDir, exist_ok=True)
+            self.compiledDir = compiledDir
+        except (OSError, TypeError):
+            self.compiledDir = tempfile.mkdtemp(prefix=YARA_COMPILED_PREFIX)
+        self.rulesLock = Lock()
+        self.rulesSnapshot = self._rules_snapshot()
+        self.rulesVersion, self.compiledRulesFile = self._compile_rules()
+        self.previousRulesFile = None
+        self._prune_compiled_rules()
+
+        # matching is done in a pool of engine processes rather than on the scanner's threads
+        self.engines = ScanEnginePool(
+            self.reqLimit,
+            yara_engine_process,
+            args=(self.compiledRulesFile,),
+            timeout=YARA_RUN_TIMEOUT_SEC + 30,
+            name='Yara',
+            logger=self.logger,
+        )
+
+        # watch the rules directories so that changed rules are recompiled and swapped in without a restart
+        if checkInterval > 0:
+            Thread(target=self._watch_rules, args=(checkInterval,), daemon=True).start()
+
+    # ---------------------------------------------------------------------------------
+    # (name, size, mtime) of every rules file, to cheaply tell if anything has changed
+    def _rules_snapshot(self):
+        # skip hidden, backup or system related files
+        snapshot = []
+        for yaraDir in self.rulesDirs:
             for root, dirs, files in os.walk(yaraDir):
                 for file in files:
-                    # skip hidden, backup or system related files
                     if file.startswith(".") or file.startswith("~") or file.startswith("_"):
                         continue
-                    filename = os.path.join(root, file)
                     try:
-                        yara.compile(filename)
-                        self.ruleFilespecs[filename] = filename
-                    except yara.SyntaxError as e:
-                        self.logger.info(f'{get_ident()} Ignored Yara compile error in {filename}: {e}')
-        self.logger.info(f"{get_ident()}: Initializing Yara with {len(self.ruleFilespecs)} rules files")
-        self.logger.debug(
-            f"{get_ident()}: Initializing Yara with {len(self.ruleFilespecs)} rules files: {self.ruleFilespecs}"
+                        fileStat = os.stat(os.path.join(root, file))
+                        snapshot.append((os.path.join(root, file), fileStat.st_size, fileStat.st_mtime_ns))
+                    except OSError:
+                        pass
+        return sorted(snapshot)
+
+    # ---------------------------------------------------------------------------------
+    # compile the rules files into a single saved ruleset, named for the digest of the rules that went into it so
+    #   that an unchanged ruleset can just be loaded from a previous run's compiled copy. returns (digest, filename)
+    def _compile_rules(self):
+        rulesVersion = rules_digest(self.rulesDirs, extra=yara.__version__)
+        compiledRulesFile = os.path.join(
+            self.compiledDir, f"{YARA_COMPILED_PREFIX}{rulesVersion}{YARA_COMPILED_SUFFIX}"
         )
+        if os.path.isfile(compiledRulesFile):
+            self.logger.info(f"{get_ident()}: Using previously compiled Yara rules {compiledRulesFile}")
+            return rulesVersion, compiledRulesFile
+
+        ruleFilespecs = {x[0]: x[0] for x in self._rules_snapshot()}
+        try:
+            compiledRules = yara.compile(filepaths=ruleFilespecs)
+        except yara.SyntaxError:
+            # something in there is bad, so compile them one at a time to find out what and leave it out
+            for filename in list(ruleFilespecs.keys()):
+                try:
+                    yara.compile(filename)
+                except yara.SyntaxError as e:
+                    self.logger.info(f'{get_ident()} Ignored Yara compile error in {filename}: {e}')
+                    del ruleFilespecs[filename]
+            compiledRules = yara.compile(filepaths=ruleFilespecs)
+        self.logger.info(f"{get_ident()}: Initializing Yara with {len(ruleFilespecs)} rules files")
+        self.logger.debug(f"{get_ident()}: Initializing Yara with {len(ruleFilespecs)} rules files: {ruleFilespecs}")
+
+        tmpRulesFile = compiledRulesFile + '.tmp'
+        compiledRules.save(tmpRulesFile)
+        os.replace(tmpRulesFile, compiledRulesFile)
+        self.logger.info(f"{get_ident()}: Saved compiled Yara rules {compiledRulesFile}")
+        return rulesVersion, compiledRulesFile
+
+    # ---------------------------------------------------------------------------------
+    # remove compiled rulesets other than the current one (and the one before it, which engines may still be using)
+    def _prune_compiled_rules(self):
+        keep = {self.compiledRulesFile, self.previousRulesFile}
+        for file in os.listdir(self.compiledDir):
+            compiledRulesFile = os.path.join(self.compiledDir, file)
+            if (
+                file.startswith(YARA_COMPILED_PREFIX)
+                and file.endswith(YARA_COMPILED_SUFFIX)
+                and (compiledRulesFile not in keep)
+            ):
+                try:
+                    os.remove(compiledRulesFile)
+                except OSError:
+                    pass
 
-        self.compiledRules = yara.compile(filepaths=self.ruleFilespecs)
+    # ---------------------------------------------------------------------------------
+    # rules directory watcher thread
+    def _watch_rules(self, checkInterval):
+        while True:
+            time.sleep(checkInterval)
+            rulesSnapshot = self._rules_snapshot()
+            if rulesSnapshot != self.rulesSnapshot:
+                try:
+                    rulesVersion, compiledRulesFile = self._compile_rules()
+                except Exception as e:
+                    self.logger.warning(f"{get_ident()}: Failed to recompile changed Yara rules: {str(e)}")
+                    continue
+                self.rulesSnapshot = rulesSnapshot
+                if compiledRulesFile != self.compiledRulesFile:
+                    # scans already in progress finish with the old rules, new requests use the new ones
+                    with self.rulesLock:
+                        self.previousRulesFile = self.compiledRulesFile
+                        self.rulesVersion, self.compiledRulesFile = rulesVersion, compiledRulesFile
+                        self.engines.args = (compiledRulesFile,)
+                    self._prune_compiled_rules()
+                    self.logger.info(f"{get_ident()}: Reloaded changed Yara rules {compiledRulesFile}")
 
     @staticmethod
     def scanner_name():
@@ -687,48 +1222,31 @@ class YaraScan(FileScanProvider):
     def check_interval():
         return YARA_CHECK_INTERVAL
 
+    def ruleset_version(self):
+        with self.rulesLock:
+            return self.rulesVersion
+
     # ---------------------------------------------------------------------------------
-    # submit a file to scan with Yara, respecting rate limiting. return scan result
+    # submit a file to scan with Yara, respecting rate limiting. return scan result, or None if
+    #   we couldn't get a slot before the timeout (only applies if block=True)
     def submit(self, fileName=None, fileSize=None, fileType=None, block=False, timeout=YARA_SUBMIT_TIMEOUT_SEC):
         yaraResult = AnalyzerResult()
-        allowed = False
-
-        # timeout only applies if block=True
-        timeoutTime = int(time.time()) + timeout
-
-        # while limit only repeats if block=True
-        while (not allowed) and (not yaraResult.finished):
-            nowTime = int(time.time())
-
-            # first make sure we haven't exceeded rate limits
-            if self.scanningFilesCount.increment() <= self.reqLimit:
-                # we've got fewer than the allowed requests open, so we're good to go!
-                allowed = True
-            else:
-                self.scanningFilesCount.decrement()
-
-            if allowed:
-                try:
-                    self.logger.debug(f'{get_ident()} Yara scanning: {fileName}')
-                    yaraResult.result = self.compiledRules.match(fileName, timeout=YARA_RUN_TIMEOUT_SEC)
-                    self.logger.debug(f'{get_ident()} Yara scan result: {yaraResult.result}')
-                    yaraResult.success = yaraResult.result is not None
-                    yaraResult.finished = True
-                except Exception as e:
-                    if yaraResult.result is None:
-                        yaraResult.result = {"error": str(e)}
-                    yaraResult.success = False
-                    yaraResult.finished = True
-                    self.logger.info(f'{get_ident()} Yara scan error: {yaraResult.result}')
-                finally:
-                    self.scanningFilesCount.decrement()
 
-            elif block and (nowTime < timeoutTime):
-                # rate limited, wait for a bit and come around and try again
-                time.sleep(1)
-
-            else:
-                break
+        if not self.limiter.acquire(block=block, timeout=timeout):
+            return None
+
+        try:
+            self.logger.debug(f'{get_ident()} Yara scanning: {fileName}')
+            with self.rulesLock:
+                compiledRulesFile = self.compiledRulesFile
+            yaraResult.result = self.engines.analyze((compiledRulesFile, fileName))
+            self.logger.debug(f'{get_ident()} Yara scan result: {yaraResult.result}')
+            yaraResult.success = isinstance(yaraResult.result, list)
+            yaraResult.finished = True
+            if not yaraResult.success:
+                self.logger.info(f'{get_ident()} Yara scan error: {yaraResult.result}')
+        finally:
+            self.limiter.release()
 
         return yaraResult
 
@@ -760,7 +1278,8 @@ class YaraScan(FileScanProvider):
             resp = response
 
         if isinstance(resp, list):
-            hits = [match.rule for match in resp if isinstance(match, yara.Match)]
+            # matches come back from the engines as rule names
+            hits = [match.rule if isinstance(match, yara.Match) else match for match in resp]
             result[FILE_SCAN_RESULT_HITS] = len(hits)
             if len(hits) > 0:
                 cnt = Counter(hits)
@@ -776,6 +1295,52 @@ class YaraScan(FileScanProvider):
         return result
 
 
+###################################################################################################
+# capa engine process: load (and compile) the rules once, then analyze files sent over the pipe until told to stop,
+#   replying with the same result document structure that "capa --json" would print
+def capa_engine_process(conn, rulesDir, sigsDir):
+    from pathlib import Path
+
+    import capa.capabilities.common
+    import capa.helpers
+    import capa.loader
+    import capa.render.json
+    import capa.rules
+    from capa.features.common import FORMAT_DOTNET
+
+    rulesPaths = [Path(rulesDir)]
+    rules = capa.rules.get_rules(rulesPaths)
+    sigPaths = capa.loader.get_signatures(Path(sigsDir)) if (sigsDir and os.path.isdir(sigsDir)) else []
+    conn.send(len(rules))
+
+    while (fileName := conn.recv()) is not None:
+        try:
+            inputPath = Path(fileName)
+            inputFormat = capa.helpers.get_auto_format(inputPath)
+            backend = capa.loader.BACKEND_DOTNET if (inputFormat == FORMAT_DOTNET) else capa.loader.BACKEND_VIV
+            inputOs = capa.loader.get_os(inputPath)
+            extractor = capa.loader.get_extractor(
+                inputPath,
+                inputFormat,
+                inputOs,
+                backend,
+                sigPaths,
+                should_save_workspace=False,
+                disable_progress=True,
+                sample_path=inputPath,
+            )
+            capabilities = capa.capabilities.common.find_capabilities(rules, extractor, disable_progress=True)
+            meta = capa.loader.collect_metadata(
+                [], inputPath, inputFormat, inputOs, rulesPaths, extractor, capabilities
+            )
+            meta.analysis.layout = capa.loader.compute_layout(rules, extractor, capabilities.matches)
+            result = json.loads(capa.render.json.render(meta, rules, capabilities.matches))
+        except Exception as e:
+            # most likely not something capa can analyze
+            result = {"error": f"{type(e).__name__}: {e}"}
+        conn.send(result)
+
+
 ###################################################################################################
 # class for scanning a file with Capa
 class CapaScan(FileScanProvider):
@@ -787,12 +1352,37 @@ class CapaScan(FileScanProvider):
         rulesDir=None,
         verboseHits=False,
         reqLimit=None,
+        inProcess=True,
     ):
-        self.scanningFilesCount = AtomicInt(value=0)
         self.rulesDir = rulesDir
         self.logger = logger if logger else logging
         self.verboseHits = verboseHits
         self.reqLimit = reqLimit if reqLimit else CAPA_MAX_REQS
+        self.limiter = ScanLimiter(maxConcurrent=self.reqLimit)
+
+        # if the capa python package (and a set of rules for it) is available, analyze files in long-lived capa
+        #   engine processes rather than running the capa executable (and loading all of its rules) for each one
+        self.engines = None
+        engineRulesDir = self.rulesDir if self.rulesDir else CAPA_DEFAULT_RULES_DIR
+        if inProcess and (importlib.util.find_spec('capa') is not None) and os.path.isdir(engineRulesDir):
+            self.engines = ScanEnginePool(
+                self.reqLimit,
+                capa_engine_process,
+                args=(engineRulesDir, CAPA_DEFAULT_SIGS_DIR),
+                timeout=CAPA_RUN_TIMEOUT_SEC,
+                name='Capa',
+                logger=self.logger,
+            )
+            self.logger.info(
+                f"{get_ident()}: Initializing {self.reqLimit} capa engines with rules from {engineRulesDir}"
+            )
+
+        # capa's default rules are embedded in the capa binary, so its version is part of the ruleset version too
+        capaErr, capaOut = run_process(['capa', '--version'], stderr=False, logger=self.logger)
+        self.rulesVersion = rules_digest(
+            [engineRulesDir] if (self.engines or self.rulesDir) else [],
+            extra=f"{' '.join(capaOut) if (capaErr == 0) else ''}|{self.verboseHits}",
+        )
 
     @staticmethod
     def scanner_name():
@@ -805,99 +1395,87 @@ class CapaScan(FileScanProvider):
     def check_interval():
         return CAPA_CHECK_INTERVAL
 
+    def ruleset_version(self):
+        return self.rulesVersion
+
     # ---------------------------------------------------------------------------------
-    # submit a file to scan with Capa, respecting rate limiting. return scan result
+    # submit a file to scan with Capa, respecting rate limiting. return scan result, or None if
+    #   we couldn't get a slot before the timeout (only applies if block=True)
     def submit(self, fileName=None, fileSize=None, fileType=None, block=False, timeout=CAPA_SUBMIT_TIMEOUT_SEC):
         capaResult = AnalyzerResult(verbose=self.verboseHits)
 
         if (fileType is not None) and (fileType in CAPA_MIMES_TO_SCAN):
-            allowed = False
-
-            # timeout only applies if block=True
-            timeoutTime = int(time.time()) + timeout
+            if not self.limiter.acquire(block=block, timeout=timeout):
+                return None
 
-            # while limit only repeats if block=True
-            while (not allowed) and (not capaResult.finished):
-                nowTime = int(time.time())
-
-                # first make sure we haven't exceeded rate limits
-                if self.scanningFilesCount.increment() <= self.reqLimit:
-                    # we've got fewer than the allowed requests open, so we're good to go!
-                    allowed = True
+            try:
+                self.logger.debug(f'{get_ident()} Capa scanning: {fileName}')
+
+                if self.engines is not None:
+                    capaResult.result = self.engines.analyze(fileName)
+
+                elif self.rulesDir is not None:
+                    cmd = [
+                        'timeout',
+                        '-k',
+                        '10',
+                        '-s',
+                        'TERM',
+                        str(CAPA_RUN_TIMEOUT_SEC),
+                        'capa',
+                        '--quiet',
+                        '-r',
+                        self.rulesDir,
+                        '--json',
+                        '--color',
+                        'never',
+                        fileName,
+                    ]
                 else:
-                    self.scanningFilesCount.decrement()
+                    cmd = [
+                        'timeout',
+                        '-k',
+                        '10',
+                        '-s',
+                        'TERM',
+                        str(CAPA_RUN_TIMEOUT_SEC),
+                        'capa',
+                        '--quiet',
+                        '--json',
+                        '--color',
+                        'never',
+                        fileName,
+                    ]
 
-                if allowed:
-                    try:
-                        self.logger.debug(f'{get_ident()} Capa scanning: {fileName}')
-
-                        if self.rulesDir is not None:
-                            cmd = [
-                                'timeout',
-                                '-k',
-                                '10',
-                                '-s',
-                                'TERM',
-                                str(CAPA_RUN_TIMEOUT_SEC),
-                                'capa',
-                                '--quiet',
-                                '-r',
-                                self.rulesDir,
-                                '--json',
-                                '--color',
-                                'never',
-                                fileName,
-                            ]
-                        else:
-                            cmd = [
-                                'timeout',
-                                '-k',
-                                '10',
-                                '-s',
-                                'TERM',
-                                str(CAPA_RUN_TIMEOUT_SEC),
-                                'capa',
-                                '--quiet',
-                                '--json',
-                                '--color',
-                                'never',
-                                fileName,
-                            ]
-                        capaErr, capaOut = run_process(cmd, stderr=False, logger=self.logger)
-                        if (capaErr == 0) and (len(capaOut) > 0) and (len(capaOut[0]) > 0):
-                            # load the JSON output from capa into the .result
-                            try:
-                                capaResult.result = json.loads(capaOut[0])
-                            except (ValueError, TypeError):
-                                capaResult.result = {"error": f"Invalid response: {'; '.join(capaOut)}"}
-
-                        else:
-                            # probably failed because it's not an executable, ignore it
-                            capaResult.result = {"error": str(capaErr)}
-
-                        self.logger.debug(f'{get_ident()} Capa scan result: {capaResult.result}')
-                        capaResult.success = capaResult.result is not None
-                        capaResult.finished = True
-
-                    except Exception as e:
-                        if capaResult.result is None:
-                            capaResult.result = str(e)
-                        self.logger.debug(f'{get_ident()} Capa scan error: {capaResult.result}')
-
-                    finally:
-                        self.scanningFilesCount.decrement()
+                if self.engines is None:
+                    capaErr, capaOut = run_process(cmd, stderr=False, logger=self.logger)
+                    if (capaErr == 0) and (len(capaOut) > 0) and (len(capaOut[0]) > 0):
+                        # load the JSON output from capa into the .result
                         try:
-                            if os.path.isfile(fileName + CAPA_VIV_SUFFIX):
-                                os.remove(fileName + CAPA_VIV_SUFFIX)
-                        except Exception:
-                            pass
+                            capaResult.result = json.loads(capaOut[0])
+                        except (ValueError, TypeError):
+                            capaResult.result = {"error": f"Invalid response: {'; '.join(capaOut)}"}
 
-                elif block and (nowTime < timeoutTime):
-                    # rate limited, wait for a bit and come around and try again
-                    time.sleep(1)
+                    else:
+                        # probably failed because it's not an executable, ignore it
+                        capaResult.result = {"error": str(capaErr)}
 
-                else:
-                    break
+                self.logger.debug(f'{get_ident()} Capa scan result: {capaResult.result}')
+                capaResult.success = capaResult.result is not None
+                capaResult.finished = True
+
+            except Exception as e:
+                if capaResult.result is None:
+                    capaResult.result = str(e)
+                self.logger.debug(f'{get_ident()} Capa scan error: {capaResult.result}')
+
+            finally:
+                self.limiter.release()
+                try:
+                    if os.path.isfile(fileName + CAPA_VIV_SUFFIX):
+                        os.remove(fileName + CAPA_VIV_SUFFIX)
+                except Exception:
+                    pass
 
         else:
             # not an executable, don't need to scan it
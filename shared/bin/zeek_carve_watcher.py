@@ -13,7 +13,6 @@ import argparse
 import glob
 import json
 import logging
-import magic
 import os
 import pathlib
 import signal
@@ -22,8 +21,8 @@ import time
 import zmq
 
 from multiprocessing.pool import ThreadPool
-from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver
+from threading import Lock
+from watchdog.events import FileCreatedEvent
 from watchdog.utils import WatchdogShutdownError
 
 from zeek_carve_utils import (
@@ -38,6 +37,7 @@ from zeek_carve_utils import (
 import malcolm_utils
 from malcolm_utils import touch, eprint, str2bool
 import watch_common
+from sniff_common import sniff_file
 
 ###################################################################################################
 MINIMUM_CHECKED_FILE_SIZE_DEFAULT = 64
@@ -66,6 +66,8 @@ class EventWatcher:
         # Socket to send messages on
         self.logger.info(f"{scriptName}:\tbinding ventilator port {VENTILATOR_PORT}")
         self.ventilator_socket = self.context.socket(zmq.PUB)
+        # ZeroMQ sockets aren't thread-safe, and processFile may be called from multiple processor threads
+        self.ventilatorSocketLock = Lock()
         self.ventilator_socket.bind(f"tcp://*:{VENTILATOR_PORT}")
 
         # todo: do I want to set this? probably not since this guy's whole job is to send
@@ -84,7 +86,7 @@ class EventWatcher:
         if os.path.isfile(pathname):
             fileSize = os.path.getsize(pathname)
             if args.minBytes <= fileSize <= args.maxBytes:
-                fileType = magic.from_file(pathname, mime=True)
+                fileType = sniff_file(pathname).mime
                 if (pathlib.Path(pathname).suffix != CAPA_VIV_SUFFIX) and (fileType != CAPA_VIV_MIME):
                     # the entity is a right-sized file, is not a capa .viv cache file, and it exists, so send it to get scanned
 
@@ -97,7 +99,8 @@ class EventWatcher:
                     )
                     self.logger.info(f"{scriptName}:\t📩\t{fileInfo}")
                     try:
-                        self.ventilator_socket.send_string(fileInfo)
+                        with self.ventilatorSocketLock:
+                            self.ventilator_socket.send_string(fileInfo)
                         self.logger.info(f"{scriptName}:\t📫\t{pathname}")
                     except zmq.Again:
                         self.logger.debug(f"{scriptName}:\t🕑\t{pathname}")
@@ -193,6 +196,16 @@ def main():
         ),
         required=False,
     )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        dest='processorThreads',
+        help="Number of threads processing files once they're ready",
+        metavar='<threads>',
+        type=int,
+        default=int(os.getenv('EXTRACTED_FILE_WATCHER_THREADS', str(watch_common.PROCESSOR_THREADS_DEFAULT))),
+        required=False,
+    )
     parser.add_argument(
         '--min-bytes',
         dest='minBytes',
@@ -263,7 +276,7 @@ def main():
     # begin threaded watch of path(s)
     time.sleep(1)
 
-    observer = PollingObserver() if args.polling else Observer()
+    observer = watch_common.create_observer(args.polling, args.assumeClosedSec)
     handler = watch_common.FileOperationEventHandler(
         logger=None,
         polling=args.polling,
@@ -286,7 +299,11 @@ def main():
                 for preexistingFile in [
                     os.path.join(watchDir, x) for x in pathlib.Path(watchDir).iterdir() if x.is_file()
                 ]:
-                    touch(preexistingFile)
+                    if args.polling:
+                        # the polling observer only notices files when they change, so hand them over directly
+                        handler.on_any_event(FileCreatedEvent(preexistingFile))
+                    else:
+                        touch(preexistingFile)
                     filesTouched += 1
             if filesTouched > 0:
                 logging.info(f"{scriptName}:\tfound {filesTouched} preexisting files to check")
@@ -305,6 +322,7 @@ def main():
                     workerThreadCount,
                     shuttingDown,
                     logging,
+                    args.processorThreads,
                 ],
             ),
         )